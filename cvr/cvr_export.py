@@ -0,0 +1,337 @@
+"""
+Compact ballot-level CVR export shared by the importers.
+
+data.sqlite3 used to hold the CVR as three normalized tables, one row per
+ballot, contest and selection, each repeating its source. The export now
+stores one row per ballot per contest, with the approved candidates as a
+bitmask over the contest's ordered candidate list:
+
+- ``cvr_export_sources``: each importer's source name once
+- ``cvr_export_contests``: each contest of a source, its report and its
+  candidates as a JSON list of ``[candidate_name, candidate_id]`` pairs;
+  bit ``n`` of a ballot's approvals is the ``n``th pair
+- ``cvr_export_ballots``: one row per ballot
+- ``cvr_ballot_approvals``: one row per ballot per contest, with the
+  undervotes and the approvals bitmask
+
+``cvr_ballots``, ``cvr_contests`` and ``cvr_selections`` are views over
+these with the old columns, so existing queries work unchanged. Only
+approvals (``selection_value = 1``) are exported.
+
+Usage:
+    setup_export_tables(main_conn)
+    writer = CompactCvrWriter(main_conn, export_source_id(main_conn, "utah"))
+    writer.add_ballots(ballot_rows)
+    writer.add_contest_records(contest_rows)
+    writer.finish(lambda contest_name: report_id)
+"""
+
+import json
+
+# A bitmask is one SQLite integer, so a contest can have 64 candidates
+MAX_CANDIDATES = 64
+
+EXPORT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cvr_export_sources (
+    id INTEGER PRIMARY KEY,
+    source TEXT UNIQUE NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS cvr_export_contests (
+    id INTEGER PRIMARY KEY,
+    source_id INTEGER NOT NULL REFERENCES cvr_export_sources(id),
+    report_id INTEGER REFERENCES reports(id),
+    contest_name TEXT NOT NULL,
+    contest_id TEXT NOT NULL,
+    candidates TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS cvr_export_ballots (
+    id INTEGER PRIMARY KEY,
+    source_id INTEGER NOT NULL REFERENCES cvr_export_sources(id),
+    cvr_guid TEXT NOT NULL,
+    batch_sequence INTEGER,
+    sheet_number INTEGER,
+    precinct_name TEXT,
+    precinct_id TEXT,
+    is_blank BOOLEAN,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(source_id, cvr_guid)
+);
+
+CREATE TABLE IF NOT EXISTS cvr_ballot_approvals (
+    id INTEGER PRIMARY KEY,
+    ballot_id INTEGER NOT NULL REFERENCES cvr_export_ballots(id),
+    contest INTEGER NOT NULL REFERENCES cvr_export_contests(id),
+    undervotes INTEGER,
+    approvals INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_cvr_ballot_approvals_contest ON cvr_ballot_approvals(contest);
+"""
+
+# Views with the old table names and columns. A selection's id is derived
+# from its contest record and bit, so it is stable but not the old id.
+EXPORT_VIEWS = """
+CREATE VIEW IF NOT EXISTS cvr_ballots AS
+SELECT
+    b.id, s.source, b.cvr_guid, b.batch_sequence, b.sheet_number,
+    b.precinct_name, b.precinct_id, b.is_blank, b.created_at
+FROM cvr_export_ballots b
+JOIN cvr_export_sources s ON s.id = b.source_id;
+
+CREATE VIEW IF NOT EXISTS cvr_contests AS
+SELECT a.id, s.source, a.ballot_id, c.contest_name, c.contest_id, a.undervotes
+FROM cvr_ballot_approvals a
+JOIN cvr_export_contests c ON c.id = a.contest
+JOIN cvr_export_sources s ON s.id = c.source_id;
+
+CREATE VIEW IF NOT EXISTS cvr_selections AS
+SELECT
+    a.id * 64 + j.key AS id,
+    s.source,
+    a.id AS contest_record_id,
+    json_extract(j.value, '$[0]') AS candidate_name,
+    json_extract(j.value, '$[1]') AS candidate_id,
+    1 AS selection_value
+FROM cvr_ballot_approvals a
+JOIN cvr_export_contests c ON c.id = a.contest
+JOIN cvr_export_sources s ON s.id = c.source_id
+JOIN json_each(c.candidates) j ON (a.approvals >> j.key) & 1;
+"""
+
+# Contest records of the normalized tables with their approvals, grouped by
+# record; records without approvals come through once with NULL candidates
+NORMALIZED_RECORDS_QUERY = """
+SELECT c.id, c.ballot_id, c.contest_name, c.contest_id, c.undervotes,
+       s.candidate_name, s.candidate_id
+FROM {contests} c
+LEFT JOIN {selections} s
+    ON s.contest_record_id = c.id AND s.selection_value = 1{source_join}
+{where}
+ORDER BY c.id
+"""
+
+
+def normalized_records_query(prefix="", source=False):
+    """Return the query reading contest records from normalized CVR tables.
+
+    ``prefix`` qualifies the tables (``"cvr."`` for an attached database);
+    with ``source`` the records are restricted to the source bound as its
+    one parameter.
+    """
+    return NORMALIZED_RECORDS_QUERY.format(
+        contests=f"{prefix}cvr_contests",
+        selections=f"{prefix}cvr_selections",
+        source_join=" AND s.source = c.source" if source else "",
+        where="WHERE c.source = ?" if source else "",
+    )
+
+
+def export_source_id(conn, source):
+    """Return the id of an export source, adding it if it is new."""
+    conn.execute(
+        "INSERT OR IGNORE INTO cvr_export_sources (source) VALUES (?)", (source,)
+    )
+    return conn.execute(
+        "SELECT id FROM cvr_export_sources WHERE source = ?", (source,)
+    ).fetchone()[0]
+
+
+def delete_source(conn, source_id):
+    """Delete every exported ballot, contest and approval row of a source."""
+    conn.execute(
+        """
+        DELETE FROM cvr_ballot_approvals
+        WHERE contest IN (SELECT id FROM cvr_export_contests WHERE source_id = ?)
+        """,
+        (source_id,),
+    )
+    conn.execute("DELETE FROM cvr_export_contests WHERE source_id = ?", (source_id,))
+    conn.execute("DELETE FROM cvr_export_ballots WHERE source_id = ?", (source_id,))
+
+
+def setup_export_tables(conn):
+    """Create the export tables and views, converting normalized CVR tables.
+
+    A database written before the compact export has ``cvr_ballots``,
+    ``cvr_contests`` and ``cvr_selections`` as tables. Their rows are
+    re-encoded per source, keeping the ballot and contest record ids, and
+    the tables (with their indexes) are dropped to make way for the views.
+    Everything happens in one transaction, so readers see either the old
+    tables or the new views, and a failed conversion leaves the old tables.
+    """
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        legacy = conn.execute(
+            "SELECT type FROM sqlite_master WHERE name = 'cvr_ballots'"
+        ).fetchone()
+        _execute_statements(conn, EXPORT_SCHEMA)
+        if legacy is not None and legacy[0] == "table":
+            sources = conn.execute("SELECT DISTINCT source FROM cvr_ballots").fetchall()
+            for (source,) in sources:
+                writer = CompactCvrWriter(conn, export_source_id(conn, source))
+                writer.add_ballots(
+                    conn.execute(
+                        """
+                        SELECT id, cvr_guid, batch_sequence, sheet_number,
+                               precinct_name, precinct_id, is_blank, created_at
+                        FROM cvr_ballots WHERE source = ? ORDER BY id
+                        """,
+                        (source,),
+                    )
+                )
+                writer.add_contest_records(
+                    conn.execute(normalized_records_query(source=True), (source,))
+                )
+                writer.finish()
+            conn.execute("DROP TABLE cvr_selections")
+            conn.execute("DROP TABLE cvr_contests")
+            conn.execute("DROP TABLE cvr_ballots")
+        _execute_statements(conn, EXPORT_VIEWS)
+
+
+def _execute_statements(conn, script):
+    """Run each statement of a schema script in the open transaction.
+
+    ``executescript`` would commit first, so it cannot be part of one.
+    """
+    for statement in script.split(";"):
+        if statement.strip():
+            conn.execute(statement)
+
+
+class CompactCvrWriter:
+    """Write one source's ballots and contest records in the compact format.
+
+    Each contest gets its candidate list in the order the candidates are
+    first seen. Ids given for ballots and contest records are kept, so
+    normalized tables can be converted with their ids. St. Louis stages its
+    export with set-based SQL instead (see ``stage_cvr_tables`` in
+    ``st-louis/process_all.py``).
+    """
+
+    def __init__(self, conn, source_id):
+        self.conn = conn
+        self.source_id = source_id
+        self.contests = {}  # (contest_name, contest_id) -> (id, {candidate: bit})
+        self.next_contest = (
+            conn.execute(
+                "SELECT COALESCE(MAX(id), 0) FROM cvr_export_contests"
+            ).fetchone()[0]
+            + 1
+        )
+
+    def add_ballots(self, rows):
+        """Insert ``(id, cvr_guid, batch_sequence, sheet_number, precinct_name,
+        precinct_id, is_blank, created_at)`` rows and return how many.
+
+        ``id`` may be None to assign the next one, and ``created_at`` None
+        for the current time.
+        """
+        cursor = self.conn.executemany(
+            """
+            INSERT INTO cvr_export_ballots (
+                id, source_id, cvr_guid, batch_sequence, sheet_number,
+                precinct_name, precinct_id, is_blank, created_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+            """,
+            ((ballot_id, self.source_id, *fields) for ballot_id, *fields in rows),
+        )
+        return cursor.rowcount
+
+    def add_contest_records(self, rows):
+        """Encode and insert contest records, returning how many.
+
+        ``rows`` are ``(id, ballot_id, contest_name, contest_id, undervotes,
+        candidate_name, candidate_id)``, one per approval and grouped by
+        record id; a record with no approvals has one row with None for
+        the candidate.
+        """
+        cursor = self.conn.executemany(
+            """
+            INSERT INTO cvr_ballot_approvals (id, ballot_id, contest, undervotes, approvals)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            self._encode(rows),
+        )
+        return cursor.rowcount
+
+    def _encode(self, rows):
+        record = None
+        for (
+            record_id,
+            ballot_id,
+            name,
+            contest_id,
+            undervotes,
+            candidate,
+            candidate_id,
+        ) in rows:
+            if record is None or record[0] != record_id:
+                if record is not None:
+                    yield _signed(record)
+                contest, bits = self._contest(name, contest_id)
+                record = [record_id, ballot_id, contest, undervotes, 0]
+            if candidate is not None:
+                bit = bits.get((candidate, candidate_id))
+                if bit is None:
+                    if len(bits) == MAX_CANDIDATES:
+                        raise ValueError(
+                            f"{name} has more than {MAX_CANDIDATES} candidates"
+                        )
+                    bit = bits[(candidate, candidate_id)] = len(bits)
+                record[4] |= 1 << bit
+        if record is not None:
+            yield _signed(record)
+
+    def declare_contest(self, name, contest_id, candidates):
+        """Give a contest its candidate order before any records are added.
+
+        ``candidates`` are ``(candidate_name, candidate_id)`` pairs, such as
+        a report's candidates; any others seen later are appended.
+        """
+        _, bits = self._contest(name, contest_id)
+        for candidate in candidates:
+            if len(bits) == MAX_CANDIDATES:
+                raise ValueError(f"{name} has more than {MAX_CANDIDATES} candidates")
+            bits.setdefault(tuple(candidate), len(bits))
+
+    def _contest(self, name, contest_id):
+        key = (name, contest_id)
+        if key not in self.contests:
+            self.contests[key] = (self.next_contest, {})
+            self.next_contest += 1
+        return self.contests[key]
+
+    def finish(self, report_for=None):
+        """Insert the contests seen, with their candidate lists.
+
+        ``report_for`` maps a contest name to its report id (None where the
+        contest has no report).
+        """
+        self.conn.executemany(
+            """
+            INSERT INTO cvr_export_contests (id, source_id, report_id, contest_name, contest_id, candidates)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (
+                (
+                    contest,
+                    self.source_id,
+                    report_for(name) if report_for else None,
+                    name,
+                    contest_id,
+                    json.dumps([list(candidate) for candidate in bits]),
+                )
+                for (name, contest_id), (contest, bits) in self.contests.items()
+            ),
+        )
+        return len(self.contests)
+
+
+def _signed(record):
+    """Store bit 63 as SQLite's sign bit."""
+    if record[4] >= 1 << 63:
+        record[4] -= 1 << 64
+    return record
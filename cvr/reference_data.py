@@ -0,0 +1,117 @@
+"""
+Report and candidate reference data shared by the CVR importers.
+
+The exports need, for every contest, the report it belongs to and the
+spelling data.sqlite3 uses for each candidate. Rather than querying both
+per contest, the importers load the rows for their election once:
+
+Usage:
+    reference = ReferenceData.load(main_conn, "date = ?", ("2025-03-04",))
+    report_id = reference.report_id(office="mayor")
+    mapping = reference.name_mapping(report_id, ["TISHAURA O. JONES"])
+    mismatches = reference.update_votes(main_conn, [(report_id, name, votes)])
+"""
+
+import json
+
+
+def normalize_for_match(name):
+    """Normalize a candidate name for matching CVR spellings to report names.
+
+    CVR exports spell names in capitals and drop or add punctuation, so case,
+    periods and spaces are ignored.
+    """
+    return name.upper().replace(".", "").replace(" ", "")
+
+
+class ReferenceData:
+    """The ``reports`` and ``candidates`` rows of one election, indexed.
+
+    Reports are looked up by office or path, and candidate names by their
+    normalized spelling. Where several rows share a key the first one (in
+    rowid order) wins, as the per-contest queries this replaces did.
+    """
+
+    def __init__(self, reports, candidates):
+        self.reports_by_office = {}
+        self.reports_by_path = {}
+        for report_id, office, path in reports:
+            self.reports_by_office.setdefault(office, report_id)
+            self.reports_by_path.setdefault(path, report_id)
+
+        self.candidates = {}  # report_id -> names, in rowid order
+        self.names = {}  # (report_id, normalized name) -> name
+        for report_id, name in candidates:
+            self.candidates.setdefault(report_id, []).append(name)
+            self.names.setdefault((report_id, normalize_for_match(name)), name)
+
+    @classmethod
+    def load(cls, conn, where, params=()):
+        """Load the reports matching ``where`` and their candidates.
+
+        ``where`` is a fixed SQL condition on the reports table, such as
+        ``"date = ?"``; its values are bound from ``params``.
+        """
+        reports = conn.execute(
+            f"SELECT id, office, path FROM reports WHERE {where} ORDER BY id",  # nosec B608 - Fixed conditions
+            params,
+        ).fetchall()
+        candidates = conn.execute(
+            f"""
+            SELECT report_id, name FROM candidates
+            WHERE report_id IN (SELECT id FROM reports WHERE {where})
+            ORDER BY rowid
+            """,  # nosec B608 - Fixed conditions
+            params,
+        ).fetchall()
+        return cls(reports, candidates)
+
+    def report_id(self, office=None, path=None):
+        """Return the id of the report for an office or path, or None."""
+        if path is not None:
+            return self.reports_by_path.get(path)
+        return self.reports_by_office.get(office)
+
+    def name_mapping(self, report_id, cvr_names):
+        """Map each CVR name that matches one of the report's candidates."""
+        mapping = {}
+        for cvr_name in cvr_names:
+            proper_name = self.names.get((report_id, normalize_for_match(cvr_name)))
+            if proper_name is not None:
+                mapping[cvr_name] = proper_name
+        return mapping
+
+    @staticmethod
+    def update_votes(conn, votes):
+        """Set candidates' vote counts and return those that did not stick.
+
+        ``votes`` holds ``(report_id, name, votes)`` rows. The updates are
+        applied with one executemany and checked with one query, which
+        returns ``(report_id, name, expected, actual)`` for every candidate
+        row whose count differs from the last value given for it, and with
+        an ``actual`` of None for every name the report has no row for.
+        """
+        votes = list(votes)
+        conn.executemany(
+            "UPDATE candidates SET votes = ? WHERE report_id = ? AND name = ?",
+            ((count, report_id, name) for report_id, name, count in votes),
+        )
+
+        # Keyed so the last value given for a candidate is the one checked
+        expected = {(report_id, name): count for report_id, name, count in votes}
+        return conn.execute(
+            """
+            SELECT
+                json_extract(e.value, '$[0]') AS report_id,
+                json_extract(e.value, '$[1]') AS name,
+                json_extract(e.value, '$[2]') AS expected,
+                c.votes
+            FROM json_each(?) e
+            LEFT JOIN candidates c
+                ON c.report_id = json_extract(e.value, '$[0]')
+                AND c.name = json_extract(e.value, '$[1]')
+            WHERE c.rowid IS NULL OR c.votes IS NOT json_extract(e.value, '$[2]')
+            ORDER BY e.key
+            """,
+            (json.dumps([[*key, count] for key, count in expected.items()]),),
+        ).fetchall()
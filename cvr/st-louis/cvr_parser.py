@@ -6,62 +6,1056 @@ Parses XML CVR files and stores them in SQLite database with optimizations
 for processing hundreds of thousands of files.
 """
 
+import hashlib
+import json
 import logging
+import math
+import multiprocessing
+import os
+import queue
+import re
 import sqlite3
+import sys
+import tempfile
+import threading
 import time
+import uuid
 import xml.etree.ElementTree as ET  # nosec B405 - Trusted election data
+import zipfile
+from bisect import bisect_right
 from collections import defaultdict
+from contextlib import suppress
+from dataclasses import dataclass
+from functools import partial
+from itertools import islice
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import click
+from lxml import etree as LET  # nosec B410 - Trusted election data
 from tqdm import tqdm
 
+# The analysis engine is shared with the other jurisdictions in ../
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from approval_analysis import (  # noqa: E402
+    ApprovalAccumulator,
+    accumulate_contests,
+    merge_contests,
+)
+
 # Set up logging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 logger = logging.getLogger(__name__)
 
+# Compact parsed ballot, cheap to pickle between worker processes:
+# (cvr_guid, batch_sequence, sheet_number, precinct_name, precinct_id, is_blank,
+#  ((contest_name, contest_id, undervotes,
+#    ((candidate_name, candidate_id, selection_value), ...)), ...))
+Ballot = Tuple
 
-class CvrParser:
-    """High-performance CVR XML parser with SQLite storage."""
+# A CVR file on disk, or an (archive path, member name) pair inside a ZIP
+Source = Union[Path, str, Tuple[str, str]]
+
+
+@dataclass
+class IngestResult:
+    """Outcome of ingesting one directory or ZIP archive."""
+
+    source: Path
+    files: int = 0  # XML files found
+    skipped: int = 0  # unchanged since the last ingest, not read
+    parsed: int = 0  # ballots parsed and queued for insert
+    duplicates: int = 0  # GUID already ingested, skipped without parsing
+    errors: int = 0  # files that failed to parse
+    error: Optional[str] = None  # set if the source as a whole failed
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+# Files handed to each worker process per round trip
+WORKER_CHUNKSIZE = 64
+
+# Read size when hashing archives for the ingest manifest
+HASH_CHUNK_SIZE = 1 << 20
+
+# XML files planned, parsed and marked ingested at a time when streaming a
+# directory (never fewer than one batch)
+SCAN_CHUNK_SIZE = 20_000
+
+# Bytes read from the top of a CVR file to find its CvrGuid before parsing it
+GUID_PEEK_BYTES = 4096
+_GUID_PATTERN = re.compile(rb"<(?:\w+:)?CvrGuid>([\w{}-]+)</")
+
+# Indexes of stored GUIDs for skipping duplicate ballots (see ``is_duplicate``)
+GUID_FILTERS = ("set", "bloom", "off")
+BLOOM_ERROR_RATE = 0.01
+BLOOM_MIN_CAPACITY = 1_000_000
+
+CVR_NAMESPACE = "http://tempuri.org/CVRDesign.xsd"
+
+
+class _Tags:
+    """Qualified Hart Verity tag names, built once per namespace."""
+
+    def __init__(self, namespace: str = ""):
+        q = f"{{{namespace}}}" if namespace else ""
+        self.cvr_guid = f"{q}CvrGuid"
+        self.batch_sequence = f"{q}BatchSequence"
+        self.sheet_number = f"{q}SheetNumber"
+        self.is_blank = f"{q}IsBlank"
+        self.precinct_split = f"{q}PrecinctSplit"
+        self.contests = f"{q}Contests"
+        self.contest = f"{q}Contest"
+        self.options = f"{q}Options"
+        self.option = f"{q}Option"
+        self.name = f"{q}Name"
+        self.id = f"{q}Id"
+        self.undervotes = f"{q}Undervotes"
+        self.value = f"{q}Value"
+
+
+_NS_TAGS = _Tags(CVR_NAMESPACE)
+_PLAIN_TAGS = _Tags()
+
+# Streaming parser state is keyed on local names, whichever namespace a file uses
+_LOCAL_NAMES = {
+    qualified: qualified.rpartition("}")[2]
+    for tags in (_NS_TAGS, _PLAIN_TAGS)
+    for qualified in vars(tags).values()
+}
+
+_LXML_PARSER = LET.XMLParser(resolve_entities=False, no_network=True)
+
+
+def _first_children(elem) -> dict:
+    """Map each child tag to its first occurrence in a single pass."""
+    children = {}
+    for child in elem:
+        children.setdefault(child.tag, child)
+    return children
+
+
+def _ballot_from_tree(root) -> Ballot:
+    """Build a ballot tuple from a parsed ElementTree or lxml root element.
+
+    Walks each element's children once and dispatches on the precompiled
+    qualified tags; this is measurably cheaper than repeated ``find`` calls,
+    particularly for lxml whose ``find`` goes through a Python path engine.
+    """
+    t = _NS_TAGS if root.tag.startswith("{") else _PLAIN_TAGS
+
+    # Extract ballot information
+    header = _first_children(root)
+    precinct_split = _first_children(header[t.precinct_split])
+
+    # Extract contests and selections
+    contests = []
+
+    for contest_elem in header[t.contests]:
+        if contest_elem.tag != t.contest:
+            continue
+
+        fields = _first_children(contest_elem)
+        undervotes_elem = fields.get(t.undervotes)
+        undervotes = int(undervotes_elem.text) if undervotes_elem is not None else 0
+
+        # Extract options/selections
+        options_elem = fields.get(t.options)
+        selections = []
+
+        if options_elem is not None:
+            for option_elem in options_elem:
+                if option_elem.tag != t.option:
+                    continue
+                option = _first_children(option_elem)
+                selections.append(
+                    (
+                        option[t.name].text,
+                        option[t.id].text,
+                        int(option[t.value].text),
+                    )
+                )
+
+        contests.append(
+            (fields[t.name].text, fields[t.id].text, undervotes, tuple(selections))
+        )
+
+    return (
+        header[t.cvr_guid].text,
+        int(header[t.batch_sequence].text),
+        int(header[t.sheet_number].text),
+        precinct_split[t.name].text,
+        precinct_split[t.id].text,
+        header[t.is_blank].text.lower() == "true",
+        tuple(contests),
+    )
+
+
+def parse_ballot_etree(source) -> Ballot:
+    """Parse a CVR file with the standard library ElementTree."""
+    return _ballot_from_tree(
+        ET.parse(source).getroot()  # nosec B314 - Trusted election data
+    )
+
+
+def parse_ballot_lxml(source) -> Ballot:
+    """Parse a CVR file with lxml (libxml2)."""
+    return _ballot_from_tree(LET.parse(source, _LXML_PARSER).getroot())
+
+
+def parse_ballot_iterparse(source) -> Ballot:
+    """Stream a CVR file with lxml.iterparse, clearing elements as it goes.
+
+    Only the path from the root to the current element is held in memory.
+    Lookups mirror ``_ballot_from_tree``: the first matching child wins and a
+    missing required element raises.
+    """
+    header = {}
+    precinct = {}
+    contests = []
+    contest = option = None
+    path = []
+
+    for event, elem in LET.iterparse(
+        source, events=("start", "end"), resolve_entities=False, no_network=True
+    ):
+        if event == "start":
+            path.append(_LOCAL_NAMES.get(elem.tag))
+            if path[1:] == ["Contests", "Contest"] and "Contests" not in header:
+                contest = {}
+                selections = []
+            elif (
+                path[1:] == ["Contests", "Contest", "Options", "Option"]
+                and contest is not None
+                and "Options" not in contest
+            ):
+                option = {}
+            continue
+
+        tag = path.pop()
+        depth = len(path)  # depth of the parent element
+
+        if depth == 1:
+            header.setdefault(tag, elem.text)
+        elif depth == 2 and path[1] == "PrecinctSplit":
+            precinct.setdefault(tag, elem.text)
+        elif contest is not None:
+            if depth == 2:
+                contests.append(
+                    (
+                        contest["Name"],
+                        contest["Id"],
+                        int(contest["Undervotes"]) if "Undervotes" in contest else 0,
+                        tuple(selections),
+                    )
+                )
+                contest = None
+            elif depth == 3:
+                contest.setdefault(tag, elem.text)
+            elif option is not None and depth == 4:
+                selections.append((option["Name"], option["Id"], int(option["Value"])))
+                option = None
+            elif option is not None and depth == 5:
+                option.setdefault(tag, elem.text)
+
+        elem.clear()
+
+    if "Contests" not in header:
+        raise ValueError("missing Contests element")
+
+    return (
+        header["CvrGuid"],
+        int(header["BatchSequence"]),
+        int(header["SheetNumber"]),
+        precinct["Name"],
+        precinct["Id"],
+        header["IsBlank"].lower() == "true",
+        tuple(contests),
+    )
+
+
+PARSER_BACKENDS = {
+    "etree": parse_ballot_etree,
+    "lxml": parse_ballot_lxml,
+    "iterparse": parse_ballot_iterparse,
+}
+# lxml parses faster but pays for a Python proxy per element it hands back;
+# on multi-contest ballots the stdlib tree came out ahead, so it stays default.
+DEFAULT_PARSER = "etree"
+
+
+# Open archives, cached per process so workers do not reread the central directory
+_open_archives: Dict[str, zipfile.ZipFile] = {}
+
+
+def _open_archive(archive_path: str) -> zipfile.ZipFile:
+    """Return this process's open handle on an archive, opening it once."""
+    archive = _open_archives.get(archive_path)
+    if archive is None:
+        archive = _open_archives[archive_path] = zipfile.ZipFile(archive_path)
+    return archive
+
+
+def parse_source(parse: Callable[..., Ballot], source: Source) -> Ballot:
+    """Parse a CVR file on disk or stream it straight out of its ZIP archive."""
+    if isinstance(source, tuple):
+        archive_path, member = source
+        with _open_archive(archive_path).open(member) as stream:
+            return parse(stream)
+    return parse(source)
+
+
+def peek_guid(source: Source) -> Optional[str]:
+    """Read a ballot's CvrGuid from the top of its file without parsing it.
+
+    Hart Verity files put the GUID first, so only the first few KB are read
+    (or decompressed, for an archive member). Returns None when it is not
+    found there verbatim; such a file is simply parsed.
+    """
+    if isinstance(source, tuple):
+        archive_path, member = source
+        with _open_archive(archive_path).open(member) as stream:
+            head = stream.read(GUID_PEEK_BYTES)
+    else:
+        with open(source, "rb") as f:
+            head = f.read(GUID_PEEK_BYTES)
+    match = _GUID_PATTERN.search(head)
+    return match.group(1).decode("ascii") if match else None
+
+
+def close_archives() -> None:
+    """Close any archives cached by ``parse_source`` in this process."""
+    while _open_archives:
+        _open_archives.popitem()[1].close()
+
+
+def describe_source(source: Source) -> str:
+    """Human-readable location of a source for log messages."""
+    if isinstance(source, tuple):
+        return f"{source[0]}:{source[1]}"
+    return str(source)
+
+
+def scan_xml_files(directory: Path) -> Iterator[str]:
+    """Yield the XML files in a directory as ``os.scandir`` reads them.
+
+    Same files and order as ``directory.glob("*.xml")``, without building
+    the whole listing first. Paths are plain strings: turning millions of
+    them into ``Path`` objects costs more than parsing some of the files.
+    """
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith(".xml") and entry.is_file():
+                yield entry.path
+
+
+def count_xml_files(directory: Path) -> int:
+    """Count the XML files in a directory by name alone (no stat calls)."""
+    with os.scandir(directory) as entries:
+        return sum(1 for entry in entries if entry.name.endswith(".xml"))
+
+
+def hash_file(path: Path) -> str:
+    """SHA-256 of a file's contents, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _parse_worker(
+    parse: Callable[..., Ballot], source: Source
+) -> Tuple[Optional[Ballot], Optional[str]]:
+    """Worker-process entry point: return the error text instead of raising.
+
+    A ``None`` source was skipped as a duplicate and yields no ballot.
+    """
+    if source is None:
+        return None, None
+    try:
+        return parse_source(parse, source), None
+    except Exception as e:
+        return None, str(e)
+
+
+def _peek_worker(source: Source) -> Optional[str]:
+    """Worker-process entry point: read a source's GUID, or None."""
+    try:
+        return peek_guid(source)
+    except Exception:
+        return None  # reported when the file is parsed
+
+
+class GuidBloomFilter:
+    """Fixed-size Bloom filter over ballot GUIDs.
+
+    About 1.2 bytes per GUID at a 1% false-positive rate, where a Python set
+    needs closer to 100. A hit only means "probably stored", so the parser
+    confirms hits against the database; a miss is certain.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = BLOOM_ERROR_RATE):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, guid: Union[bytes, str]) -> Iterator[int]:
+        if isinstance(guid, str):
+            guid = guid.encode()
+        digest = hashlib.blake2b(guid, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, guid: Union[bytes, str]) -> None:
+        for position in self._positions(guid):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, guid: Union[bytes, str]) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(guid)
+        )
+
+
+# Files finished by all shard processes, shared with the parent for its progress bar
+_shard_progress = None
+
+
+def _init_shard(progress) -> None:
+    """Shard-process initializer: keep the shared progress counter."""
+    global _shard_progress
+    _shard_progress = progress
+
+
+def _ingest_shard(
+    shard_path: str, tasks: List[Tuple[int, Source, int]], settings: Dict
+) -> Tuple[Dict[int, Tuple[int, int, int]], Optional[Dict], int]:
+    """Shard-process entry point: ingest a slice of sources into its own database.
+
+    ``tasks`` are ``(result_index, source, source_id)`` in ingest order; the
+    ballots keep the source ids already registered in the main manifest.
+    Returns ``(parsed, errors, duplicates)`` for each result index, with the
+    shard's fused analysis and the number of ballots it covers.
+    """
+    counts = {}
+    with CvrParser(shard_path, bulk_load=True, snapshots=False, **settings) as parser:
+        parser.load_guid_index()
+        sources = [source for _, source, _ in tasks]
+        source_ids = {_source_key(source): source_id for _, source, source_id in tasks}
+        errors = duplicates = 0
+        for (index, _, source_id), ballot in zip(
+            tasks, parser.iter_ballots(sources, source_ids), strict=True
+        ):
+            if ballot:
+                parser.add_to_batch(ballot, source_id)
+                parser.processed += 1
+                if len(parser.ballot_batch) >= parser.batch_size:
+                    parser.flush_batch()
+
+            parsed, failed, skipped = counts.get(index, (0, 0, 0))
+            counts[index] = (
+                parsed + (ballot is not None),
+                failed + parser.errors - errors,
+                skipped + parser.duplicates - duplicates,
+            )
+            errors, duplicates = parser.errors, parser.duplicates
+            with _shard_progress.get_lock():
+                _shard_progress.value += 1
+
+        parser.flush_batch()
+        parser.drain()
+    return counts, parser.analysis, parser.analyzed_ballots
+
+
+def _next_rowid(conn: sqlite3.Connection, table: str) -> int:
+    """Return the first unused INTEGER PRIMARY KEY of ``table``."""
+    query = f"SELECT COALESCE(MAX(id), 0) + 1 FROM {table}"  # nosec B608 - Fixed table names
+    return conn.execute(query).fetchone()[0]
+
+
+def _source_key(source: Source) -> str:
+    """Manifest path a source belongs to: the file itself, or its archive."""
+    return source[0] if isinstance(source, tuple) else str(source)
+
+
+def _pack_guid(cvr_guid: str) -> Union[bytes, str]:
+    """Store a canonical GUID as its 16 bytes; anything else stays as text."""
+    try:
+        packed = uuid.UUID(cvr_guid)
+    except ValueError:
+        return cvr_guid
+    return packed.bytes if str(packed) == cvr_guid else cvr_guid
+
+
+# Source files and archives already ingested. content_hash stays NULL until
+# every ballot from the source is committed; meanwhile checkpoint counts the
+# archive members whose ballots are, updated in the same transaction.
+MANIFEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ingest_manifest (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    content_hash TEXT,
+    ingested_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    checkpoint INTEGER
+);
+
+-- Sources holding a ballot whose GUID was already stored, so their copy was
+-- dropped. If the stored copy is retracted, the ballot is read back from
+-- one of these (see ``restore_duplicates``). Rows go with their source.
+CREATE TABLE IF NOT EXISTS ingest_duplicates (
+    cvr_guid NOT NULL,
+    source_id INTEGER NOT NULL REFERENCES ingest_manifest(id),
+    PRIMARY KEY (cvr_guid, source_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_ingest_duplicates_source ON ingest_duplicates(source_id);
+"""
+
+# Mergeable co-approval state, so the analysis is refreshed without reading
+# the ballots back. Each write batch stores how many ballots of each contest
+# approved each combination of candidates (a JSON list of names), keyed by
+# the batch's first ballot id; analysis_batches counts the ballots a batch
+# covers. Retracting ballots subtracts them from their batch, and a batch
+# that is entirely superseded disappears.
+SNAPSHOT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS analysis_batches (
+    id INTEGER PRIMARY KEY,
+    ballots INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS analysis_snapshots (
+    id INTEGER PRIMARY KEY,
+    batch_id INTEGER NOT NULL REFERENCES analysis_batches(id),
+    contest_name TEXT NOT NULL,
+    combination TEXT NOT NULL,
+    ballots INTEGER NOT NULL,
+    UNIQUE (batch_id, contest_name, combination)
+);
+"""
+
+# Approved selections grouped by contest record (one ballot in one contest),
+# through the legacy names so it works in both layouts
+APPROVALS_QUERY = """
+SELECT c.ballot_id, c.contest_name, s.contest_record_id, s.candidate_name
+FROM cvr_contests c
+JOIN cvr_selections s ON s.contest_record_id = c.id
+WHERE s.selection_value = 1 AND {where}
+ORDER BY s.contest_record_id
+"""
+
+# Tables holding ballots, contests and selections in each database layout.
+# The compact layout keeps the legacy names as views over its own tables.
+LEGACY_TABLES = ("cvr_ballots", "cvr_contests", "cvr_selections")
+COMPACT_TABLES = ("cvr_ballot_rows", "cvr_contest_rows", "cvr_selection_rows")
+
+# Dictionary-encoded layout: names and ids live once in the *_dict tables and
+# the row tables hold integer keys. GUIDs are 16-byte blobs (text if not a
+# canonical UUID), timestamps are epoch seconds, and selections are clustered
+# by contest record in a WITHOUT ROWID table. The (contest, ballot_id) index
+# covers the analysis lookup of a contest's ballots in ballot order.
+COMPACT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cvr_precinct_dict (
+    id INTEGER PRIMARY KEY,
+    precinct_name TEXT,
+    precinct_id TEXT,
+    UNIQUE(precinct_name, precinct_id)
+);
+
+CREATE TABLE IF NOT EXISTS cvr_contest_dict (
+    id INTEGER PRIMARY KEY,
+    contest_name TEXT NOT NULL,
+    contest_id TEXT NOT NULL,
+    UNIQUE(contest_name, contest_id)
+);
+
+CREATE TABLE IF NOT EXISTS cvr_candidate_dict (
+    id INTEGER PRIMARY KEY,
+    candidate_name TEXT NOT NULL,
+    candidate_id TEXT NOT NULL,
+    UNIQUE(candidate_name, candidate_id)
+);
+
+CREATE TABLE IF NOT EXISTS cvr_ballot_rows (
+    id INTEGER PRIMARY KEY,
+    cvr_guid BLOB UNIQUE NOT NULL,
+    batch_sequence INTEGER,
+    sheet_number INTEGER,
+    precinct INTEGER REFERENCES cvr_precinct_dict(id),
+    is_blank BOOLEAN,
+    created_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+    source_id INTEGER REFERENCES ingest_manifest(id)
+);
+
+CREATE TABLE IF NOT EXISTS cvr_contest_rows (
+    id INTEGER PRIMARY KEY,
+    ballot_id INTEGER REFERENCES cvr_ballot_rows(id),
+    contest INTEGER NOT NULL REFERENCES cvr_contest_dict(id),
+    undervotes INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS cvr_selection_rows (
+    contest_record_id INTEGER NOT NULL REFERENCES cvr_contest_rows(id),
+    seq INTEGER NOT NULL,
+    candidate INTEGER NOT NULL REFERENCES cvr_candidate_dict(id),
+    selection_value INTEGER,
+    PRIMARY KEY (contest_record_id, seq)
+) WITHOUT ROWID;
+
+-- Views with the legacy table names and columns, so existing queries work
+CREATE VIEW IF NOT EXISTS cvr_ballots AS
+SELECT
+    b.id,
+    CASE WHEN typeof(b.cvr_guid) = 'blob' THEN lower(
+        substr(hex(b.cvr_guid), 1, 8) || '-' || substr(hex(b.cvr_guid), 9, 4) || '-' ||
+        substr(hex(b.cvr_guid), 13, 4) || '-' || substr(hex(b.cvr_guid), 17, 4) || '-' ||
+        substr(hex(b.cvr_guid), 21)
+    ) ELSE b.cvr_guid END AS cvr_guid,
+    b.batch_sequence,
+    b.sheet_number,
+    p.precinct_name,
+    p.precinct_id,
+    b.is_blank,
+    datetime(b.created_at, 'unixepoch') AS created_at,
+    b.source_id
+FROM cvr_ballot_rows b
+JOIN cvr_precinct_dict p ON p.id = b.precinct;
+
+CREATE VIEW IF NOT EXISTS cvr_contests AS
+SELECT c.id, c.ballot_id, d.contest_name, d.contest_id, c.undervotes
+FROM cvr_contest_rows c
+JOIN cvr_contest_dict d ON d.id = c.contest;
+
+CREATE VIEW IF NOT EXISTS cvr_selections AS
+SELECT
+    s.contest_record_id * 65536 + s.seq AS id,
+    s.contest_record_id,
+    d.candidate_name,
+    d.candidate_id,
+    s.selection_value
+FROM cvr_selection_rows s
+JOIN cvr_candidate_dict d ON d.id = s.candidate;
+"""
 
-    def __init__(self, db_path: str, batch_size: int = 5000):
+# Secondary indexes of each layout (cvr_guid is already indexed by its
+# UNIQUE constraint). A bulk load creates them once the rows are in.
+LEGACY_INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_precinct ON cvr_ballots(precinct_id);
+CREATE INDEX IF NOT EXISTS idx_contest ON cvr_contests(contest_id);
+CREATE INDEX IF NOT EXISTS idx_ballot_contest ON cvr_contests(ballot_id, contest_id);
+CREATE INDEX IF NOT EXISTS idx_candidate ON cvr_selections(candidate_id);
+CREATE INDEX IF NOT EXISTS idx_contest_selection ON cvr_selections(contest_record_id, candidate_id);
+CREATE INDEX IF NOT EXISTS idx_ballot_source ON cvr_ballots(source_id);
+"""
+
+COMPACT_INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_ballot_rows_source ON cvr_ballot_rows(source_id);
+CREATE INDEX IF NOT EXISTS idx_contest_rows_contest ON cvr_contest_rows(contest, ballot_id);
+"""
+
+# Page size for a bulk-loaded database; it is fixed once the first table exists
+BULK_PAGE_SIZE = 65536
+
+# Dictionary tables and the fields of a parsed ballot they encode
+DICT_TABLES = {
+    "cvr_precinct_dict": ("precinct_name", "precinct_id"),
+    "cvr_contest_dict": ("contest_name", "contest_id"),
+    "cvr_candidate_dict": ("candidate_name", "candidate_id"),
+}
+
+
+def _record_checkpoint(
+    conn: sqlite3.Connection,
+    completed: Iterable[Tuple[int, str]],
+    positions: Iterable[Tuple[int, int]] = (),
+) -> None:
+    """Mark sources ingested and move archive checkpoints forward.
+
+    ``completed`` holds ``(source_id, content_hash)`` pairs and
+    ``positions`` ``(source_id, members_committed)`` pairs.
+    """
+    conn.executemany(
+        "UPDATE ingest_manifest SET checkpoint = ? WHERE id = ?",
+        ((position, source_id) for source_id, position in positions),
+    )
+    conn.executemany(
+        "UPDATE ingest_manifest SET content_hash = ?, checkpoint = NULL, ingested_at = CURRENT_TIMESTAMP WHERE id = ?",
+        ((content_hash, source_id) for source_id, content_hash in completed),
+    )
+
+
+def _retract_sources(
+    conn: sqlite3.Connection,
+    source_ids: List[int],
+    tables: Tuple[str, str, str] = LEGACY_TABLES,
+) -> List[Union[bytes, str]]:
+    """Delete every ballot, contest and selection ingested from the given sources.
+
+    Their duplicate records go too. Returns the GUIDs of the deleted ballots;
+    any that another source also holds are restored by the next ingest.
+    """
+    if not source_ids:
+        return []
+    ballots, contests, selections = tables
+
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS retract_ids (id INTEGER PRIMARY KEY)")
+    conn.execute("DELETE FROM retract_ids")
+    conn.executemany(
+        "INSERT INTO retract_ids (id) VALUES (?)", ((i,) for i in source_ids)
+    )
+    _retract_snapshots(conn, ballots)
+    conn.execute(
+        "DELETE FROM ingest_duplicates WHERE source_id IN (SELECT id FROM retract_ids)"
+    )
+    conn.execute(
+        f"""
+        DELETE FROM {selections} WHERE contest_record_id IN (
+            SELECT c.id FROM {contests} c
+            JOIN {ballots} b ON b.id = c.ballot_id
+            WHERE b.source_id IN (SELECT id FROM retract_ids)
+        )
+        """  # nosec B608 - Fixed table names
+    )
+    conn.execute(
+        f"""
+        DELETE FROM {contests} WHERE ballot_id IN (
+            SELECT id FROM {ballots} WHERE source_id IN (SELECT id FROM retract_ids)
+        )
+        """  # nosec B608 - Fixed table names
+    )
+    guids = [
+        row[0]
+        for row in conn.execute(
+            f"DELETE FROM {ballots} WHERE source_id IN (SELECT id FROM retract_ids) RETURNING cvr_guid"  # nosec B608 - Fixed table names
+        )
+    ]
+    logger.info(
+        f"Retracted {len(guids):,} ballots from {len(source_ids):,} changed or removed sources"
+    )
+    return guids
+
+
+def _record_duplicates(
+    conn: sqlite3.Connection, duplicates: Iterable[Tuple[Union[bytes, str], int]]
+) -> None:
+    """Record ``(cvr_guid, source_id)`` copies dropped because the GUID was stored."""
+    conn.executemany(
+        "INSERT OR IGNORE INTO ingest_duplicates (cvr_guid, source_id) VALUES (?, ?)",
+        (
+            (cvr_guid, source_id)
+            for cvr_guid, source_id in duplicates
+            if source_id is not None
+        ),
+    )
+
+
+def _store_snapshot(
+    conn: sqlite3.Connection, batch_id: int, accumulators: Dict, ballots: int
+) -> None:
+    """Store one batch's per-contest accumulators as snapshot rows."""
+    conn.execute(
+        "INSERT INTO analysis_batches (id, ballots) VALUES (?, ?)", (batch_id, ballots)
+    )
+    conn.executemany(
+        "INSERT INTO analysis_snapshots (batch_id, contest_name, combination, ballots) VALUES (?, ?, ?, ?)",
+        (
+            (batch_id, contest_name, json.dumps(names), count)
+            for contest_name, accumulator in accumulators.items()
+            for names, count in accumulator.combinations()
+        ),
+    )
+
+
+def _snapshot_ballots(
+    conn: sqlite3.Connection, ballots_table: str, first_ballot_id: int
+) -> None:
+    """Snapshot every ballot from ``first_ballot_id`` on as a single batch."""
+    count, batch_id = conn.execute(
+        f"SELECT COUNT(*), MIN(id) FROM {ballots_table} WHERE id >= ?",  # nosec B608 - Fixed table names
+        (first_ballot_id,),
+    ).fetchone()
+    if not count:
+        return
+    rows = conn.execute(
+        APPROVALS_QUERY.format(where="c.ballot_id >= ?"), (first_ballot_id,)
+    )
+    accumulators = accumulate_contests(
+        (contest_name, record_id, name) for _, contest_name, record_id, name in rows
+    )
+    _store_snapshot(conn, batch_id, accumulators, count)
+
+
+def _retract_snapshots(conn: sqlite3.Connection, ballots_table: str) -> None:
+    """Subtract the ballots of the sources in ``retract_ids`` from their snapshots.
+
+    Ballot ids are allocated in commit order, so a ballot belongs to the
+    batch with the greatest id not above its own.
+    """
+    batch_ids = [
+        row[0] for row in conn.execute("SELECT id FROM analysis_batches ORDER BY id")
+    ]
+    if not batch_ids:
+        return
+
+    def batch_of(ballot_id):
+        index = bisect_right(batch_ids, ballot_id) - 1
+        return batch_ids[index] if index >= 0 else None
+
+    retracted = f"SELECT id FROM {ballots_table} WHERE source_id IN (SELECT id FROM retract_ids)"  # nosec B608 - Fixed table names
+    covered = defaultdict(int)
+    for (ballot_id,) in conn.execute(retracted):
+        covered[batch_of(ballot_id)] += 1
+
+    rows = conn.execute(
+        APPROVALS_QUERY.format(
+            where=f"c.ballot_id IN ({retracted})"
+        )  # nosec B608 - Fixed table names
+    )
+    accumulators = accumulate_contests(
+        ((batch_of(ballot_id), contest_name), record_id, name)
+        for ballot_id, contest_name, record_id, name in rows
+    )
+    conn.executemany(
+        "UPDATE analysis_snapshots SET ballots = ballots - ? WHERE batch_id = ? AND contest_name = ? AND combination = ?",
+        (
+            (count, batch_id, contest_name, json.dumps(names))
+            for (batch_id, contest_name), accumulator in accumulators.items()
+            for names, count in accumulator.combinations()
+        ),
+    )
+    conn.executemany(
+        "UPDATE analysis_batches SET ballots = ballots - ? WHERE id = ?",
+        ((count, batch_id) for batch_id, count in covered.items()),
+    )
+    conn.execute("DELETE FROM analysis_snapshots WHERE ballots <= 0")
+    conn.execute("DELETE FROM analysis_batches WHERE ballots <= 0")
+
+
+def load_snapshots(conn: sqlite3.Connection) -> Optional[Dict]:
+    """Merge the stored snapshots into ``{contest name: ApprovalAccumulator}``.
+
+    Returns None unless the snapshots cover every ballot in the database
+    (see ``CvrParser.build_snapshots``). Contests and combinations keep the
+    order in which they were first stored.
+    """
+    compact = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'cvr_ballot_rows'"
+    ).fetchone()
+    ballots_table = COMPACT_TABLES[0] if compact else LEGACY_TABLES[0]
+    try:
+        (covered,) = conn.execute(
+            "SELECT COALESCE(SUM(ballots), 0) FROM analysis_batches"
+        ).fetchone()
+    except sqlite3.OperationalError:  # written before snapshots existed
+        return None
+    (stored,) = conn.execute(
+        f"SELECT COUNT(*) FROM {ballots_table}"  # nosec B608 - Fixed table names
+    ).fetchone()
+    if covered != stored:
+        return None
+
+    accumulators = {}
+    for contest_name, combination, count in conn.execute(
+        """
+        SELECT contest_name, combination, SUM(ballots)
+        FROM analysis_snapshots
+        GROUP BY contest_name, combination
+        ORDER BY MIN(id)
+        """
+    ):
+        accumulator = accumulators.get(contest_name)
+        if accumulator is None:
+            accumulator = accumulators[contest_name] = ApprovalAccumulator()
+        accumulator.add(json.loads(combination), count)
+    return accumulators
+
+
+class CvrParser:
+    """High-performance CVR XML parser with SQLite storage.
+
+    The parser holds one writer connection for its lifetime; use it as a
+    context manager (or call ``close``) to release it::
+
+        with CvrParser("cvr-data.sqlite3") as parser:
+            parser.ingest([Path("data")])
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        batch_size: int = 5000,
+        workers: int = 1,
+        parser: str = DEFAULT_PARSER,
+        compact: bool = False,
+        bulk_load: bool = False,
+        pipeline_depth: int = 0,
+        guid_filter: str = "set",
+        shards: int = 1,
+        analyze: bool = False,
+        snapshots: bool = True,
+    ):
         self.db_path = Path(db_path)
         self.batch_size = batch_size
+        self.workers = max(1, workers)
+        self.shards = max(1, shards)
+        self.parser_name = parser
+        self.parse = PARSER_BACKENDS[parser]
+        self.pipeline_depth = pipeline_depth
+        self.compact = compact
+        self.bulk_load = bulk_load
+        self.index_time = None
         self.processed = 0
         self.errors = 0
+        self.duplicates = 0
         self.start_time = time.time()
 
+        # GUIDs stored or batched so far, loaded on the first ingest
+        self.guid_filter = guid_filter
+        self.guid_index = None
+
+        # Manifest id and content hash of sources still being ingested
+        self.pending_sources = {}
+
+        # Checkpoint state: pending files read since the last flush, and
+        # members of each pending archive read so far
+        self.finished_sources = set()
+        self.archive_positions = {}
+
+        # Fused analysis: contest name -> ApprovalAccumulator, fed with the
+        # approvals of every committed batch, and how many ballots it covers
+        self.analysis = {} if analyze else None
+        self.analyzed_ballots = 0
+
+        # Whether each write batch also stores its analysis snapshot
+        self.snapshots = snapshots
+
+        # Compact layout: dictionary table -> {(name, id): row id}
+        self.dict_ids = {table: {} for table in DICT_TABLES}
+
         # Batch storage for bulk inserts
         self.ballot_batch = []
         self.contest_batch = []
         self.selection_batch = []
+        self.duplicate_batch = []  # (cvr_guid, source_id) skipped by the peek
 
-        # Statistics tracking
+        # Statistics tracking (keyed by name, so bounded by the number of
+        # distinct precincts and contests rather than by ballots)
         self.stats = {
             "precincts": defaultdict(int),
             "contests": defaultdict(int),
-            "candidates": defaultdict(int),
         }
 
-        self.setup_database()
+        self.conn = None
+        self.pool = None  # parser processes, started on first use
+        self.setup_database(check_same_thread=not pipeline_depth)
+
+        # Pipelined mode: a bounded queue of batches drained by a writer thread
+        self.write_queue = None
+        self.write_error = None
+        self.writer = None
+        self.pipeline_stats = {
+            "batches": 0,
+            "depth_total": 0,
+            "depth_max": 0,
+            "put_wait": 0.0,
+            "get_wait": 0.0,
+            "write_time": 0.0,
+        }
+        if pipeline_depth:
+            self.write_queue = queue.Queue(maxsize=pipeline_depth)
+            self.writer = threading.Thread(
+                target=self._write_loop, name="cvr-writer", daemon=True
+            )
+            self.writer.start()
+
+    def __enter__(self) -> "CvrParser":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Close the writer connection.
 
-    def setup_database(self) -> None:
-        """Initialize database with optimized settings and schema."""
+        Batches already queued for the writer thread are committed first;
+        ballots not yet flushed are not.
+        """
+        if self.writer is not None:
+            self.write_queue.put(None)
+            self.writer.join()
+            self.writer = None
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def setup_database(self, check_same_thread: bool = True) -> None:
+        """Initialize database with optimized settings and schema.
+
+        Opens the writer connection that every later read and write goes
+        through, so the PRAGMAs below are applied once and the flush
+        statements stay compiled in its statement cache. In bulk-load mode a fresh database gets a larger page size
+        and its secondary indexes are left out until ``build_indexes``.
+        """
         logger.info(f"Setting up database: {self.db_path}")
 
-        conn = sqlite3.connect(self.db_path)
+        # A pipelined parser hands the connection to its writer thread; the
+        # two threads never use it at the same time (see ``drain``)
+        conn = self.conn = sqlite3.connect(
+            self.db_path, check_same_thread=check_same_thread
+        )
+
+        # An existing database keeps the layout it was created with
+        existing = conn.execute(
+            "SELECT type FROM sqlite_master WHERE name = 'cvr_ballots'"
+        ).fetchone()
+        if existing and (existing[0] == "view") != self.compact:
+            layout = "compact" if existing[0] == "view" else "legacy"
+            logger.warning(
+                f"{self.db_path} already uses the {layout} layout; keeping it (rebuild the database to switch)"
+            )
+            self.compact = existing[0] == "view"
+
+        if existing and self.bulk_load:
+            logger.warning(
+                f"{self.db_path} already exists; bulk-load mode only applies to a fresh database"
+            )
+            self.bulk_load = False
+        elif self.bulk_load:
+            conn.execute(f"PRAGMA page_size = {BULK_PAGE_SIZE}")
+
         conn.execute("PRAGMA journal_mode = WAL")
-        conn.execute("PRAGMA synchronous = NORMAL")
         conn.execute("PRAGMA cache_size = -64000")  # 64MB cache
         conn.execute("PRAGMA temp_store = memory")
         conn.execute("PRAGMA mmap_size = 268435456")  # 256MB mmap
+        self._set_durability()
+
+        self.indexes = COMPACT_INDEXES if self.compact else LEGACY_INDEXES
+
+        if self.compact:
+            self.tables = COMPACT_TABLES
+            self._setup_compact_schema(conn)
+            self._migrate_manifest(conn)
+            conn.commit()
+            return
+
+        self.tables = LEGACY_TABLES
 
         # Create tables
         conn.executescript(
-            """
+            MANIFEST_SCHEMA
+            + SNAPSHOT_SCHEMA
+            + """
         CREATE TABLE IF NOT EXISTS cvr_ballots (
             id INTEGER PRIMARY KEY,
             cvr_guid TEXT UNIQUE NOT NULL,
@@ -70,7 +1064,8 @@ class CvrParser:
             precinct_name TEXT,
             precinct_id TEXT,
             is_blank BOOLEAN,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            source_id INTEGER REFERENCES ingest_manifest(id)
         );
         
         CREATE TABLE IF NOT EXISTS cvr_contests (
@@ -90,302 +1085,1416 @@ class CvrParser:
             selection_value INTEGER,
             FOREIGN KEY(contest_record_id) REFERENCES cvr_contests(id)
         );
-        
-        -- Create indexes for better query performance
-        CREATE INDEX IF NOT EXISTS idx_cvr_guid ON cvr_ballots(cvr_guid);
-        CREATE INDEX IF NOT EXISTS idx_precinct ON cvr_ballots(precinct_id);
-        CREATE INDEX IF NOT EXISTS idx_contest ON cvr_contests(contest_id);
-        CREATE INDEX IF NOT EXISTS idx_ballot_contest ON cvr_contests(ballot_id, contest_id);
-        CREATE INDEX IF NOT EXISTS idx_candidate ON cvr_selections(candidate_id);
-        CREATE INDEX IF NOT EXISTS idx_contest_selection ON cvr_selections(contest_record_id, candidate_id);
         """
         )
 
-        conn.commit()
-        conn.close()
-
-    def parse_xml_file(self, file_path: Path) -> Optional[Dict[str, Any]]:
-        """Parse a single CVR XML file and return structured data."""
+        # Add source_id column if it doesn't exist (migration for existing databases)
         try:
-            tree = ET.parse(file_path)  # nosec B314 - Trusted election data
-            root = tree.getroot()
-
-            # Handle namespace
-            ns = (
-                {"cvr": "http://tempuri.org/CVRDesign.xsd"}
-                if root.tag.startswith("{")
-                else {}
+            conn.execute(
+                "ALTER TABLE cvr_ballots ADD COLUMN source_id INTEGER REFERENCES ingest_manifest(id)"
             )
+            logger.info("✓ Added source_id column to existing cvr_ballots table")
+        except sqlite3.OperationalError as e:
+            if "duplicate column name" not in str(e):
+                raise
+        self._migrate_manifest(conn)
 
-            def find_with_ns(element, tag):
-                """Find element with or without namespace."""
-                if ns:
-                    return element.find(f"cvr:{tag}", ns)
-                else:
-                    return element.find(tag)
+        # Create indexes for better query performance
+        conn.execute("DROP INDEX IF EXISTS idx_cvr_guid")
+        if not self.bulk_load:
+            conn.executescript(LEGACY_INDEXES)
 
-            def findall_with_ns(element, tag):
-                """Find all elements with or without namespace."""
-                if ns:
-                    return element.findall(f"cvr:{tag}", ns)
-                else:
-                    return element.findall(tag)
-
-            # Extract ballot information
-            cvr_guid = find_with_ns(root, "CvrGuid").text
-            batch_sequence = int(find_with_ns(root, "BatchSequence").text)
-            sheet_number = int(find_with_ns(root, "SheetNumber").text)
-            is_blank = find_with_ns(root, "IsBlank").text.lower() == "true"
-
-            precinct_split = find_with_ns(root, "PrecinctSplit")
-            precinct_name = find_with_ns(precinct_split, "Name").text
-            precinct_id = find_with_ns(precinct_split, "Id").text
-
-            # Extract contests and selections
-            contests_elem = find_with_ns(root, "Contests")
-            contests = []
-
-            for contest_elem in findall_with_ns(contests_elem, "Contest"):
-                contest_name = find_with_ns(contest_elem, "Name").text
-                contest_id = find_with_ns(contest_elem, "Id").text
-                undervotes_elem = find_with_ns(contest_elem, "Undervotes")
-                undervotes = (
-                    int(undervotes_elem.text) if undervotes_elem is not None else 0
-                )
-
-                # Extract options/selections
-                options_elem = find_with_ns(contest_elem, "Options")
-                selections = []
-
-                if options_elem is not None:
-                    for option_elem in findall_with_ns(options_elem, "Option"):
-                        candidate_name = find_with_ns(option_elem, "Name").text
-                        candidate_id = find_with_ns(option_elem, "Id").text
-                        selection_value = int(find_with_ns(option_elem, "Value").text)
+        conn.commit()
 
-                        selections.append(
-                            {
-                                "candidate_name": candidate_name,
-                                "candidate_id": candidate_id,
-                                "selection_value": selection_value,
-                            }
-                        )
+    def _migrate_manifest(self, conn: sqlite3.Connection) -> None:
+        """Add the checkpoint column to a manifest created before it existed."""
+        try:
+            conn.execute("ALTER TABLE ingest_manifest ADD COLUMN checkpoint INTEGER")
+            logger.info("✓ Added checkpoint column to existing ingest_manifest table")
+        except sqlite3.OperationalError as e:
+            if "duplicate column name" not in str(e):
+                raise
+
+    def _setup_compact_schema(self, conn: sqlite3.Connection) -> None:
+        """Create the dictionary-encoded layout and load its dictionaries."""
+        conn.executescript(MANIFEST_SCHEMA + SNAPSHOT_SCHEMA + COMPACT_SCHEMA)
+        if not self.bulk_load:
+            conn.executescript(COMPACT_INDEXES)
+        self._load_dictionaries(conn)
+
+    def _load_dictionaries(self, conn: sqlite3.Connection) -> None:
+        """Read the compact layout's dictionary tables into ``dict_ids``."""
+        for table, (name_column, id_column) in DICT_TABLES.items():
+            query = f"SELECT id, {name_column}, {id_column} FROM {table}"  # nosec B608 - Fixed table names
+            self.dict_ids[table] = {
+                (name, key): row_id for row_id, name, key in conn.execute(query)
+            }
 
-                contests.append(
-                    {
-                        "contest_name": contest_name,
-                        "contest_id": contest_id,
-                        "undervotes": undervotes,
-                        "selections": selections,
-                    }
-                )
+    def _set_durability(self) -> None:
+        """Apply the sync and locking settings for the current load mode.
 
-            return {
-                "cvr_guid": cvr_guid,
-                "batch_sequence": batch_sequence,
-                "sheet_number": sheet_number,
-                "precinct_name": precinct_name,
-                "precinct_id": precinct_id,
-                "is_blank": is_blank,
-                "contests": contests,
-            }
+        A bulk load trades durability for speed: commits are not synced, and
+        the database stays locked against other connections until the load
+        finishes. WAL still keeps a crash from corrupting the file.
+        """
+        if self.bulk_load:
+            self.conn.execute("PRAGMA synchronous = OFF")
+            self.conn.execute("PRAGMA locking_mode = EXCLUSIVE")
+        else:
+            self.conn.execute("PRAGMA synchronous = NORMAL")
+            self.conn.execute("PRAGMA locking_mode = NORMAL")
+
+    def build_indexes(self) -> None:
+        """Create the indexes deferred by a bulk load, then ANALYZE once."""
+        if not self.bulk_load:
+            return
 
+        self.drain()
+        logger.info("Building indexes...")
+        start = time.time()
+        self.conn.executescript(self.indexes + "ANALYZE;")
+        self.bulk_load = False
+        self._set_durability()
+        self.index_time = time.time() - start
+        logger.info(f"✓ Built indexes in {self.index_time:.2f} seconds")
+
+    def _dict_id(self, table: str, key: Tuple[str, str], new_rows: Dict) -> int:
+        """Return the dictionary id for ``key``, queueing a row if it is new."""
+        ids = self.dict_ids[table]
+        row_id = ids.get(key)
+        if row_id is None:
+            row_id = ids[key] = len(ids) + 1
+            new_rows[table].append((row_id,) + key)
+        return row_id
+
+    def parse_xml_file(self, file_path: Source) -> Optional[Ballot]:
+        """Parse a single CVR XML file, counting and logging any failure."""
+        try:
+            return parse_source(self.parse, file_path)
         except Exception as e:
             self.errors += 1
-            logger.error(f"Error parsing {file_path}: {e}")
+            logger.error(f"Error parsing {describe_source(file_path)}: {e}")
             return None
 
-    def add_to_batch(self, ballot_data: Dict[str, Any]) -> None:
-        """Add parsed ballot data to batch for bulk insert."""
-        # Add ballot record
+    def add_to_batch(self, ballot: Ballot, source_id: Optional[int] = None) -> None:
+        """Add a parsed ballot to the batch for bulk insert.
+
+        ``source_id`` is the ``ingest_manifest`` entry the ballot came from,
+        which is what lets it be retracted when that source changes.
+        """
+        (
+            cvr_guid,
+            batch_sequence,
+            sheet_number,
+            precinct_name,
+            precinct_id,
+            is_blank,
+            contests,
+        ) = ballot
+
+        # Add ballot record (the compact layout compares GUIDs as bytes)
+        if self.compact:
+            cvr_guid = _pack_guid(cvr_guid)
+        if self.guid_index is not None:
+            self.guid_index.add(cvr_guid)
         ballot_record = (
-            ballot_data["cvr_guid"],
-            ballot_data["batch_sequence"],
-            ballot_data["sheet_number"],
-            ballot_data["precinct_name"],
-            ballot_data["precinct_id"],
-            ballot_data["is_blank"],
+            cvr_guid,
+            batch_sequence,
+            sheet_number,
+            precinct_name,
+            precinct_id,
+            is_blank,
+            source_id,
         )
         self.ballot_batch.append(ballot_record)
 
         # Track statistics
-        self.stats["precincts"][ballot_data["precinct_name"]] += 1
+        self.stats["precincts"][precinct_name] += 1
 
         # Add contests and selections (we'll handle relationships after ballot insert)
         ballot_index = len(self.ballot_batch) - 1
 
-        for contest in ballot_data["contests"]:
-            self.stats["contests"][contest["contest_name"]] += 1
+        for contest_name, contest_id, undervotes, selections in contests:
+            self.stats["contests"][contest_name] += 1
 
             contest_record = (
                 ballot_index,  # Will be replaced with actual ballot_id after insert
-                contest["contest_name"],
-                contest["contest_id"],
-                contest["undervotes"],
+                contest_name,
+                contest_id,
+                undervotes,
             )
             contest_index = len(self.contest_batch)
             self.contest_batch.append(contest_record)
 
-            for selection in contest["selections"]:
-                self.stats["candidates"][selection["candidate_name"]] += 1
-
+            for candidate_name, candidate_id, selection_value in selections:
                 selection_record = (
                     contest_index,  # Will be replaced with actual contest_record_id
-                    selection["candidate_name"],
-                    selection["candidate_id"],
-                    selection["selection_value"],
+                    candidate_name,
+                    candidate_id,
+                    selection_value,
                 )
                 self.selection_batch.append(selection_record)
 
     def flush_batch(self) -> None:
-        """Write current batch to database."""
-        if not self.ballot_batch:
+        """Write the current batch, or queue it for the writer thread.
+
+        The batch carries a checkpoint of the sources read so far, which is
+        committed in the same transaction as its ballots (see
+        ``mark_source_read``). With a pipeline the call only blocks while the
+        queue is full, which is what bounds memory when the writer falls
+        behind. A failure in an earlier queued batch is raised here.
+        """
+        if not self.ballot_batch and not self.duplicate_batch:
             return
 
-        conn = sqlite3.connect(self.db_path)
-        conn.execute("BEGIN TRANSACTION")
+        completed = [
+            self.pending_sources[path]
+            for path in self.finished_sources
+            if path in self.pending_sources
+        ]
+        done = {source_id for source_id, _ in completed}
+        positions = [
+            (source_id, position)
+            for source_id, position in self.archive_positions.items()
+            if source_id not in done
+        ]
+        batch = (
+            self.ballot_batch,
+            self.contest_batch,
+            self.selection_batch,
+            (completed, positions),
+            self.duplicate_batch,
+        )
+        if self.write_queue is None:
+            self.ballot_batch, self.contest_batch, self.selection_batch = [], [], []
+            self.duplicate_batch = []
+            self.write_batch(*batch)
+            self._checkpoint_flushed()
+            return
 
-        try:
-            # Insert ballots and track which ones were actually inserted
-            cursor = conn.executemany(
-                "INSERT OR IGNORE INTO cvr_ballots (cvr_guid, batch_sequence, sheet_number, precinct_name, precinct_id, is_blank) VALUES (?, ?, ?, ?, ?, ?)",
-                self.ballot_batch,
+        if self.write_error is not None:
+            self.drain()
+
+        stats = self.pipeline_stats
+        start = time.perf_counter()
+        self.write_queue.put(batch)
+        stats["put_wait"] += time.perf_counter() - start
+        # Only start new lists once the batch is queued, so an interrupted
+        # put leaves it here for the final flush
+        self.ballot_batch, self.contest_batch, self.selection_batch = [], [], []
+        self.duplicate_batch = []
+        self._checkpoint_flushed()
+
+        depth = self.write_queue.qsize()
+        stats["batches"] += 1
+        stats["depth_total"] += depth
+        stats["depth_max"] = max(stats["depth_max"], depth)
+
+    def mark_source_read(self, source: Source) -> None:
+        """Record that every ballot of ``source`` is batched (or it had none).
+
+        A file then completes with the next flush; an archive's checkpoint
+        moves on by one member. Call before the flush that may follow.
+        """
+        if isinstance(source, tuple):
+            source_id = self.pending_sources[source[0]][0]
+            self.archive_positions[source_id] = (
+                self.archive_positions.get(source_id, 0) + 1
             )
+        else:
+            self.finished_sources.add(str(source))
+
+    def _checkpoint_flushed(self) -> None:
+        """Forget checkpoint state that now travels with a flushed batch."""
+        for path in self.finished_sources:
+            source = self.pending_sources.pop(path, None)
+            if source is not None:
+                self.archive_positions.pop(source[0], None)
+        self.finished_sources.clear()
+
+    def write_batch(
+        self,
+        ballot_batch: List[Tuple],
+        contest_batch: List[Tuple],
+        selection_batch: List[Tuple],
+        checkpoint: Tuple[List, List] = ((), ()),
+        duplicates: List[Tuple] = (),
+    ) -> None:
+        """Write one batch of records from ``add_to_batch`` to the database.
+
+        ``checkpoint`` is a ``(completed, positions)`` pair for
+        ``_record_checkpoint``, written in the same transaction, so after a
+        crash the manifest matches exactly the ballots that were committed.
+        ``duplicates`` are ``(cvr_guid, source_id)`` copies skipped before
+        parsing, recorded with the ones this batch drops.
+        Existing GUIDs are found with one join against a temp table and new
+        row ids are allocated in Python above the current maxima while the
+        write lock is held, so a flush costs a fixed handful of statements
+        regardless of batch size. A GUID already in the database, or repeated
+        within the batch, keeps its first ballot; later copies are dropped
+        together with their contests and selections.
+        """
+        ballots_table, contests_table, _ = self.tables
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        new_dict_rows = {table: [] for table in DICT_TABLES}
 
-            # Only process contests/selections for newly inserted ballots
-            if cursor.rowcount == 0:
-                # No new ballots were inserted, skip contest/selection processing
-                return
-
-            # Get mapping of cvr_guid to ballot_id for newly inserted ballots
-            guid_to_ballot_id = {}
-            for ballot_record in self.ballot_batch:
-                cvr_guid = ballot_record[0]
-                result = conn.execute(
-                    "SELECT id FROM cvr_ballots WHERE cvr_guid = ?", (cvr_guid,)
-                ).fetchone()
-                if result:
-                    guid_to_ballot_id[cvr_guid] = result[0]
+        try:
+            # Untyped so text and blob GUIDs compare as stored
+            conn.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS batch_guids (cvr_guid PRIMARY KEY)"
+            )
+            conn.execute("DELETE FROM batch_guids")
+            conn.executemany(
+                "INSERT OR IGNORE INTO batch_guids (cvr_guid) VALUES (?)",
+                ((ballot_record[0],) for ballot_record in ballot_batch),
+            )
+            seen_guids = {
+                row[0]
+                for row in conn.execute(
+                    f"SELECT b.cvr_guid FROM batch_guids g JOIN {ballots_table} b ON b.cvr_guid = g.cvr_guid"  # nosec B608 - Fixed table names
+                )
+            }
 
-            # Update contest records with actual ballot IDs, but only for new ballots
-            updated_contest_batch = []
-            contest_id_mapping = {}
+            first_ballot_id = _next_rowid(conn, ballots_table)
+            first_contest_id = _next_rowid(conn, contests_table)
 
-            for i, (ballot_index, contest_name, contest_id, undervotes) in enumerate(
-                self.contest_batch
-            ):
-                ballot_record = self.ballot_batch[ballot_index]
+            # Pre-allocate ids for new ballots, keeping the first copy of a GUID
+            ballot_ids = {}
+            ballot_rows = []
+            duplicates = list(duplicates)
+            for ballot_index, ballot_record in enumerate(ballot_batch):
                 cvr_guid = ballot_record[0]
-
-                # Only add contest if the ballot was newly inserted
-                if cvr_guid in guid_to_ballot_id:
-                    actual_ballot_id = guid_to_ballot_id[cvr_guid]
-
-                    # Check if this contest already exists for this ballot
-                    existing = conn.execute(
-                        "SELECT id FROM cvr_contests WHERE ballot_id = ? AND contest_id = ?",
-                        (actual_ballot_id, contest_id),
-                    ).fetchone()
-
-                    if not existing:
-                        updated_contest_batch.append(
-                            (actual_ballot_id, contest_name, contest_id, undervotes)
-                        )
-                        contest_id_mapping[i] = len(updated_contest_batch) - 1
-
-            # Insert contests only if we have any
-            if updated_contest_batch:
-                cursor = conn.executemany(
-                    "INSERT INTO cvr_contests (ballot_id, contest_name, contest_id, undervotes) VALUES (?, ?, ?, ?)",
-                    updated_contest_batch,
+                if cvr_guid in seen_guids:
+                    duplicates.append((cvr_guid, ballot_record[6]))
+                    continue
+                seen_guids.add(cvr_guid)
+                ballot_ids[ballot_index] = first_ballot_id + len(ballot_rows)
+                ballot_rows.append((ballot_ids[ballot_index],) + ballot_record)
+
+            # Only add contests for newly inserted ballots
+            contest_ids = {}
+            contest_rows = []
+            for contest_index, (
+                ballot_index,
+                contest_name,
+                contest_id,
+                undervotes,
+            ) in enumerate(contest_batch):
+                ballot_id = ballot_ids.get(ballot_index)
+                if ballot_id is None:
+                    continue
+                contest_ids[contest_index] = first_contest_id + len(contest_rows)
+                contest_rows.append(
+                    (
+                        contest_ids[contest_index],
+                        ballot_id,
+                        contest_name,
+                        contest_id,
+                        undervotes,
+                    )
                 )
 
-                # Get the contest record IDs for selections
-                updated_selection_batch = []
-                contest_records = {}
-
-                for i, (ballot_id, _contest_name, contest_id, _undervotes) in enumerate(
-                    updated_contest_batch
-                ):
-                    result = conn.execute(
-                        "SELECT id FROM cvr_contests WHERE ballot_id = ? AND contest_id = ?",
-                        (ballot_id, contest_id),
-                    ).fetchone()
-                    if result:
-                        contest_records[i] = result[0]
-
-                # Build selection records only for contests that were processed
+            selection_rows = (
+                (contest_ids[contest_index], candidate_name, candidate_id, value)
                 for (
-                    orig_contest_index,
+                    contest_index,
                     candidate_name,
                     candidate_id,
-                    selection_value,
-                ) in self.selection_batch:
-                    if orig_contest_index in contest_id_mapping:
-                        new_contest_index = contest_id_mapping[orig_contest_index]
-                        if new_contest_index in contest_records:
-                            actual_contest_record_id = contest_records[
-                                new_contest_index
-                            ]
-                            updated_selection_batch.append(
-                                (
-                                    actual_contest_record_id,
-                                    candidate_name,
-                                    candidate_id,
-                                    selection_value,
-                                )
-                            )
-
-                # Insert selections only if we have any
-                if updated_selection_batch:
-                    conn.executemany(
-                        "INSERT INTO cvr_selections (contest_record_id, candidate_name, candidate_id, selection_value) VALUES (?, ?, ?, ?)",
-                        updated_selection_batch,
-                    )
+                    value,
+                ) in selection_batch
+                if contest_index in contest_ids
+            )
+
+            if self.compact:
+                self._insert_compact(
+                    conn, ballot_rows, contest_rows, selection_rows, new_dict_rows
+                )
+            else:
+                conn.executemany(
+                    "INSERT INTO cvr_ballots (id, cvr_guid, batch_sequence, sheet_number, precinct_name, precinct_id, is_blank, source_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    ballot_rows,
+                )
+                conn.executemany(
+                    "INSERT INTO cvr_contests (id, ballot_id, contest_name, contest_id, undervotes) VALUES (?, ?, ?, ?, ?)",
+                    contest_rows,
+                )
+                conn.executemany(
+                    "INSERT INTO cvr_selections (contest_record_id, candidate_name, candidate_id, selection_value) VALUES (?, ?, ?, ?)",
+                    selection_rows,
+                )
+            _record_duplicates(conn, duplicates)
+
+            accumulators = None
+            if self.snapshots or self.analysis is not None:
+                accumulators = self._analyze_batch(
+                    contest_batch, selection_batch, contest_ids
+                )
+            if self.snapshots and ballot_rows:
+                _store_snapshot(conn, first_ballot_id, accumulators, len(ballot_rows))
 
+            _record_checkpoint(conn, *checkpoint)
             conn.execute("COMMIT")
 
+            if self.analysis is not None:
+                merge_contests(self.analysis, accumulators)
+                self.analyzed_ballots += len(ballot_rows)
+
         except Exception as e:
             conn.execute("ROLLBACK")
+            # Forget dictionary ids that were never committed
+            for table, rows in new_dict_rows.items():
+                for row in rows:
+                    del self.dict_ids[table][row[1:]]
             logger.error(f"Error writing batch to database: {e}")
             raise
 
+    def _analyze_batch(
+        self,
+        contest_batch: List[Tuple],
+        selection_batch: List[Tuple],
+        contest_ids: Dict[int, int],
+    ) -> Dict:
+        """Analyze the approvals of a batch being written, per contest.
+
+        Only contests that are written count, so ballots dropped as
+        duplicates are left out as they are from the database. Selections
+        are batched contest by contest, so each contest record is one ballot
+        of one contest for ``accumulate_contests``.
+        """
+        rows = (
+            (contest_batch[contest_index][1], contest_index, candidate_name)
+            for contest_index, candidate_name, _, value in selection_batch
+            if value == 1 and contest_index in contest_ids
+        )
+        return accumulate_contests(rows)
+
+    def build_snapshots(self) -> None:
+        """Snapshot the whole database if the snapshots do not cover it.
+
+        Normally every batch stores its own snapshot and this only compares
+        two counts. A database written before snapshots existed, or by a
+        parser without them, is analyzed once here.
+        """
+        if not self.snapshots:
+            return
+        self.drain()
+        conn = self.conn
+        ballots_table = self.tables[0]
+        (covered,) = conn.execute(
+            "SELECT COALESCE(SUM(ballots), 0) FROM analysis_batches"
+        ).fetchone()
+        (stored,) = conn.execute(
+            f"SELECT COUNT(*) FROM {ballots_table}"  # nosec B608 - Fixed table names
+        ).fetchone()
+        if covered == stored:
+            return
+
+        logger.info(f"Building analysis snapshots for {stored:,} ballots...")
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM analysis_snapshots")
+            conn.execute("DELETE FROM analysis_batches")
+            _snapshot_ballots(conn, ballots_table, 0)
+
+    def fused_analysis(self) -> Optional[Dict]:
+        """Return the analysis computed while ingesting, if it is complete.
+
+        That is ``{contest name: ApprovalAccumulator}`` when the ballots
+        written through this parser are all the database holds, as after a
+        fresh build. Otherwise (an incremental run, a shard merge that
+        dropped duplicates) it covers only part of the data and None is
+        returned, so the caller scans the database instead.
+        """
+        if self.analysis is None:
+            return None
+        self.drain()
+        ballots_table = self.tables[0]
+        (stored,) = self.conn.execute(
+            f"SELECT COUNT(*) FROM {ballots_table}"  # nosec B608 - Fixed table names
+        ).fetchone()
+        if stored != self.analyzed_ballots:
+            return None
+        return self.analysis
+
+    def _write_loop(self) -> None:
+        """Writer thread: commit queued batches in order until told to stop.
+
+        After a failure the remaining batches are discarded until ``drain``
+        reports the error.
+        """
+        write_queue = self.write_queue
+        stats = self.pipeline_stats
+        while True:
+            start = time.perf_counter()
+            batch = write_queue.get()
+            stats["get_wait"] += time.perf_counter() - start
+            try:
+                if batch is None:
+                    return
+                if self.write_error is None:
+                    start = time.perf_counter()
+                    self.write_batch(*batch)
+                    stats["write_time"] += time.perf_counter() - start
+            except Exception as e:
+                self.write_error = e
+            finally:
+                write_queue.task_done()
+
+    def drain(self) -> None:
+        """Wait until the writer thread has committed every queued batch.
+
+        Anything else that uses the connection calls this first. Re-raises
+        the error if a queued batch failed to write.
+        """
+        if self.write_queue is None:
+            return
+        self.write_queue.join()
+        error, self.write_error = self.write_error, None
+        if error is not None:
+            raise error
+
+    def load_guid_index(self, expected: int = 0) -> None:
+        """Seed the GUID index from the ballots already in the database.
+
+        ``expected`` is roughly how many ballots are about to be added, which
+        sizes a Bloom filter; a set grows as needed.
+        """
+        if self.guid_filter == "off":
+            return
+
+        self.drain()
+        query = (
+            f"SELECT cvr_guid FROM {self.tables[0]}"  # nosec B608 - Fixed table names
+        )
+        if self.guid_filter == "bloom":
+            (count,) = self.conn.execute(
+                f"SELECT COUNT(*) FROM {self.tables[0]}"  # nosec B608 - Fixed table names
+            ).fetchone()
+            index = GuidBloomFilter(max(BLOOM_MIN_CAPACITY, count + expected))
+            for (cvr_guid,) in self.conn.execute(query):
+                index.add(cvr_guid)
+        else:
+            index = {cvr_guid for (cvr_guid,) in self.conn.execute(query)}
+            count = len(index)
+        self.guid_index = index
+        logger.info(f"Loaded {count:,} stored ballot GUIDs ({self.guid_filter} index)")
+
+    def forget_guids(self, guids: Iterable[Union[bytes, str]]) -> None:
+        """Drop retracted GUIDs from an exact index.
+
+        A Bloom filter cannot forget; its stale hits fail the database check.
+        """
+        if isinstance(self.guid_index, set):
+            self.guid_index.difference_update(guids)
+
+    def is_duplicate(self, source: Source, source_id: Optional[int] = None) -> bool:
+        """Whether a source's ballot is already stored or batched, read cheaply.
+
+        Only the GUID at the top of the file is read. Skipping such a ballot
+        gives the same result as ``write_batch`` dropping it after a full
+        parse, since the first copy of a GUID wins either way; the copy is
+        recorded for ``source_id`` all the same (see ``is_stored_guid``).
+        """
+        if self.guid_index is None:
+            return False
+        try:
+            cvr_guid = peek_guid(source)
+        except Exception:
+            return False  # reported when the file is parsed
+        return self.is_stored_guid(cvr_guid, source_id)
+
+    def is_stored_guid(
+        self, cvr_guid: Optional[str], source_id: Optional[int] = None
+    ) -> bool:
+        """Whether a peeked GUID is already stored or batched.
+
+        If so, the skipped copy is queued for ``ingest_duplicates`` with the
+        next batch, so the ballot can be read back from ``source_id`` if the
+        stored copy is ever retracted.
+        """
+        index = self.guid_index
+        if index is None or cvr_guid is None:
+            return False
+        if self.compact:
+            cvr_guid = _pack_guid(cvr_guid)
+        if cvr_guid not in index:
+            return False
+
+        if isinstance(index, GuidBloomFilter):
+            self.drain()
+            query = f"SELECT 1 FROM {self.tables[0]} WHERE cvr_guid = ?"  # nosec B608 - Fixed table names
+            if self.conn.execute(query, (cvr_guid,)).fetchone() is None:
+                return False
+
+        self.duplicates += 1
+        self.duplicate_batch.append((cvr_guid, source_id))
+        return True
+
+    def iter_ballots(
+        self, sources: List[Source], source_ids: Optional[Dict[str, int]] = None
+    ) -> Iterator[Optional[Ballot]]:
+        """Parse sources in order, yielding a ballot (or None) for each.
+
+        None stands for a file that failed to parse or was skipped as a
+        duplicate; ``source_ids`` maps files and archives to the manifest
+        entries such skipped copies are recorded for. With more than one
+        worker, parsing fans out to a process pool while this process stays
+        the single writer; ``imap`` keeps results in input order so the
+        database ends up identical to a serial run. The pool lives until
+        ``close``, so streamed chunks reuse the same workers.
+        """
+        source_ids = source_ids or {}
+        if self.workers == 1:
+            try:
+                for source in sources:
+                    if self.is_duplicate(source, source_ids.get(_source_key(source))):
+                        yield None
+                    else:
+                        yield self.parse_xml_file(source)
+            finally:
+                close_archives()
+            return
+
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers)
+
+        # The workers read each file's GUID, and only the rest are parsed.
+        # The index is checked here: it also holds the GUIDs batched but not
+        # yet written and drops retracted ones, which a copy in each worker
+        # would miss.
+        tasks = sources
+        if self.guid_index is not None:
+            guids = self.pool.imap(_peek_worker, sources, chunksize=WORKER_CHUNKSIZE)
+            tasks = [
+                (
+                    None
+                    if self.is_stored_guid(
+                        cvr_guid, source_ids.get(_source_key(source))
+                    )
+                    else source
+                )
+                for source, cvr_guid in zip(sources, guids, strict=True)
+            ]
+
+        results = self.pool.imap(
+            partial(_parse_worker, self.parse),
+            tasks,
+            chunksize=WORKER_CHUNKSIZE,
+        )
+        for source, (ballot, error) in zip(sources, results, strict=True):
+            if error is not None:
+                self.errors += 1
+                logger.error(f"Error parsing {describe_source(source)}: {error}")
+            yield ballot
+
+    def _insert_compact(
+        self,
+        conn: sqlite3.Connection,
+        ballot_rows: List[Tuple],
+        contest_rows: List[Tuple],
+        selection_rows: Iterable[Tuple],
+        new_dict_rows: Dict[str, List[Tuple]],
+    ) -> None:
+        """Insert one flush worth of rows into the dictionary-encoded layout."""
+        lookup = partial(self._dict_id, new_rows=new_dict_rows)
+
+        ballot_rows = [
+            (
+                ballot_id,
+                cvr_guid,
+                batch_sequence,
+                sheet_number,
+                lookup("cvr_precinct_dict", (precinct_name, precinct_id)),
+                is_blank,
+                source_id,
+            )
+            for (
+                ballot_id,
+                cvr_guid,
+                batch_sequence,
+                sheet_number,
+                precinct_name,
+                precinct_id,
+                is_blank,
+                source_id,
+            ) in ballot_rows
+        ]
+        contest_rows = [
+            (
+                contest_record_id,
+                ballot_id,
+                lookup("cvr_contest_dict", (contest_name, contest_id)),
+                undervotes,
+            )
+            for (
+                contest_record_id,
+                ballot_id,
+                contest_name,
+                contest_id,
+                undervotes,
+            ) in contest_rows
+        ]
+
+        # Number each contest's selections in ballot order
+        encoded_selections = []
+        previous_contest = seq = None
+        for contest_record_id, candidate_name, candidate_id, value in selection_rows:
+            if contest_record_id == previous_contest:
+                seq += 1
+            else:
+                previous_contest, seq = contest_record_id, 0
+            encoded_selections.append(
+                (
+                    contest_record_id,
+                    seq,
+                    lookup("cvr_candidate_dict", (candidate_name, candidate_id)),
+                    value,
+                )
+            )
+
+        for table, (name_column, id_column) in DICT_TABLES.items():
+            conn.executemany(
+                f"INSERT INTO {table} (id, {name_column}, {id_column}) VALUES (?, ?, ?)",  # nosec B608 - Fixed table names
+                new_dict_rows[table],
+            )
+        conn.executemany(
+            "INSERT INTO cvr_ballot_rows (id, cvr_guid, batch_sequence, sheet_number, precinct, is_blank, source_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ballot_rows,
+        )
+        conn.executemany(
+            "INSERT INTO cvr_contest_rows (id, ballot_id, contest, undervotes) VALUES (?, ?, ?, ?)",
+            contest_rows,
+        )
+        conn.executemany(
+            "INSERT INTO cvr_selection_rows (contest_record_id, seq, candidate, selection_value) VALUES (?, ?, ?, ?)",
+            encoded_selections,
+        )
+
+    def merge_shard(self, shard_path: Union[Path, str]) -> int:
+        """Copy a shard database's ballots into this one; return how many were new.
+
+        Ballots whose GUID is already here are dropped with their contests
+        and selections, as in ``write_batch``, and the rest are numbered on
+        from the current maxima in shard order. Merging shards in ingest
+        order therefore gives the rows and ids of a serial ingest. The copy
+        is a handful of ``INSERT ... SELECT`` statements in one transaction.
+        """
+        self.drain()
+        ballots_table, contests_table, _ = self.tables
+        conn = self.conn
+        conn.execute("ATTACH DATABASE ? AS shard", (str(shard_path),))
+        try:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute(
+                    "CREATE TEMP TABLE IF NOT EXISTS merge_ballots (shard_id INTEGER PRIMARY KEY, id INTEGER)"
+                )
+                conn.execute(
+                    "CREATE TEMP TABLE IF NOT EXISTS merge_contests (shard_id INTEGER PRIMARY KEY, id INTEGER, ballot_id INTEGER)"
+                )
+                conn.execute("DELETE FROM merge_ballots")
+                conn.execute("DELETE FROM merge_contests")
+                first_ballot_id = _next_rowid(conn, f"main.{ballots_table}")
+                conn.execute(
+                    f"""
+                    INSERT INTO merge_ballots (shard_id, id)
+                    SELECT s.id, ? + ROW_NUMBER() OVER (ORDER BY s.id)
+                    FROM shard.{ballots_table} s
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM main.{ballots_table} b WHERE b.cvr_guid = s.cvr_guid
+                    )
+                    """,  # nosec B608 - Fixed table names
+                    (first_ballot_id - 1,),
+                )
+                conn.execute(
+                    f"""
+                    INSERT INTO merge_contests (shard_id, id, ballot_id)
+                    SELECT c.id, ? + ROW_NUMBER() OVER (ORDER BY c.id), m.id
+                    FROM shard.{contests_table} c
+                    JOIN merge_ballots m ON m.shard_id = c.ballot_id
+                    """,  # nosec B608 - Fixed table names
+                    (_next_rowid(conn, f"main.{contests_table}") - 1,),
+                )
+                if self.compact:
+                    self._merge_compact(conn)
+                else:
+                    self._merge_legacy(conn)
+                conn.execute(
+                    f"""
+                    INSERT OR IGNORE INTO main.ingest_duplicates (cvr_guid, source_id)
+                    SELECT cvr_guid, source_id FROM shard.ingest_duplicates
+                    UNION ALL
+                    SELECT s.cvr_guid, s.source_id FROM shard.{ballots_table} s
+                    WHERE s.source_id IS NOT NULL
+                        AND s.id NOT IN (SELECT shard_id FROM merge_ballots)
+                    """  # nosec B608 - Fixed table names
+                )
+                (merged,) = conn.execute(
+                    "SELECT COUNT(*) FROM merge_ballots"
+                ).fetchone()
+                if self.snapshots:
+                    _snapshot_ballots(conn, f"main.{ballots_table}", first_ballot_id)
         finally:
-            conn.close()
-
-            # Clear batches
-            self.ballot_batch.clear()
-            self.contest_batch.clear()
-            self.selection_batch.clear()
-
-    def process_directory(self, data_dir: Path) -> None:
-        """Process all XML files in the given directory."""
-        xml_files = list(data_dir.glob("*.xml"))
-        logger.info(f"Found {len(xml_files)} XML files to process")
-
-        with tqdm(xml_files, desc="Processing CVR files", unit="files") as pbar:
-            for file_path in pbar:
-                ballot_data = self.parse_xml_file(file_path)
-
-                if ballot_data:
-                    self.add_to_batch(ballot_data)
-                    self.processed += 1
-
-                    # Flush batch when it reaches the batch size
-                    if len(self.ballot_batch) >= self.batch_size:
-                        self.flush_batch()
-
-                # Update progress bar
-                pbar.set_postfix(
-                    {
-                        "processed": self.processed,
-                        "errors": self.errors,
-                        "rate": f"{self.processed / (time.time() - self.start_time):.1f}/s",
-                    }
+            conn.execute("DETACH DATABASE shard")
+
+        if self.compact:
+            self._load_dictionaries(conn)
+        return merged
+
+    def _merge_legacy(self, conn: sqlite3.Connection) -> None:
+        """Copy the rows picked by ``merge_shard`` in the legacy layout."""
+        conn.execute(
+            """
+            INSERT INTO main.cvr_ballots (id, cvr_guid, batch_sequence, sheet_number, precinct_name, precinct_id, is_blank, created_at, source_id)
+            SELECT m.id, s.cvr_guid, s.batch_sequence, s.sheet_number, s.precinct_name, s.precinct_id, s.is_blank, s.created_at, s.source_id
+            FROM merge_ballots m JOIN shard.cvr_ballots s ON s.id = m.shard_id
+            ORDER BY m.id
+            """
+        )
+        conn.execute(
+            """
+            INSERT INTO main.cvr_contests (id, ballot_id, contest_name, contest_id, undervotes)
+            SELECT m.id, m.ballot_id, c.contest_name, c.contest_id, c.undervotes
+            FROM merge_contests m JOIN shard.cvr_contests c ON c.id = m.shard_id
+            ORDER BY m.id
+            """
+        )
+        conn.execute(
+            """
+            INSERT INTO main.cvr_selections (contest_record_id, candidate_name, candidate_id, selection_value)
+            SELECT m.id, s.candidate_name, s.candidate_id, s.selection_value
+            FROM shard.cvr_selections s JOIN merge_contests m ON m.shard_id = s.contest_record_id
+            ORDER BY s.id
+            """
+        )
+
+    def _merge_compact(self, conn: sqlite3.Connection) -> None:
+        """Copy the rows picked by ``merge_shard`` in the compact layout.
+
+        Dictionary entries new to this database are added first, and each
+        shard key is mapped to this database's key by name and id.
+        """
+        for table, (name_column, id_column) in DICT_TABLES.items():
+            conn.execute(
+                f"""
+                INSERT INTO main.{table} ({name_column}, {id_column})
+                SELECT d.{name_column}, d.{id_column} FROM shard.{table} d
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM main.{table} m
+                    WHERE m.{name_column} IS d.{name_column} AND m.{id_column} IS d.{id_column}
+                )
+                ORDER BY d.id
+                """  # nosec B608 - Fixed table names
+            )
+            conn.execute(
+                f"CREATE TEMP TABLE IF NOT EXISTS merge_{table} (shard_id INTEGER PRIMARY KEY, id INTEGER)"
+            )
+            conn.execute(f"DELETE FROM merge_{table}")  # nosec B608 - Fixed table names
+            conn.execute(
+                f"""
+                INSERT INTO merge_{table} (shard_id, id)
+                SELECT d.id, MIN(m.id) FROM shard.{table} d
+                JOIN main.{table} m
+                    ON m.{name_column} IS d.{name_column} AND m.{id_column} IS d.{id_column}
+                GROUP BY d.id
+                """  # nosec B608 - Fixed table names
+            )
+
+        conn.execute(
+            """
+            INSERT INTO main.cvr_ballot_rows (id, cvr_guid, batch_sequence, sheet_number, precinct, is_blank, created_at, source_id)
+            SELECT m.id, s.cvr_guid, s.batch_sequence, s.sheet_number, p.id, s.is_blank, s.created_at, s.source_id
+            FROM merge_ballots m
+            JOIN shard.cvr_ballot_rows s ON s.id = m.shard_id
+            JOIN merge_cvr_precinct_dict p ON p.shard_id = s.precinct
+            ORDER BY m.id
+            """
+        )
+        conn.execute(
+            """
+            INSERT INTO main.cvr_contest_rows (id, ballot_id, contest, undervotes)
+            SELECT m.id, m.ballot_id, d.id, c.undervotes
+            FROM merge_contests m
+            JOIN shard.cvr_contest_rows c ON c.id = m.shard_id
+            JOIN merge_cvr_contest_dict d ON d.shard_id = c.contest
+            ORDER BY m.id
+            """
+        )
+        conn.execute(
+            """
+            INSERT INTO main.cvr_selection_rows (contest_record_id, seq, candidate, selection_value)
+            SELECT m.id, s.seq, d.id, s.selection_value
+            FROM shard.cvr_selection_rows s
+            JOIN merge_contests m ON m.shard_id = s.contest_record_id
+            JOIN merge_cvr_candidate_dict d ON d.shard_id = s.candidate
+            """
+        )
+
+    def plan_sources(
+        self, paths: List[Union[Path, str]], force: bool = False, resume: bool = False
+    ) -> Dict[str, int]:
+        """Register the files or archives that need ingesting; return their ids.
+
+        A path whose size and mtime match a completed manifest entry is
+        skipped without being read, and one whose SHA-256 still matches is
+        skipped after hashing. Anything else is new or changed: rows from an
+        earlier ingest of it (including one that never completed) are
+        retracted, and its entry stays pending until it is completed. With
+        ``resume``, an archive left part way through with its size and mtime
+        unchanged keeps its committed ballots and continues from its
+        checkpoint (see ``archive_positions``) instead.
+        A ballot found in two sources belongs to whichever was ingested first.
+        Only the manifest entries for ``paths`` are read.
+        """
+        self.drain()
+        conn = self.conn
+        with conn:
+            conn.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS plan_paths (path TEXT PRIMARY KEY)"
+            )
+            conn.execute("DELETE FROM plan_paths")
+            conn.executemany(
+                "INSERT OR IGNORE INTO plan_paths (path) VALUES (?)",
+                ((str(path),) for path in paths),
+            )
+            manifest = {
+                path: (source_id, size, mtime, content_hash, checkpoint)
+                for source_id, path, size, mtime, content_hash, checkpoint in conn.execute(
+                    """
+                    SELECT m.id, m.path, m.size, m.mtime, m.content_hash, m.checkpoint
+                    FROM plan_paths p JOIN ingest_manifest m ON m.path = p.path
+                    """
+                )
+            }
+
+        touched = []
+        retract_ids = []
+        pending = {}
+        resumed = {}
+        for path in paths:
+            stat = os.stat(path)
+            source_id, size, mtime, content_hash, checkpoint = manifest.get(
+                str(path), (None, None, None, None, None)
+            )
+            unchanged = (size, mtime) == (stat.st_size, stat.st_mtime)
+            if not force and content_hash is not None and unchanged:
+                continue
+
+            if resume and not force and checkpoint is not None and unchanged:
+                resumed[source_id] = checkpoint
+                pending[str(path)] = (stat.st_size, stat.st_mtime, hash_file(path))
+                continue
+
+            new_hash = hash_file(path)
+            if new_hash == content_hash and not force:
+                touched.append((stat.st_size, stat.st_mtime, source_id))
+                continue
+
+            if source_id is not None:
+                retract_ids.append(source_id)
+            pending[str(path)] = (stat.st_size, stat.st_mtime, new_hash)
+
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "UPDATE ingest_manifest SET size = ?, mtime = ? WHERE id = ?", touched
+            )
+            self.forget_guids(_retract_sources(conn, retract_ids, self.tables))
+            conn.executemany(
+                """
+                INSERT INTO ingest_manifest (path, size, mtime) VALUES (?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET
+                    size = excluded.size,
+                    mtime = excluded.mtime,
+                    content_hash = NULL,
+                    checkpoint = NULL
+                """,
+                (
+                    (path, size, mtime)
+                    for path, (size, mtime, _) in pending.items()
+                    if manifest.get(path, (None,))[0] not in resumed
+                ),
+            )
+            source_ids = {
+                path: source_id
+                for source_id, path in conn.execute(
+                    """
+                    SELECT m.id, m.path
+                    FROM plan_paths p JOIN ingest_manifest m ON m.path = p.path
+                    WHERE m.content_hash IS NULL
+                    """
                 )
+                if path in pending
+            }
+
+        for path, (_size, _mtime, content_hash) in pending.items():
+            self.pending_sources[path] = (source_ids[path], content_hash)
+        self.archive_positions.update(resumed)
+        return source_ids
+
+    def complete_sources(self, paths: Optional[Iterable[str]] = None) -> None:
+        """Mark pending sources ingested once all their ballots are committed.
+
+        ``paths`` limits this to the sources just read; archives planned up
+        front but not read yet stay pending. Without it every pending source
+        is completed.
+        """
+        if paths is None:
+            paths = list(self.pending_sources)
+        paths = [path for path in paths if path in self.pending_sources]
+        if not paths:
+            return
+
+        self.drain()
+        with self.conn as conn:
+            _record_checkpoint(conn, [self.pending_sources[path] for path in paths])
+        self.forget_sources(paths)
+
+    def forget_sources(self, paths: Iterable[str]) -> None:
+        """Drop the pending and checkpoint state of sources, leaving the rest."""
+        for path in paths:
+            source = self.pending_sources.pop(path, None)
+            if source is not None:
+                self.archive_positions.pop(source[0], None)
+            self.finished_sources.discard(path)
+
+    def prune_sources(
+        self, data_dirs: Iterable[Path] = (), zip_paths: Iterable[Path] = ()
+    ) -> int:
+        """Retract ballots from manifest sources that are no longer present.
+
+        Only call this with the complete set of inputs for the database: an
+        ingested source is kept if it is one of ``zip_paths`` or an XML file
+        that still exists directly in one of ``data_dirs``. Each manifest
+        entry is checked on its own, so no listing of the inputs is built.
+        """
+        data_dirs = {str(path) for path in data_dirs}
+        zip_paths = {str(path) for path in zip_paths}
+
+        def present(path: str) -> bool:
+            if path in zip_paths:
+                return True
+            return (
+                os.path.dirname(path) in data_dirs
+                and path.endswith(".xml")
+                and os.path.isfile(path)
+            )
+
+        self.drain()
+        with self.conn as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            removed = [
+                source_id
+                for source_id, path in conn.execute(
+                    "SELECT id, path FROM ingest_manifest"
+                )
+                if not present(path)
+            ]
+            self.forget_guids(_retract_sources(conn, removed, self.tables))
+            conn.executemany(
+                "DELETE FROM ingest_manifest WHERE id = ?",
+                ((source_id,) for source_id in removed),
+            )
+        return len(removed)
+
+    def process_sources(
+        self, sources: List[Source], source_ids: Dict[str, int], pbar: tqdm
+    ) -> None:
+        """Parse and store every source, flushing in batches.
+
+        ``source_ids`` maps each file (or archive) to its manifest entry.
+        Files are completed with the batch holding their ballot, and each
+        batch checkpoints how far into an archive it reaches; the archive
+        itself is completed with the final batch.
+        """
+        for source, ballot in zip(
+            sources, self.iter_ballots(sources, source_ids), strict=True
+        ):
+            if ballot:
+                self.add_to_batch(ballot, source_ids.get(_source_key(source)))
+                self.processed += 1
+            self.mark_source_read(source)
+
+            # Flush batch when it reaches the batch size
+            if len(self.ballot_batch) >= self.batch_size:
+                self.flush_batch()
+
+            # Update progress bar (tqdm throttles the redraw)
+            postfix = {
+                "processed": self.processed,
+                "errors": self.errors,
+                "rate": f"{self.processed / (time.time() - self.start_time):.1f}/s",
+            }
+            if self.write_queue is not None:
+                postfix["queued"] = self.write_queue.qsize()
+            pbar.set_postfix(postfix, refresh=False)
+            pbar.update(1)
+
+        # Flush any remaining records, completing these sources with them
+        self.finished_sources.update(source_ids)
+        self.flush_batch()
+        self.complete_sources(source_ids)
+
+    def plan_directory(
+        self,
+        data_dir: Path,
+        result: IngestResult,
+        force: bool = False,
+        resume: bool = False,
+    ) -> Iterator[Tuple[List[Source], Dict[str, int]]]:
+        """Yield the new or changed XML files in a directory, a chunk at a time.
+
+        Files are listed as ``os.scandir`` finds them and each chunk is
+        planned just before it is parsed, so ingest starts at once and memory
+        does not grow with the size of the directory. Files are checkpointed
+        one by one as they complete, so ``resume`` changes nothing here.
+        """
+        xml_files = scan_xml_files(data_dir)
+        chunk_size = max(SCAN_CHUNK_SIZE, self.batch_size)
+        while chunk := list(islice(xml_files, chunk_size)):
+            source_ids = self.plan_sources(chunk, force, resume)
+            result.files += len(chunk)
+            result.skipped += len(chunk) - len(source_ids)
+            yield [path for path in chunk if str(path) in source_ids], source_ids
+
+        logger.info(
+            f"{data_dir}: {result.files} XML files, {result.skipped} unchanged since last ingest"
+        )
 
-        # Flush any remaining records
+    def plan_archive(
+        self,
+        zip_path: Path,
+        result: IngestResult,
+        force: bool = False,
+        resume: bool = False,
+    ) -> Tuple[List[Source], Dict[str, int]]:
+        """List the XML members of a ZIP archive, or none if it is unchanged.
+
+        The archive is a single manifest source: unchanged archives are
+        skipped without being opened, changed ones are retracted and re-read.
+        With ``resume`` an interrupted archive only lists the members after
+        its checkpoint; members keep their order in the unchanged archive.
+        """
+        with zipfile.ZipFile(zip_path) as archive:
+            members = [
+                (str(zip_path), info.filename)
+                for info in archive.infolist()
+                if not info.is_dir() and info.filename.endswith(".xml")
+            ]
+        result.files = len(members)
+
+        source_ids = self.plan_sources([zip_path], force, resume)
+        if not source_ids:
+            result.skipped = len(members)
+            logger.info(f"{zip_path}: unchanged since last ingest, skipping")
+            return [], source_ids
+
+        checkpoint = self.archive_positions.get(source_ids[str(zip_path)], 0)
+        if checkpoint:
+            result.skipped = checkpoint
+            logger.info(
+                f"{zip_path}: resuming after {checkpoint} of {len(members)} XML files"
+            )
+            return members[checkpoint:], source_ids
+
+        logger.info(f"{zip_path}: {len(members)} XML files")
+        return members, source_ids
+
+    def ingest(
+        self,
+        data_dirs: Iterable[Path] = (),
+        zip_paths: Iterable[Path] = (),
+        force: bool = False,
+        precount: bool = True,
+        resume: bool = False,
+    ) -> List[IngestResult]:
+        """Ingest many directories and archives in one job.
+
+        Everything shares this parser's database setup, worker settings and a
+        single progress bar. Archives are planned up front; directories are
+        streamed a chunk at a time (see ``plan_directory``), and ``precount``
+        first counts their XML files by name so the progress bar has a total.
+        Ballots whose GUID is already stored are skipped before parsing.
+        With more than one shard, writing is parallel too (see
+        ``_ingest_shards``).
+        A source that fails is reported in its result (and left pending in the
+        manifest, so the next run retries it) instead of aborting the rest of
+        the job. ``resume`` continues archives from their last checkpoint
+        rather than retracting them (see ``plan_sources``).
+        """
+        work = []
+        results = []
+        for zip_path in zip_paths:
+            result = IngestResult(zip_path)
+            results.append(result)
+            try:
+                work.append(
+                    (result, [self.plan_archive(zip_path, result, force, resume)])
+                )
+            except Exception as e:
+                result.error = str(e)
+                logger.error(f"Failed to read {zip_path}: {e}")
+        total = sum(result.files for result, _ in work)
+
+        for data_dir in data_dirs:
+            result = IngestResult(data_dir)
+            results.append(result)
+            work.append((result, self.plan_directory(data_dir, result, force, resume)))
+            if precount and total is not None:
+                with suppress(OSError):  # reported when the directory is read
+                    total += count_xml_files(data_dir)
+            elif not precount:
+                total = None
+
+        if self.shards > 1:
+            self._ingest_shards(work, total)
+            self.restore_duplicates()
+            self.build_indexes()
+            self.build_snapshots()
+            return results
+
+        if self.guid_index is None:
+            self.load_guid_index(total or 0)
+
+        with tqdm(total=total, desc="Processing CVR files", unit="files") as pbar:
+            for result, chunks in work:
+                processed, errors = self.processed, self.errors
+                duplicates = self.duplicates
+                skipped = 0
+                source_ids = {}
+                pbar.set_description(f"Processing {result.source.name}")
+                try:
+                    for sources, source_ids in chunks:
+                        pbar.update(result.skipped - skipped)
+                        skipped = result.skipped
+                        if sources:
+                            self.process_sources(sources, source_ids, pbar)
+                except Exception as e:
+                    result.error = str(e)
+                    logger.error(f"Failed to process {result.source}: {e}")
+                    # Drop this source's unsaved ballots and leave it pending
+                    with suppress(Exception):
+                        self.drain()  # already reported by the writer
+                    self.ballot_batch.clear()
+                    self.contest_batch.clear()
+                    self.selection_batch.clear()
+                    self.duplicate_batch.clear()
+                    self.forget_sources(source_ids)
+                    # The index holds GUIDs of the ballots just dropped
+                    self.load_guid_index()
+                result.parsed = self.processed - processed
+                result.errors = self.errors - errors
+                result.duplicates = self.duplicates - duplicates
+
+        self.restore_duplicates()
+        self.build_indexes()
+        self.build_snapshots()
+        return results
+
+    def restore_duplicates(self) -> int:
+        """Read back ballots whose stored copy was retracted; return how many.
+
+        A source whose ballot was dropped as a duplicate is complete, so it is
+        not read again when the copy that was kept is retracted with its own
+        source. For each such GUID, one completed source still holding it
+        (the first registered) is read and just that ballot is stored for it,
+        as a rebuild without the retracted source would store it.
+        """
+        self.drain()
+        missing = {}  # source_id -> (path, GUIDs to read back)
+        for cvr_guid, source_id, path in self.conn.execute(
+            f"""
+            SELECT d.cvr_guid, MIN(d.source_id), m.path
+            FROM ingest_duplicates d
+            JOIN ingest_manifest m ON m.id = d.source_id
+            WHERE m.content_hash IS NOT NULL AND NOT EXISTS (
+                SELECT 1 FROM {self.tables[0]} b WHERE b.cvr_guid = d.cvr_guid
+            )
+            GROUP BY d.cvr_guid
+            """  # nosec B608 - Fixed table names
+        ):
+            missing.setdefault(source_id, (path, set()))[1].add(cvr_guid)
+        if not missing:
+            return 0
+
+        restored = 0
+        try:
+            for source_id, (path, guids) in sorted(missing.items()):
+                try:
+                    if zipfile.is_zipfile(path):
+                        with zipfile.ZipFile(path) as archive:
+                            sources = [
+                                (path, info.filename)
+                                for info in archive.infolist()
+                                if not info.is_dir() and info.filename.endswith(".xml")
+                            ]
+                    else:
+                        sources = [path]
+                except OSError as e:
+                    logger.error(f"Cannot read back duplicates from {path}: {e}")
+                    continue
+
+                for source in sources:
+                    try:
+                        cvr_guid = peek_guid(source)
+                    except Exception:
+                        cvr_guid = None  # reported when the file is parsed
+                    if (
+                        cvr_guid is not None
+                        and self._stored_guid(cvr_guid) not in guids
+                    ):
+                        continue
+                    ballot = self.parse_xml_file(source)
+                    if ballot and self._stored_guid(ballot[0]) in guids:
+                        guids.discard(self._stored_guid(ballot[0]))
+                        self.add_to_batch(ballot, source_id)
+                        restored += 1
+                        if len(self.ballot_batch) >= self.batch_size:
+                            self.flush_batch()
+                    if not guids:
+                        break
+        finally:
+            close_archives()
         self.flush_batch()
+        self.drain()
+        logger.info(f"Restored {restored:,} ballots held by other sources")
+        return restored
+
+    def _stored_guid(self, cvr_guid: str) -> Union[bytes, str]:
+        """Return a GUID as this database's ballots table stores it."""
+        return _pack_guid(cvr_guid) if self.compact else cvr_guid
+
+    def _ingest_shards(
+        self, work: List[Tuple[IngestResult, Iterable]], total: Optional[int]
+    ) -> None:
+        """Ingest planned work in shard processes, then merge the shards here.
+
+        Every source is planned against this database first, so the manifest,
+        retraction and source ids work as in a serial ingest. The sources are
+        then split into contiguous runs in ingest order, and each shard
+        process parses and writes its run into a database of its own, so N
+        shards give N parsers and N SQLite writers. ``merge_shard`` copies the
+        shards back in order. A source is completed only if every shard that
+        read from it succeeded.
+        """
+        tasks = []
+        failed = set()
+        for index, (result, chunks) in enumerate(work):
+            try:
+                for sources, source_ids in chunks:
+                    tasks.extend(
+                        (index, source, source_ids[_source_key(source)])
+                        for source in sources
+                    )
+            except Exception as e:
+                result.error = str(e)
+                failed.add(index)
+                logger.error(f"Failed to read {work[index][0].source}: {e}")
+
+        size = -(-len(tasks) // self.shards) if tasks else 1
+        slices = [tasks[start : start + size] for start in range(0, len(tasks), size)]
+        settings = {
+            "batch_size": self.batch_size,
+            "parser": self.parser_name,
+            "compact": self.compact,
+            "pipeline_depth": self.pipeline_depth,
+            "guid_filter": self.guid_filter,
+            "analyze": self.analysis is not None,
+        }
+        logger.info(f"Ingesting {len(tasks):,} files in {len(slices)} shards")
+
+        progress = multiprocessing.Value("q", 0)
+        with tempfile.TemporaryDirectory(
+            prefix=f"{self.db_path.name}.shards-", dir=self.db_path.parent
+        ) as shard_dir, tqdm(
+            total=total, desc="Processing CVR files (sharded)", unit="files"
+        ) as pbar, multiprocessing.Pool(
+            len(slices) or 1, initializer=_init_shard, initargs=(progress,)
+        ) as pool:
+            pbar.update(sum(result.skipped for result, _ in work))
+            shard_paths = [
+                os.path.join(shard_dir, f"shard-{number}.sqlite3")
+                for number in range(len(slices))
+            ]
+            jobs = [
+                pool.apply_async(_ingest_shard, (shard_path, shard_tasks, settings))
+                for shard_path, shard_tasks in zip(shard_paths, slices, strict=True)
+            ]
+            done = 0
+            for job in jobs:
+                while not job.ready():
+                    job.wait(0.5)
+                    pbar.update(progress.value - done)
+                    done = progress.value
+            pbar.update(progress.value - done)
+
+            pbar.set_description("Merging shards")
+            for shard_path, shard_tasks, job in zip(
+                shard_paths, slices, jobs, strict=True
+            ):
+                indexes = {index for index, _, _ in shard_tasks}
+                try:
+                    counts, analysis, analyzed = job.get()
+                    merged = self.merge_shard(shard_path)
+                except Exception as e:
+                    logger.error(f"Failed to ingest shard {shard_path}: {e}")
+                    for index in indexes:
+                        work[index][0].error = str(e)
+                    failed |= indexes
+                    continue
+                logger.info(f"Merged {merged:,} new ballots from {shard_path}")
+
+                # Merged in shard order, so contests keep their serial order
+                if self.analysis is not None:
+                    merge_contests(self.analysis, analysis)
+                    self.analyzed_ballots += analyzed
+
+                for index, (parsed, errors, duplicates) in counts.items():
+                    result = work[index][0]
+                    result.parsed += parsed
+                    result.errors += errors
+                    result.duplicates += duplicates
+                    self.processed += parsed
+                    self.errors += errors
+                    self.duplicates += duplicates
+
+        # Leave every source of a failed result pending, so the next run retries it
+        for index, source, _ in tasks:
+            if index in failed:
+                self.pending_sources.pop(_source_key(source), None)
+        self.complete_sources()
+        # Ballots arrived without passing through the GUID index
+        self.guid_index = None
+
+    def show_pipeline_stats(self) -> None:
+        """Print where each side of the parse/write pipeline spent its time.
+
+        The parser waits on a full queue when the writer is the bottleneck,
+        and the writer waits on an empty one when parsing is.
+        """
+        stats = self.pipeline_stats
+        batches = stats["batches"]
+        print("\nPIPELINE")
+        print("-" * 30)
+        print(f"Batches queued: {batches:,}")
+        print(
+            f"Queue depth: {stats['depth_total'] / max(batches, 1):.1f} average, "
+            f"{stats['depth_max']} max of {self.write_queue.maxsize}"
+        )
+        print(f"Parser waiting on writer: {stats['put_wait']:.2f} seconds")
+        print(f"Writer waiting on parser: {stats['get_wait']:.2f} seconds")
+        print(f"Writer busy: {stats['write_time']:.2f} seconds")
+        bottleneck = "writer" if stats["put_wait"] > stats["get_wait"] else "parser"
+        print(f"Bottleneck: {bottleneck}")
+
+    def process_directory(self, data_dir: Path, force: bool = False) -> IngestResult:
+        """Process the new or changed XML files in the given directory."""
+        return self.ingest(data_dirs=[data_dir], force=force)[0]
+
+    def process_archive(self, zip_path: Path, force: bool = False) -> IngestResult:
+        """Process the XML members of a ZIP archive without extracting it."""
+        return self.ingest(zip_paths=[zip_path], force=force)[0]
 
     def show_summary(self) -> None:
         """Display processing summary and database statistics."""
@@ -396,11 +2505,19 @@ class CvrParser:
         print("=" * 60)
         print(f"Files processed: {self.processed:,}")
         print(f"Errors: {self.errors:,}")
+        if self.guid_filter != "off":
+            print(f"Duplicates skipped before parsing: {self.duplicates:,}")
         print(f"Processing time: {total_time:.2f} seconds")
         print(f"Average rate: {self.processed / total_time:.2f} files/second")
+        if self.index_time is not None:
+            print(f"Index build time: {self.index_time:.2f} seconds")
+
+        if self.write_queue is not None:
+            self.show_pipeline_stats()
 
         # Database statistics
-        conn = sqlite3.connect(self.db_path)
+        self.drain()
+        conn = self.conn
 
         ballot_count = conn.execute("SELECT COUNT(*) FROM cvr_ballots").fetchone()[0]
         contest_count = conn.execute("SELECT COUNT(*) FROM cvr_contests").fetchone()[0]
@@ -429,16 +2546,33 @@ class CvrParser:
         for contest, count in sorted(self.stats["contests"].items()):
             print(f"{contest}: {count:,} instances")
 
-        conn.close()
-
 
 @click.command()
 @click.option(
     "--data-dir",
     "-d",
-    type=click.Path(exists=True, path_type=Path),
-    default=Path("data"),
-    help="Directory containing CVR XML files",
+    "data_dirs",
+    type=click.Path(exists=True, file_okay=False, path_type=Path),
+    multiple=True,
+    help="Directory containing CVR XML files (repeatable; default: data)",
+)
+@click.option(
+    "--zip",
+    "-z",
+    "zip_paths",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    multiple=True,
+    help="ZIP archive to read XML from directly (repeatable)",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Re-parse files and archives even if they are unchanged since their last ingest",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Continue archives left part way through by an interrupted run from their last checkpoint",
 )
 @click.option(
     "--output",
@@ -454,32 +2588,136 @@ class CvrParser:
     default=5000,
     help="Batch size for database operations",
 )
+@click.option(
+    "--workers",
+    "-w",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of parser processes (the main process remains the only writer)",
+)
+@click.option(
+    "--parser",
+    "-p",
+    "parser_name",
+    type=click.Choice(sorted(PARSER_BACKENDS)),
+    default=DEFAULT_PARSER,
+    show_default=True,
+    help="XML parser backend",
+)
+@click.option(
+    "--compact",
+    is_flag=True,
+    help="Create a new database in the dictionary-encoded layout (legacy table names become views)",
+)
+@click.option(
+    "--bulk-load",
+    is_flag=True,
+    help="Load a new database without syncing and with indexes built once at the end",
+)
+@click.option(
+    "--pipeline",
+    "pipeline_depth",
+    type=click.IntRange(min=0),
+    default=0,
+    help="Queue up to N batches for a background writer thread so parsing overlaps commits (0 writes inline)",
+)
+@click.option(
+    "--shards",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Parse and write in N processes, each into its own shard database, then merge the shards",
+)
+@click.option(
+    "--guid-filter",
+    type=click.Choice(GUID_FILTERS),
+    default="set",
+    show_default=True,
+    help="Index of stored GUIDs used to skip duplicate ballots before parsing (bloom: far less memory, hits checked in the database)",
+)
+@click.option(
+    "--precount/--no-precount",
+    default=True,
+    help="Count the XML files first so the progress bar shows a total",
+)
 @click.option("--verbose", "-v", is_flag=True, help="Enable verbose logging")
-def main(data_dir: Path, output: Path, batch_size: int, verbose: bool):
+def main(
+    data_dirs: Tuple[Path, ...],
+    zip_paths: Tuple[Path, ...],
+    force: bool,
+    resume: bool,
+    output: Path,
+    batch_size: int,
+    workers: int,
+    parser_name: str,
+    compact: bool,
+    bulk_load: bool,
+    pipeline_depth: int,
+    shards: int,
+    guid_filter: str,
+    precount: bool,
+    verbose: bool,
+):
     """Parse St. Louis Cast Vote Record XML files into SQLite database."""
 
     if verbose:
         logging.getLogger().setLevel(logging.DEBUG)
 
+    if not data_dirs and not zip_paths:
+        if not Path("data").is_dir():
+            raise click.BadParameter(
+                "Directory 'data' does not exist.", param_hint="'--data-dir'"
+            )
+        data_dirs = (Path("data"),)
+
     logger.info("Starting CVR parsing...")
-    logger.info(f"Data directory: {data_dir}")
+    if data_dirs:
+        logger.info(f"Data directories: {', '.join(str(p) for p in data_dirs)}")
+    if zip_paths:
+        logger.info(f"ZIP archives: {', '.join(str(p) for p in zip_paths)}")
     logger.info(f"Output database: {output}")
     logger.info(f"Batch size: {batch_size}")
+    logger.info(f"Parser workers: {workers}")
+    logger.info(f"Parser backend: {parser_name}")
+    logger.info(f"Layout: {'compact' if compact else 'legacy'}")
+    logger.info(f"Bulk load: {bulk_load}")
+    logger.info(f"Pipeline depth: {pipeline_depth}")
+    logger.info(f"Shards: {shards}")
+    logger.info(f"GUID filter: {guid_filter}")
+
+    with CvrParser(
+        str(output),
+        batch_size,
+        workers,
+        parser_name,
+        compact,
+        bulk_load,
+        pipeline_depth,
+        guid_filter,
+        shards,
+    ) as parser:
+        try:
+            results = parser.ingest(
+                data_dirs, zip_paths, force=force, precount=precount, resume=resume
+            )
+            parser.show_summary()
 
-    parser = CvrParser(str(output), batch_size)
-
-    try:
-        parser.process_directory(data_dir)
-        parser.show_summary()
+        except KeyboardInterrupt:
+            logger.info("Processing interrupted by user")
+            parser.flush_batch()  # Save any pending work
+            parser.build_indexes()
+            parser.show_summary()
+            return
 
-    except KeyboardInterrupt:
-        logger.info("Processing interrupted by user")
-        parser.flush_batch()  # Save any pending work
-        parser.show_summary()
+        except Exception as e:
+            logger.error(f"Fatal error: {e}")
+            raise
 
-    except Exception as e:
-        logger.error(f"Fatal error: {e}")
-        raise
+    failed = [result for result in results if not result.ok]
+    if failed:
+        raise click.ClickException(
+            f"{len(failed)} of {len(results)} sources failed: "
+            + ", ".join(str(result.source) for result in failed)
+        )
 
 
 if __name__ == "__main__":
@@ -3,25 +3,51 @@
 One-shot script to process all St. Louis CVR data from zip files to website database.
 
 This script:
-1. Unzips all ZIP files in ./data/ directory
-2. Parses all CVR XML files into cvr-data.sqlite3
+1. Unzips all ZIP files in ./data/ directory (or, with --stream-zips, reads
+   the XML straight out of each archive)
+2. Parses new or changed CVR XML files and archives into cvr-data.sqlite3 in
+   a single in-process ingest job, retracting ballots from any that were
+   removed since the last run
 3. Generates co-approval analysis for ALL contests automatically
-4. Exports to main ../data.sqlite3 with automatic office name mapping
-5. Is fully idempotent - safe to re-run
+4. Exports to main ../data.sqlite3 with automatic office name mapping,
+   staged in a sidecar database and published in one short transaction
+5. Is fully idempotent - safe to re-run, and re-runs cost time proportional
+   to what changed (use --rebuild to start cvr-data.sqlite3 from scratch)
 
 Usage:
     uv run process-all
+    uv run python process_all.py --stream-zips
+    uv run python process_all.py --rebuild
+    uv run python process_all.py --workers 4
+    uv run python process_all.py --rebuild --shards 8
+    uv run python process_all.py --stream-zips --resume
+    uv run python process_all.py --rebuild --fused
 """
 
 import json
 import logging
 import os
 import sqlite3
-import subprocess  # nosec B404 - Controlled input
+import sys
+import tempfile
 import zipfile
-from collections import Counter, defaultdict
 from pathlib import Path
 
+import click
+from cvr_parser import CvrParser, load_snapshots
+
+# The analysis engine is shared with the other jurisdictions in ../
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from approval_analysis import accumulate_contests  # noqa: E402
+from cvr_export import (  # noqa: E402
+    EXPORT_SCHEMA,
+    MAX_CANDIDATES,
+    delete_source,
+    export_source_id,
+    setup_export_tables,
+)
+from reference_data import ReferenceData  # noqa: E402
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -55,58 +81,117 @@ def unzip_data_files():
     return True
 
 
-def find_xml_directories():
-    """Find all directories containing XML files."""
-    data_dir = Path("./data")
+def find_zip_archives():
+    """Find all ZIP archives in ./data/ directory."""
+    zip_paths = sorted(Path("./data").glob("*.zip"))
+    logger.info(f"Found {len(zip_paths)} ZIP archives:")
+    for zip_path in zip_paths:
+        logger.info(f"  {zip_path}")
+    return zip_paths
+
+
+def find_xml_directories(skip_dirs=()):
+    """Find all directories containing XML files, ignoring any under skip_dirs.
+
+    Walks ./data/ top-down in ``os.walk`` order with one ``os.scandir`` pass
+    per directory, counting XML files by name instead of listing them.
+    """
+    skip_dirs = set(skip_dirs)
     xml_dirs = []
 
-    for root, _dirs, files in os.walk(data_dir):
-        if any(f.endswith(".xml") for f in files):
-            xml_dirs.append(Path(root))
+    pending = [Path("./data")]
+    while pending:
+        directory = pending.pop()
+        xml_count = 0
+        subdirs = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if Path(entry.path) not in skip_dirs:
+                        subdirs.append(Path(entry.path))
+                elif entry.name.endswith(".xml"):
+                    xml_count += 1
+        if xml_count:
+            xml_dirs.append((directory, xml_count))
+        pending.extend(reversed(subdirs))
 
     logger.info(f"Found {len(xml_dirs)} directories with XML files:")
-    for xml_dir in xml_dirs:
-        xml_count = len(list(xml_dir.glob("*.xml")))
+    for xml_dir, xml_count in xml_dirs:
         logger.info(f"  {xml_dir}: {xml_count} XML files")
 
-    return xml_dirs
-
-
-def parse_cvr_data(xml_dirs):
-    """Parse all CVR XML files into cvr-data.sqlite3."""
+    return [xml_dir for xml_dir, _ in xml_dirs]
+
+
+def parse_cvr_data(
+    xml_dirs,
+    zip_paths=(),
+    fresh=False,
+    workers=1,
+    compact=False,
+    pipeline_depth=0,
+    resume=False,
+    shards=1,
+    fused=False,
+    bulk_load=False,
+):
+    """Parse new or changed CVR XML files and archives into cvr-data.sqlite3.
+
+    All directories and archives are ingested in one job sharing a single
+    parser, database connection and worker pool. The parser's ingest
+    manifest skips inputs that are unchanged since the last run. Ballots from
+    inputs that no longer exist are retracted first, so a file moved between
+    directories is re-read from its new location. With ``fresh`` the database
+    is rebuilt from scratch instead, which is also how an existing database
+    switches to the ``compact`` layout. With ``bulk_load`` a new database is
+    written with ``synchronous=OFF`` and its indexes built once at the end.
+    With ``resume``, archives an
+    interrupted run left part way through continue from their checkpoint.
+    ``shards`` splits parsing and writing over that many processes, each with
+    its own shard database, merged into cvr-data.sqlite3 at the end.
+
+    Returns ``(ok, contests)``. With ``fused`` the co-approval analysis is
+    computed from the batches as they are written, and ``contests`` is its
+    ``{contest_name: ApprovalAccumulator}`` when it covers every ballot in
+    the database; otherwise it is None.
+    """
     output_db = "cvr-data.sqlite3"
 
     # Remove existing database for fresh start
-    if Path(output_db).exists():
+    if fresh and Path(output_db).exists():
         logger.info(f"🗑️  Removing existing {output_db}")
         Path(output_db).unlink()
 
-    for xml_dir in xml_dirs:
-        logger.info(f"📊 Processing {xml_dir}...")
-
-        # Run cvr_parser on this directory
-        cmd = [
-            "uv",
-            "run",
-            "python",
-            "cvr_parser.py",
-            "--data-dir",
-            str(xml_dir),
-            "--output",
-            output_db,
-            "--batch-size",
-            "5000",
-        ]
-
-        result = subprocess.run(
-            cmd, capture_output=True, text=True
-        )  # nosec B603 - Controlled input
-        if result.returncode != 0:
-            logger.error(f"Failed to process {xml_dir}: {result.stderr}")
-            return False
+    with CvrParser(
+        output_db,
+        batch_size=5000,
+        workers=workers,
+        compact=compact,
+        bulk_load=bulk_load,
+        pipeline_depth=pipeline_depth,
+        shards=shards,
+        analyze=fused,
+    ) as parser:
+        removed = parser.prune_sources(xml_dirs, zip_paths)
+        if removed:
+            logger.info(f"🗑️  Retracted ballots from {removed} removed inputs")
+
+        logger.info(f"📊 Processing {len(zip_paths) + len(xml_dirs)} sources...")
+        results = parser.ingest(xml_dirs, zip_paths, resume=resume)
+        parser.show_summary()
+        contests = parser.fused_analysis()
+        if fused and contests is None:
+            logger.info(
+                "ℹ️  This run did not write every ballot; the analysis will rescan the database"
+            )
+
+    failed = [result for result in results if not result.ok]
+    for result in failed:
+        logger.error(f"Failed to process {result.source}: {result.error}")
+    if failed:
+        return False, None
 
     logger.info(f"✅ All CVR data parsed into {output_db}")
-    return True
+    return True, contests
 
 
 def normalize_contest_name(contest_name):
@@ -121,149 +206,426 @@ def normalize_contest_name(contest_name):
     return contest_name.lower().replace(" - ", "-").replace(" ", "")
 
 
-def generate_co_approval_analysis(contest_name, cvr_conn):
-    """Generate co-approval analysis for a specific contest."""
+def analyze_all_contests(cvr_conn):
+    """Analyze every contest from a single scan of the selection rows.
 
-    # Get ballot approvals for this contest
+    Returns ``{contest_name: ApprovalAccumulator}`` in the order the
+    contests first appear in the CVR.
+    """
+    # Rows arrive grouped by contest record (one ballot's entry in one
+    # contest), which both layouts can stream without sorting
     query = """
-    SELECT 
-        c.ballot_id,
+    SELECT
+        c.contest_name,
+        s.contest_record_id,
         s.candidate_name
     FROM cvr_contests c
     JOIN cvr_selections s ON c.id = s.contest_record_id
-    WHERE c.contest_name = ? AND s.selection_value = 1
-    ORDER BY c.ballot_id
+    WHERE s.selection_value = 1
+    ORDER BY s.contest_record_id
     """
+    return accumulate_contests(cvr_conn.execute(query))
+
+
+# Election day of the St. Louis reports the contests are matched against
+ELECTION_DATE = "2025-03-04"
+
+# Seconds to wait for readers of data.sqlite3 (the website build) to finish
+# before publishing
+PUBLISH_TIMEOUT = 120
+
+# Pages freed per step of an incremental vacuum; each step is its own short
+# transaction
+VACUUM_STEP_PAGES = 2048
+
+# Analysis tables of data.sqlite3, created if missing
+RESULTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS co_approvals (
+    id INTEGER PRIMARY KEY,
+    report_id INTEGER,
+    candidate_a TEXT,
+    candidate_b TEXT,
+    co_approval_count INTEGER,
+    co_approval_rate REAL,
+    FOREIGN KEY(report_id) REFERENCES reports(id)
+);
+
+CREATE TABLE IF NOT EXISTS voting_patterns (
+    id INTEGER PRIMARY KEY,
+    report_id INTEGER,
+    total_ballots INTEGER,
+    bullet_voting_count INTEGER,
+    bullet_voting_rate REAL,
+    full_approval_count INTEGER,
+    full_approval_rate REAL,
+    average_approvals_per_ballot REAL,
+    most_common_combination TEXT,
+    approval_distribution TEXT,
+    candidate_approval_distributions TEXT,
+    anyone_but_analysis TEXT,
+    FOREIGN KEY(report_id) REFERENCES reports(id)
+);
+
+CREATE TABLE IF NOT EXISTS ballot_profiles (
+    id INTEGER PRIMARY KEY,
+    report_id INTEGER,
+    combination TEXT,
+    ballots INTEGER,
+    FOREIGN KEY(report_id) REFERENCES reports(id)
+);
+"""
+
+# Sidecar tables holding an export until it is published. Rows keep the
+# column names of their data.sqlite3 counterparts; the CVR rows are staged
+# in the compact export tables (EXPORT_SCHEMA) under source id 1.
+STAGING_SCHEMA = """
+CREATE TABLE co_approvals (
+    id INTEGER PRIMARY KEY,
+    report_id INTEGER,
+    candidate_a TEXT,
+    candidate_b TEXT,
+    co_approval_count INTEGER,
+    co_approval_rate REAL
+);
+
+CREATE TABLE voting_patterns (
+    id INTEGER PRIMARY KEY,
+    report_id INTEGER,
+    total_ballots INTEGER,
+    bullet_voting_count INTEGER,
+    bullet_voting_rate REAL,
+    full_approval_count INTEGER,
+    full_approval_rate REAL,
+    average_approvals_per_ballot REAL,
+    most_common_combination TEXT,
+    approval_distribution TEXT,
+    candidate_approval_distributions TEXT,
+    anyone_but_analysis TEXT
+);
+
+CREATE TABLE ballot_profiles (
+    id INTEGER PRIMARY KEY,
+    report_id INTEGER,
+    combination TEXT,
+    ballots INTEGER
+);
+
+CREATE TABLE candidate_votes (
+    id INTEGER PRIMARY KEY,
+    report_id INTEGER,
+    name TEXT,
+    votes INTEGER
+);
+"""
 
-    ballot_approvals = defaultdict(set)
-    for row in cvr_conn.execute(query, (contest_name,)):
-        ballot_approvals[row[0]].add(row[1])
-
-    if len(ballot_approvals) < 2:
-        return [], {}  # Not enough data
-
-    # Get all candidates
-    candidates = set()
-    for approved_candidates in ballot_approvals.values():
-        candidates.update(approved_candidates)
-    candidates = list(candidates)
-
-    if len(candidates) < 2:
-        return [], {}  # Need at least 2 candidates
-
-    # Calculate co-approval matrix
-    co_approvals = []
-    for i, cand_a in enumerate(candidates):
-        for j, cand_b in enumerate(candidates):
-            if i == j:
-                continue
-
-            # Count ballots that approved cand_a
-            cand_a_ballots = [
-                ballot_id
-                for ballot_id, approved in ballot_approvals.items()
-                if cand_a in approved
-            ]
 
-            if len(cand_a_ballots) == 0:
-                continue
+def stage_cvr_tables(stage_conn, cvr_db, report_for):
+    """Encode the CVR ballots and contest records into the staging database.
 
-            # Count how many of those also approved cand_b
-            both_count = sum(
-                1
-                for ballot_id in cand_a_ballots
-                if cand_b in ballot_approvals[ballot_id]
+    Rows are read through the CVR database's legacy table names (views in
+    the compact layout) and keep their ids; the publish step offsets them.
+    The approvals bitmasks are computed in SQLite, from a temporary table
+    giving each contest's candidates their bits in the order they are
+    first seen. ``report_for`` maps a contest name to its report id.
+    """
+    stage_conn.execute("ATTACH DATABASE ? AS cvr", (cvr_db,))
+    with stage_conn:
+        count = stage_conn.execute(
+            """
+            INSERT INTO cvr_export_ballots (
+                id, source_id, cvr_guid, batch_sequence, sheet_number,
+                precinct_name, precinct_id, is_blank, created_at
             )
+            SELECT id, 1, cvr_guid, batch_sequence, sheet_number,
+                   precinct_name, precinct_id, is_blank, created_at
+            FROM cvr.cvr_ballots
+            """
+        ).rowcount
+        logger.info(f"  ✓ Staged {count} ballots")
 
-            co_approval_rate = (both_count / len(cand_a_ballots)) * 100
+        # Contests and candidate bits, numbered in the order first seen
+        stage_conn.execute(
+            """
+            CREATE TEMP TABLE export_contests AS
+            SELECT ROW_NUMBER() OVER (ORDER BY MIN(id)) AS id, contest_name, contest_id
+            FROM cvr.cvr_contests
+            GROUP BY contest_name, contest_id
+            """
+        )
+        stage_conn.execute(
+            "CREATE UNIQUE INDEX temp.idx_export_contests ON export_contests(contest_name, contest_id)"
+        )
+        stage_conn.execute(
+            """
+            CREATE TEMP TABLE candidate_bits AS
+            SELECT k.id AS contest, s.candidate_name, s.candidate_id,
+                   ROW_NUMBER() OVER (PARTITION BY k.id ORDER BY MIN(s.id)) - 1 AS bit
+            FROM cvr.cvr_selections s
+            JOIN cvr.cvr_contests c ON c.id = s.contest_record_id
+            JOIN export_contests k
+                ON k.contest_name = c.contest_name AND k.contest_id IS c.contest_id
+            WHERE s.selection_value = 1
+            GROUP BY k.id, s.candidate_name, s.candidate_id
+            """
+        )
+        stage_conn.execute(
+            "CREATE UNIQUE INDEX temp.idx_candidate_bits ON candidate_bits(contest, candidate_name, candidate_id)"
+        )
+        too_many = stage_conn.execute(
+            """
+            SELECT k.contest_name FROM candidate_bits b
+            JOIN export_contests k ON k.id = b.contest
+            WHERE b.bit >= ?
+            """,
+            (MAX_CANDIDATES,),
+        ).fetchone()
+        if too_many is not None:
+            raise ValueError(f"{too_many[0]} has more than {MAX_CANDIDATES} candidates")
+
+        # Bits are distinct powers of two, so their sum is the bitmask (bit
+        # 63 is SQLite's sign bit, as CompactCvrWriter stores it)
+        count = stage_conn.execute(
+            """
+            INSERT INTO cvr_ballot_approvals (id, ballot_id, contest, undervotes, approvals)
+            SELECT c.id, c.ballot_id, k.id, c.undervotes,
+                   COALESCE(SUM(DISTINCT 1 << b.bit), 0)
+            FROM cvr.cvr_contests c
+            JOIN export_contests k
+                ON k.contest_name = c.contest_name AND k.contest_id IS c.contest_id
+            LEFT JOIN cvr.cvr_selections s
+                ON s.contest_record_id = c.id AND s.selection_value = 1
+            LEFT JOIN candidate_bits b
+                ON b.contest = k.id
+                AND b.candidate_name = s.candidate_name
+                AND b.candidate_id IS s.candidate_id
+            GROUP BY c.id
+            """
+        ).rowcount
+        logger.info(f"  ✓ Staged {count} contest records")
 
-            co_approvals.append(
-                {
-                    "candidateA": cand_a,
-                    "candidateB": cand_b,
-                    "coApprovalCount": both_count,
-                    "coApprovalRate": co_approval_rate,
-                }
+        contests = stage_conn.execute(
+            """
+            SELECT k.id, k.contest_name, k.contest_id, (
+                SELECT json_group_array(json_array(candidate_name, candidate_id))
+                FROM (
+                    SELECT candidate_name, candidate_id FROM candidate_bits
+                    WHERE contest = k.id ORDER BY bit
+                )
             )
+            FROM export_contests k
+            ORDER BY k.id
+            """
+        ).fetchall()
+        stage_conn.executemany(
+            """
+            INSERT INTO cvr_export_contests (id, source_id, report_id, contest_name, contest_id, candidates)
+            VALUES (?, 1, ?, ?, ?, ?)
+            """,
+            (
+                (contest, report_for(name), name, contest_id, candidates)
+                for contest, name, contest_id, candidates in contests
+            ),
+        )
+        logger.info(f"  ✓ Staged {len(contests)} contest candidate lists")
+        stage_conn.execute("DROP TABLE candidate_bits")
+        stage_conn.execute("DROP TABLE export_contests")
+    stage_conn.execute("DETACH DATABASE cvr")
 
-    # Calculate voting patterns
-    total_ballots = len(ballot_approvals)
-    approval_distribution = Counter()
 
-    for approved_candidates in ballot_approvals.values():
-        approval_distribution[len(approved_candidates)] += 1
+def publish_staged_export(main_conn, staging_db, source):
+    """Swap a staged export into the main database in one transaction.
 
-    bullet_voting_count = approval_distribution[1]
-    full_approval_count = approval_distribution[len(candidates)]
+    Everything is computed beforehand, so the transaction only deletes the
+    previous rows and copies the staged ones. Readers see either the old
+    export or the new one, never a contest half way through.
+    """
+    # Keep the whole transaction in memory, so readers are only locked out
+    # while it is written at commit rather than from the first cache spill
+    main_conn.execute("PRAGMA cache_size = -262144")  # 256MB
+    main_conn.execute("ATTACH DATABASE ? AS staged", (staging_db,))
+    try:
+        with main_conn:
+            main_conn.execute("BEGIN IMMEDIATE")
 
-    # Find most common combination
-    combination_counts = Counter()
-    for approved_candidates in ballot_approvals.values():
-        if len(approved_candidates) > 0:
-            combination_counts[tuple(sorted(approved_candidates))] += 1
+            # Analysis results, replaced per report
+            staged_reports = "SELECT report_id FROM staged.voting_patterns"
+            main_conn.execute(
+                f"DELETE FROM co_approvals WHERE report_id IN ({staged_reports})"  # nosec B608 - Fixed query
+            )
+            main_conn.execute(
+                f"DELETE FROM voting_patterns WHERE report_id IN ({staged_reports})"  # nosec B608 - Fixed query
+            )
+            main_conn.execute(
+                f"DELETE FROM ballot_profiles WHERE report_id IN ({staged_reports})"  # nosec B608 - Fixed query
+            )
+            main_conn.execute(
+                """
+                INSERT INTO co_approvals (report_id, candidate_a, candidate_b, co_approval_count, co_approval_rate)
+                SELECT report_id, candidate_a, candidate_b, co_approval_count, co_approval_rate
+                FROM staged.co_approvals ORDER BY id
+                """
+            )
+            main_conn.execute(
+                """
+                INSERT INTO voting_patterns (
+                    report_id, total_ballots, bullet_voting_count, bullet_voting_rate,
+                    full_approval_count, full_approval_rate, average_approvals_per_ballot,
+                    most_common_combination, approval_distribution, candidate_approval_distributions,
+                    anyone_but_analysis
+                )
+                SELECT
+                    report_id, total_ballots, bullet_voting_count, bullet_voting_rate,
+                    full_approval_count, full_approval_rate, average_approvals_per_ballot,
+                    most_common_combination, approval_distribution, candidate_approval_distributions,
+                    anyone_but_analysis
+                FROM staged.voting_patterns ORDER BY id
+                """
+            )
+            main_conn.execute(
+                """
+                INSERT INTO ballot_profiles (report_id, combination, ballots)
+                SELECT report_id, combination, ballots
+                FROM staged.ballot_profiles ORDER BY id
+                """
+            )
 
-    most_common_combination = (
-        list(combination_counts.most_common(1)[0][0]) if combination_counts else []
-    )
+            # Ballot and vote counts from the CVR (the last staged row wins)
+            main_conn.execute(
+                """
+                UPDATE reports SET ballotCount = (
+                    SELECT v.total_ballots FROM staged.voting_patterns v
+                    WHERE v.report_id = reports.id ORDER BY v.id DESC LIMIT 1
+                )
+                WHERE id IN (SELECT report_id FROM staged.voting_patterns)
+                """
+            )
+            main_conn.execute(
+                """
+                UPDATE candidates SET votes = (
+                    SELECT v.votes FROM staged.candidate_votes v
+                    WHERE v.report_id = candidates.report_id AND v.name = candidates.name
+                    ORDER BY v.id DESC LIMIT 1
+                )
+                WHERE EXISTS (
+                    SELECT 1 FROM staged.candidate_votes v
+                    WHERE v.report_id = candidates.report_id AND v.name = candidates.name
+                )
+                """
+            )
 
-    total_approvals = sum(len(approved) for approved in ballot_approvals.values())
-    average_approvals = total_approvals / total_ballots if total_ballots > 0 else 0
+            # CVR rows. Ids are shifted past the main database's current
+            # maxima, so the references carry over with the same offsets.
+            source_id = export_source_id(main_conn, source)
+            delete_source(main_conn, source_id)
+            offsets = [
+                main_conn.execute(
+                    f"SELECT COALESCE(MAX(id), 0) FROM main.{table}"  # nosec B608 - Fixed table names
+                ).fetchone()[0]
+                for table in (
+                    "cvr_export_ballots",
+                    "cvr_export_contests",
+                    "cvr_ballot_approvals",
+                )
+            ]
+            ballot_offset, contest_offset, record_offset = offsets
 
-    # Calculate candidate-specific approval distributions
-    candidate_approval_distributions = {}
-    for candidate in candidates:
-        # Get all ballots that approved this candidate
-        candidate_ballots = [
-            ballot_id
-            for ballot_id, approved in ballot_approvals.items()
-            if candidate in approved
-        ]
+            cursor = main_conn.execute(
+                """
+                INSERT INTO main.cvr_export_ballots (id, source_id, cvr_guid, batch_sequence, sheet_number, precinct_name, precinct_id, is_blank, created_at)
+                SELECT id + ?, ?, cvr_guid, batch_sequence, sheet_number, precinct_name, precinct_id, is_blank, created_at
+                FROM staged.cvr_export_ballots ORDER BY id
+                """,
+                (ballot_offset, source_id),
+            )
+            logger.info(f"  ✓ Published {cursor.rowcount} ballots")
+            cursor = main_conn.execute(
+                """
+                INSERT INTO main.cvr_export_contests (id, source_id, report_id, contest_name, contest_id, candidates)
+                SELECT id + ?, ?, report_id, contest_name, contest_id, candidates
+                FROM staged.cvr_export_contests ORDER BY id
+                """,
+                (contest_offset, source_id),
+            )
+            logger.info(f"  ✓ Published {cursor.rowcount} contests")
+            cursor = main_conn.execute(
+                """
+                INSERT INTO main.cvr_ballot_approvals (id, ballot_id, contest, undervotes, approvals)
+                SELECT id + ?, ballot_id + ?, contest + ?, undervotes, approvals
+                FROM staged.cvr_ballot_approvals ORDER BY id
+                """,
+                (record_offset, ballot_offset, contest_offset),
+            )
+            logger.info(f"  ✓ Published {cursor.rowcount} contest records")
 
-        if not candidate_ballots:
-            continue
+        # Report any staged vote count that did not land on a candidate row
+        for report_id, name, votes, current in main_conn.execute(
+            """
+            SELECT v.report_id, v.name, v.votes, c.votes
+            FROM staged.candidate_votes v
+            JOIN candidates c ON c.report_id = v.report_id AND c.name = v.name
+            WHERE c.votes IS NOT v.votes
+            """
+        ):
+            logger.warning(
+                f"    Vote count mismatch for {name} (report {report_id}): expected {votes}, got {current}"
+            )
+    finally:
+        main_conn.execute("DETACH DATABASE staged")
 
-        # For each of these ballots, count how many total candidates they approved
-        candidate_distribution = Counter()
-        for ballot_id in candidate_ballots:
-            total_approvals_on_ballot = len(ballot_approvals[ballot_id])
-            candidate_distribution[total_approvals_on_ballot] += 1
-
-        candidate_approval_distributions[candidate] = dict(candidate_distribution)
-
-    # Calculate "Anyone But X" analysis - ballots with exactly N-1 approvals
-    anyone_but_analysis = {}
-    num_candidates = len(candidates)
-    anyone_but_ballots = 0
-
-    for _ballot_id, approved_candidates in ballot_approvals.items():
-        if len(approved_candidates) == num_candidates - 1:  # N-1 approvals
-            anyone_but_ballots += 1
-            # Find the one candidate that was NOT approved
-            excluded_candidates = set(candidates) - approved_candidates
-            if len(excluded_candidates) == 1:
-                excluded_candidate = list(excluded_candidates)[0]
-                anyone_but_analysis[excluded_candidate] = (
-                    anyone_but_analysis.get(excluded_candidate, 0) + 1
-                )
 
-    voting_patterns = {
-        "totalBallots": total_ballots,
-        "bulletVotingCount": bullet_voting_count,
-        "bulletVotingRate": (bullet_voting_count / total_ballots) * 100,
-        "fullApprovalCount": full_approval_count,
-        "fullApprovalRate": (full_approval_count / total_ballots) * 100,
-        "averageApprovalsPerBallot": average_approvals,
-        "mostCommonCombination": most_common_combination,
-        "approvalDistribution": dict(approval_distribution),
-        "candidateApprovalDistributions": candidate_approval_distributions,
-        "anyoneButAnalysis": anyone_but_analysis,
-    }
+def enable_incremental_vacuum(conn):
+    """Switch a database to incremental auto-vacuum with one full VACUUM.
+
+    The VACUUM rewrites the whole file and locks out readers and writers
+    until it finishes, so it is a separate step from ``incremental_vacuum``.
+    """
+    (mode,) = conn.execute("PRAGMA auto_vacuum").fetchone()
+    if mode == 2:
+        logger.info("🧹 Incremental auto-vacuum is already enabled")
+        return
+    logger.info("🧹 Enabling incremental auto-vacuum (full VACUUM)...")
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
 
-    return co_approvals, voting_patterns
 
+def incremental_vacuum(conn):
+    """Return free pages to the filesystem in short steps.
 
-def export_to_main_database():
-    """Export all co-approval data to main database with automatic mapping."""
+    This needs a database in incremental auto-vacuum mode (see
+    ``enable_incremental_vacuum``); any other is left as it is.
+    """
+    (mode,) = conn.execute("PRAGMA auto_vacuum").fetchone()
+    if mode != 2:
+        logger.warning(
+            "⚠️  data.sqlite3 does not use incremental auto-vacuum; convert it once with --enable-incremental-vacuum"
+        )
+        return
+
+    freed = 0
+    while True:
+        (free_pages,) = conn.execute("PRAGMA freelist_count").fetchone()
+        if not free_pages:
+            break
+        conn.execute(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})").fetchall()
+        freed += min(free_pages, VACUUM_STEP_PAGES)
+    logger.info(f"🧹 Freed {freed} pages")
+
+
+def export_to_main_database(vacuum=False, contests=None, enable_vacuum=False):
+    """Export all co-approval data to main database with automatic mapping.
+
+    The export is staged: every contest is analysed and every row written to
+    a sidecar database first, with data.sqlite3 only read. The results are
+    then swapped in with one short transaction (``publish_staged_export``),
+    so the website build never sees a half-exported contest. With ``vacuum``
+    the pages freed by the old rows are then released a step at a time;
+    ``enable_vacuum`` first switches data.sqlite3 to incremental
+    auto-vacuum, with a full VACUUM.
+    ``contests`` is an analysis already computed during ingest (see
+    ``parse_cvr_data``); without it the analysis snapshots stored with each
+    ingested batch are merged, so a new wave of CVR files only costs its own
+    ballots. The CVR database is scanned only if the snapshots are missing.
+    """
     cvr_db = "cvr-data.sqlite3"
     main_db = "../../data.sqlite3"
 
@@ -276,108 +638,10 @@ def export_to_main_database():
         return False
 
     cvr_conn = sqlite3.connect(cvr_db)
-    main_conn = sqlite3.connect(main_db)
-
-    def create_candidate_name_mapping(contest_name, main_report_id, cvr_candidates):
-        """Create mapping from CVR names (ALL CAPS) to proper database names."""
-        # Get proper candidate names from main database
-        proper_candidates = main_conn.execute(
-            "SELECT name FROM candidates WHERE report_id = ?", (main_report_id,)
-        ).fetchall()
-        proper_names = [row[0] for row in proper_candidates]
-
-        # Create mapping by normalized matching
-        mapping = {}
-
-        def normalize_for_match(name):
-            return (
-                name.upper()
-                .replace('"', '"')
-                .replace('"', '"')
-                .replace(".", "")
-                .replace(" ", "")
-            )
-
-        for cvr_name in cvr_candidates:
-            normalized_cvr = normalize_for_match(cvr_name)
-            for proper_name in proper_names:
-                normalized_proper = normalize_for_match(proper_name)
-                if normalized_cvr == normalized_proper:
-                    mapping[cvr_name] = proper_name
-                    break
-
-        return mapping
+    main_conn = sqlite3.connect(main_db, timeout=PUBLISH_TIMEOUT)
 
     # Create tables if they don't exist
-    main_conn.executescript(
-        """
-        CREATE TABLE IF NOT EXISTS co_approvals (
-            id INTEGER PRIMARY KEY,
-            report_id INTEGER,
-            candidate_a TEXT,
-            candidate_b TEXT,
-            co_approval_count INTEGER,
-            co_approval_rate REAL,
-            FOREIGN KEY(report_id) REFERENCES reports(id)
-        );
-        
-        CREATE TABLE IF NOT EXISTS voting_patterns (
-            id INTEGER PRIMARY KEY,
-            report_id INTEGER,
-            total_ballots INTEGER,
-            bullet_voting_count INTEGER,
-            bullet_voting_rate REAL,
-            full_approval_count INTEGER,
-            full_approval_rate REAL,
-            average_approvals_per_ballot REAL,
-            most_common_combination TEXT,
-            approval_distribution TEXT,
-            candidate_approval_distributions TEXT,
-            anyone_but_analysis TEXT,
-            FOREIGN KEY(report_id) REFERENCES reports(id)
-        );
-        
-        CREATE TABLE IF NOT EXISTS cvr_ballots (
-            id INTEGER PRIMARY KEY,
-            source TEXT NOT NULL,
-            cvr_guid TEXT NOT NULL,
-            batch_sequence INTEGER,
-            sheet_number INTEGER,
-            precinct_name TEXT,
-            precinct_id TEXT,
-            is_blank BOOLEAN,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(source, cvr_guid)
-        );
-        
-        CREATE TABLE IF NOT EXISTS cvr_contests (
-            id INTEGER PRIMARY KEY,
-            source TEXT NOT NULL,
-            ballot_id INTEGER,
-            contest_name TEXT NOT NULL,
-            contest_id TEXT NOT NULL,
-            undervotes INTEGER,
-            FOREIGN KEY(ballot_id) REFERENCES cvr_ballots(id)
-        );
-        
-        CREATE TABLE IF NOT EXISTS cvr_selections (
-            id INTEGER PRIMARY KEY,
-            source TEXT NOT NULL,
-            contest_record_id INTEGER,
-            candidate_name TEXT NOT NULL,
-            candidate_id TEXT NOT NULL,
-            selection_value INTEGER,
-            FOREIGN KEY(contest_record_id) REFERENCES cvr_contests(id)
-        );
-        
-        CREATE INDEX IF NOT EXISTS idx_cvr_source_guid ON cvr_ballots(source, cvr_guid);
-        CREATE INDEX IF NOT EXISTS idx_cvr_source_precinct ON cvr_ballots(source, precinct_id);
-        CREATE INDEX IF NOT EXISTS idx_cvr_source_contest ON cvr_contests(source, contest_id);
-        CREATE INDEX IF NOT EXISTS idx_cvr_source_ballot_contest ON cvr_contests(source, ballot_id, contest_id);
-        CREATE INDEX IF NOT EXISTS idx_cvr_source_candidate ON cvr_selections(source, candidate_id);
-        CREATE INDEX IF NOT EXISTS idx_cvr_source_contest_selection ON cvr_selections(source, contest_record_id, candidate_id);
-    """
-    )
+    main_conn.executescript(RESULTS_SCHEMA)
 
     # Add anyone_but_analysis column if it doesn't exist (migration for existing databases)
     try:
@@ -394,52 +658,58 @@ def export_to_main_database():
             logger.warning(f"Could not add anyone_but_analysis column: {e}")
             # Continue anyway - might not be a critical error
 
-    # Get all contests from CVR
-    contests = cvr_conn.execute(
-        "SELECT DISTINCT contest_name FROM cvr_contests"
-    ).fetchall()
+    # Ballot-level CVR tables (converted from the normalized ones if needed)
+    setup_export_tables(main_conn)
+
+    # Stage the new results in a sidecar database next to the CVR database
+    staging_dir = tempfile.TemporaryDirectory(prefix="export-", dir=".")
+    staging_db = os.path.join(staging_dir.name, "staging.sqlite3")
+    stage_conn = sqlite3.connect(staging_db)
+    stage_conn.execute("PRAGMA journal_mode = OFF")
+    stage_conn.execute("PRAGMA synchronous = OFF")
+    stage_conn.executescript(STAGING_SCHEMA)
+    stage_conn.executescript(EXPORT_SCHEMA)
+
+    # Reports and candidates of this election, loaded once for all contests
+    reference = ReferenceData.load(main_conn, "date = ?", (ELECTION_DATE,))
+
+    # Use the analysis from the ingest if there is one; otherwise merge the
+    # per-batch snapshots, and only scan the CVR if those are incomplete
+    if contests is not None:
+        logger.info("🔄 Using the analysis computed during ingest")
+    else:
+        contests = load_snapshots(cvr_conn)
+        if contests is not None:
+            logger.info("🔄 Merged the stored analysis snapshots")
+        else:
+            logger.info("🔄 Analyzing all contests...")
+            contests = analyze_all_contests(cvr_conn)
+    cvr_conn.close()
 
-    for (contest_name,) in contests:
+    for contest_name, accumulator in contests.items():
         logger.info(f"🔄 Processing {contest_name}...")
 
         # Normalize contest name to match office field
         office_name = normalize_contest_name(contest_name)
 
         # Find matching report (with date constraint for St. Louis)
-        report_result = main_conn.execute(
-            "SELECT id FROM reports WHERE office = ? AND date = ?",
-            (office_name, "2025-03-04"),
-        ).fetchone()
+        report_id = reference.report_id(office=office_name)
 
-        if not report_result:
+        if report_id is None:
             logger.warning(
                 f"  No matching report found for contest '{contest_name}' -> office '{office_name}'"
             )
             continue
 
-        report_id = report_result[0]
         logger.info(f"  ✓ Found report_id: {report_id}")
 
-        # Generate co-approval analysis
-        co_approvals, voting_patterns = generate_co_approval_analysis(
-            contest_name, cvr_conn
-        )
-
-        # Get CVR candidates to create name mapping
-        cvr_candidates_query = """
-        SELECT DISTINCT s.candidate_name 
-        FROM cvr_contests c
-        JOIN cvr_selections s ON c.id = s.contest_record_id
-        WHERE c.contest_name = ?
-        """
-        cvr_candidate_names = [
-            row[0] for row in cvr_conn.execute(cvr_candidates_query, (contest_name,))
-        ]
+        # Generate co-approval analysis (needs 2+ ballots and 2+ candidates)
+        co_approvals, voting_patterns = [], {}
+        if accumulator.total_ballots >= 2 and len(accumulator.names) >= 2:
+            co_approvals, voting_patterns = accumulator.result()
 
         # Create name mapping and update both co-approvals and voting patterns
-        name_mapping = create_candidate_name_mapping(
-            contest_name, report_id, cvr_candidate_names
-        )
+        name_mapping = reference.name_mapping(report_id, accumulator.names)
 
         # Update co-approvals to use proper database names
         for ca in co_approvals:
@@ -470,30 +740,40 @@ def export_to_main_database():
             logger.warning(f"  No co-approval data generated for {contest_name}")
             continue
 
-        # Clear existing data for this report (idempotent)
-        main_conn.execute("DELETE FROM co_approvals WHERE report_id = ?", (report_id,))
-        main_conn.execute(
-            "DELETE FROM voting_patterns WHERE report_id = ?", (report_id,)
-        )
-
-        # Insert co-approval data
-        for ca in co_approvals:
-            main_conn.execute(
-                """
-                INSERT INTO co_approvals (report_id, candidate_a, candidate_b, co_approval_count, co_approval_rate)
-                VALUES (?, ?, ?, ?, ?)
-            """,
+        # Stage co-approval data (replaces this report's rows on publish)
+        stage_conn.executemany(
+            """
+            INSERT INTO co_approvals (report_id, candidate_a, candidate_b, co_approval_count, co_approval_rate)
+            VALUES (?, ?, ?, ?, ?)
+        """,
+            (
                 (
                     report_id,
                     ca["candidateA"],
                     ca["candidateB"],
                     ca["coApprovalCount"],
                     ca["coApprovalRate"],
-                ),
-            )
+                )
+                for ca in co_approvals
+            ),
+        )
 
-        # Insert voting patterns
-        main_conn.execute(
+        # Stage the weighted ballot profile the analysis was computed from,
+        # in the report's spelling of the candidate names
+        stage_conn.executemany(
+            "INSERT INTO ballot_profiles (report_id, combination, ballots) VALUES (?, ?, ?)",
+            (
+                (
+                    report_id,
+                    json.dumps(sorted({name_mapping.get(n, n) for n in names})),
+                    count,
+                )
+                for names, count in accumulator.combinations()
+            ),
+        )
+
+        # Stage voting patterns
+        stage_conn.execute(
             """
             INSERT INTO voting_patterns (
                 report_id, total_ballots, bullet_voting_count, bullet_voting_rate,
@@ -517,162 +797,95 @@ def export_to_main_database():
             ),
         )
 
-        # Update the reports table with accurate ballot count from CVR
+        # The report's ballot count is set from total_ballots on publish
         logger.info(
             f"  Updating report ballot count to {voting_patterns['totalBallots']}"
         )
-        main_conn.execute(
-            """
-            UPDATE reports 
-            SET ballotCount = ? 
-            WHERE id = ?
-        """,
-            (voting_patterns["totalBallots"], report_id),
-        )
 
-        # Update candidate vote counts from CVR data
+        # Stage candidate vote counts from CVR data
         logger.info("  Updating candidate vote counts from CVR data")
 
-        # Get candidate vote counts from CVR
-        candidate_votes_query = """
-            SELECT s.candidate_name, COUNT(*) as approvals 
-            FROM cvr_ballots b 
-            JOIN cvr_contests c ON b.id = c.ballot_id 
-            JOIN cvr_selections s ON c.id = s.contest_record_id 
-            WHERE c.contest_name = ? AND s.selection_value = 1 
-            GROUP BY s.candidate_name
-        """
-
-        cvr_candidate_votes = cvr_conn.execute(
-            candidate_votes_query, (contest_name,)
-        ).fetchall()
-
-        # Update each candidate's vote count using the name mapping
-        for cvr_name, vote_count in cvr_candidate_votes:
+        # Stage each candidate's vote count using the name mapping
+        candidate_votes = []
+        for cvr_name, vote_count in sorted(accumulator.approval_counts().items()):
             proper_name = name_mapping.get(cvr_name, cvr_name)
             logger.info(f"    Updating {proper_name}: {vote_count} votes")
-
-            main_conn.execute(
-                """
-                UPDATE candidates 
-                SET votes = ? 
-                WHERE report_id = ? AND name = ?
-            """,
-                (vote_count, report_id, proper_name),
-            )
-
-            # Verify the update worked
-            updated_count = main_conn.execute(
-                """
-                SELECT votes FROM candidates 
-                WHERE report_id = ? AND name = ?
-            """,
-                (report_id, proper_name),
-            ).fetchone()
-
-            if updated_count and updated_count[0] != vote_count:
-                logger.warning(
-                    f"    Vote count mismatch for {proper_name}: expected {vote_count}, got {updated_count[0]}"
-                )
+            candidate_votes.append((report_id, proper_name, vote_count))
+        stage_conn.executemany(
+            "INSERT INTO candidate_votes (report_id, name, votes) VALUES (?, ?, ?)",
+            candidate_votes,
+        )
 
         logger.info(
-            f"  ✅ Exported {len(co_approvals)} co-approval entries and voting patterns"
+            f"  ✅ Staged {len(co_approvals)} co-approval entries and voting patterns"
         )
 
-    # Export CVR tables to main database
-    logger.info("\n📦 Exporting CVR tables to main database...")
-    source = "st_louis"
-
-    # Delete existing St. Louis CVR data (idempotent)
-    main_conn.execute("DELETE FROM cvr_selections WHERE source = ?", (source,))
-    main_conn.execute("DELETE FROM cvr_contests WHERE source = ?", (source,))
-    main_conn.execute("DELETE FROM cvr_ballots WHERE source = ?", (source,))
-
-    # Copy ballots
-    logger.info("  Copying cvr_ballots...")
-    ballots = cvr_conn.execute(
-        "SELECT cvr_guid, batch_sequence, sheet_number, precinct_name, precinct_id, is_blank, created_at FROM cvr_ballots"
-    ).fetchall()
-    main_conn.executemany(
-        "INSERT INTO cvr_ballots (source, cvr_guid, batch_sequence, sheet_number, precinct_name, precinct_id, is_blank, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-        [(source,) + ballot for ballot in ballots],
-    )
-    logger.info(f"  ✓ Copied {len(ballots)} ballots")
+    stage_conn.commit()
 
-    # Create mapping from old ballot IDs to new ballot IDs
-    ballot_id_map = {}
-    for old_id, (cvr_guid,) in enumerate(
-        cvr_conn.execute("SELECT cvr_guid FROM cvr_ballots ORDER BY id").fetchall(), 1
-    ):
-        new_id = main_conn.execute(
-            "SELECT id FROM cvr_ballots WHERE source = ? AND cvr_guid = ?",
-            (source, cvr_guid),
-        ).fetchone()[0]
-        ballot_id_map[old_id] = new_id
-
-    # Copy contests
-    logger.info("  Copying cvr_contests...")
-    contest_id_map = {}
-    cursor = main_conn.cursor()
-    for row in cvr_conn.execute(
-        "SELECT id, ballot_id, contest_name, contest_id, undervotes FROM cvr_contests ORDER BY id"
-    ).fetchall():
-        old_id, ballot_id, contest_name, contest_id, undervotes = row
-        new_ballot_id = ballot_id_map[ballot_id]
-        cursor.execute(
-            "INSERT INTO cvr_contests (source, ballot_id, contest_name, contest_id, undervotes) VALUES (?, ?, ?, ?, ?)",
-            (source, new_ballot_id, contest_name, contest_id, undervotes),
-        )
-        # Get the last inserted rowid
-        new_id = cursor.lastrowid
-        contest_id_map[old_id] = new_id
-
-    logger.info(f"  ✓ Copied {len(contest_id_map)} contests")
-
-    # Copy selections
-    logger.info("  Copying cvr_selections...")
-    selections = []
-    for row in cvr_conn.execute(
-        "SELECT id, contest_record_id, candidate_name, candidate_id, selection_value FROM cvr_selections ORDER BY id"
-    ).fetchall():
-        old_id, contest_record_id, candidate_name, candidate_id, selection_value = row
-        new_contest_id = contest_id_map[contest_record_id]
-        selections.append(
-            (source, new_contest_id, candidate_name, candidate_id, selection_value)
+    try:
+        logger.info("\n📦 Staging CVR tables...")
+        stage_cvr_tables(
+            stage_conn,
+            cvr_db,
+            lambda name: reference.report_id(office=normalize_contest_name(name)),
         )
+        stage_conn.close()
 
-    main_conn.executemany(
-        "INSERT INTO cvr_selections (source, contest_record_id, candidate_name, candidate_id, selection_value) VALUES (?, ?, ?, ?, ?)",
-        selections,
-    )
-    logger.info(f"  ✓ Copied {len(selections)} selections")
+        logger.info("📤 Publishing to main database...")
+        publish_staged_export(main_conn, staging_db, "st_louis")
 
-    main_conn.commit()
-    cvr_conn.close()
-    main_conn.close()
+        if enable_vacuum:
+            enable_incremental_vacuum(main_conn)
+        elif vacuum:
+            incremental_vacuum(main_conn)
+    finally:
+        stage_conn.close()
+        staging_dir.cleanup()
+        main_conn.close()
 
     logger.info("🎉 All data exported to main database!")
     return True
 
 
-def main():
+def main(
+    stream_zips=False,
+    rebuild=False,
+    workers=1,
+    compact=False,
+    pipeline_depth=0,
+    resume=False,
+    shards=1,
+    vacuum=False,
+    fused=False,
+    bulk_load=False,
+    enable_vacuum=False,
+):
     """Main entry point."""
     logger.info("🚀 Starting complete St. Louis CVR processing...")
 
-    # Step 1: Unzip data files
-    logger.info("\n" + "=" * 60)
-    logger.info("STEP 1: Unzipping data files")
-    logger.info("=" * 60)
-    if not unzip_data_files():
-        logger.error("❌ Failed to unzip data files")
-        return 1
-
-    # Step 2: Find XML directories
+    if stream_zips:
+        # Step 1: Read archives in place instead of extracting them
+        logger.info("\n" + "=" * 60)
+        logger.info("STEP 1: Finding ZIP archives (streaming, no extraction)")
+        logger.info("=" * 60)
+        zip_paths = find_zip_archives()
+    else:
+        # Step 1: Unzip data files
+        logger.info("\n" + "=" * 60)
+        logger.info("STEP 1: Unzipping data files")
+        logger.info("=" * 60)
+        if not unzip_data_files():
+            logger.error("❌ Failed to unzip data files")
+            return 1
+        zip_paths = []
+
+    # Step 2: Find XML directories (leftover extractions of streamed archives
+    # would only be parsed again as duplicates)
     logger.info("\n" + "=" * 60)
     logger.info("STEP 2: Finding XML files")
     logger.info("=" * 60)
-    xml_dirs = find_xml_directories()
-    if not xml_dirs:
+    xml_dirs = find_xml_directories(skip_dirs=[p.with_suffix("") for p in zip_paths])
+    if not xml_dirs and not zip_paths:
         logger.error("❌ No XML files found!")
         return 1
 
@@ -680,7 +893,19 @@ def main():
     logger.info("\n" + "=" * 60)
     logger.info("STEP 3: Parsing CVR data")
     logger.info("=" * 60)
-    if not parse_cvr_data(xml_dirs):
+    ok, contests = parse_cvr_data(
+        xml_dirs,
+        zip_paths,
+        fresh=rebuild,
+        workers=workers,
+        compact=compact,
+        pipeline_depth=pipeline_depth,
+        resume=resume,
+        shards=shards,
+        fused=fused,
+        bulk_load=bulk_load,
+    )
+    if not ok:
         logger.error("❌ Failed to parse CVR data")
         return 1
 
@@ -688,7 +913,9 @@ def main():
     logger.info("\n" + "=" * 60)
     logger.info("STEP 4: Exporting to main database")
     logger.info("=" * 60)
-    if not export_to_main_database():
+    if not export_to_main_database(
+        vacuum=vacuum, contests=contests, enable_vacuum=enable_vacuum
+    ):
         logger.error("❌ Failed to export to main database")
         return 1
 
@@ -698,5 +925,98 @@ def main():
     return 0
 
 
+@click.command()
+@click.option(
+    "--stream-zips",
+    is_flag=True,
+    help="Read XML straight out of ./data/*.zip instead of extracting the archives",
+)
+@click.option(
+    "--rebuild",
+    is_flag=True,
+    help="Delete cvr-data.sqlite3 and reparse everything instead of ingesting only changes",
+)
+@click.option(
+    "--workers",
+    "-w",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of processes used to parse XML files",
+)
+@click.option(
+    "--compact",
+    is_flag=True,
+    help="Store a new cvr-data.sqlite3 in the dictionary-encoded layout",
+)
+@click.option(
+    "--bulk-load",
+    is_flag=True,
+    help="Write a new cvr-data.sqlite3 with synchronous=OFF and build its indexes at the end (a crash can corrupt it; rerun with --rebuild)",
+)
+@click.option(
+    "--pipeline",
+    "pipeline_depth",
+    type=click.IntRange(min=0),
+    default=0,
+    help="Queue up to N parsed batches for a background writer thread (0 writes inline)",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Continue archives an interrupted run left part way through from their last checkpoint",
+)
+@click.option(
+    "--shards",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Parse and write in N processes with a shard database each, merged at the end",
+)
+@click.option(
+    "--vacuum",
+    is_flag=True,
+    help="After publishing, release the main database's free pages in short incremental vacuum steps (needs --enable-incremental-vacuum once first)",
+)
+@click.option(
+    "--enable-incremental-vacuum",
+    "enable_vacuum",
+    is_flag=True,
+    help="After publishing, switch data.sqlite3 to incremental auto-vacuum with a one-time full VACUUM, which rewrites the whole file and locks out readers and writers until it finishes",
+)
+@click.option(
+    "--fused",
+    is_flag=True,
+    help="Compute the co-approval analysis while parsing instead of re-reading cvr-data.sqlite3 (used when the run writes every ballot, e.g. with --rebuild)",
+)
+def cli(
+    stream_zips,
+    rebuild,
+    workers,
+    compact,
+    pipeline_depth,
+    resume,
+    shards,
+    vacuum,
+    enable_vacuum,
+    fused,
+    bulk_load,
+):
+    """Process all St. Louis CVR data from zip files to website database."""
+    sys.exit(
+        main(
+            stream_zips=stream_zips,
+            rebuild=rebuild,
+            workers=workers,
+            compact=compact,
+            pipeline_depth=pipeline_depth,
+            resume=resume,
+            shards=shards,
+            vacuum=vacuum,
+            enable_vacuum=enable_vacuum,
+            fused=fused,
+            bulk_load=bulk_load,
+        )
+    )
+
+
 if __name__ == "__main__":
-    exit(main())
+    cli()
@@ -4,7 +4,7 @@ Process Utah CVR data from JSON format and export to main database.
 
 This script:
 1. Loads Utah CVR data from JSON
-2. Creates CVR tables in main database (if needed)
+2. Creates the compact CVR export tables in main database (if needed)
 3. Exports CVR data with source='utah'
 4. Generates co-approval analysis and voting patterns
 
@@ -15,9 +15,24 @@ After running this script, you can validate the results by running:
 import json
 import logging
 import sqlite3
-from collections import Counter, defaultdict
+import sys
 from pathlib import Path
 
+# The analysis engine is shared with the other jurisdictions in ../
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from approval_analysis import (  # noqa: E402
+    ApprovalAccumulator,
+    analyze_profile,
+    ballot_profile,
+)
+from cvr_export import (  # noqa: E402
+    CompactCvrWriter,
+    delete_source,
+    export_source_id,
+    setup_export_tables,
+)
+from reference_data import ReferenceData  # noqa: E402
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -25,167 +40,19 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def generate_co_approval_analysis(ballots_data, candidates):
-    """Generate co-approval analysis from ballot data."""
-    total_ballots = len(ballots_data)
-
-    # Build mapping of candidate to set of ballot indices that approved them
-    candidate_ballots = defaultdict(set)
-    for idx, ballot in enumerate(ballots_data):
-        for key in sorted(ballot.keys()):
-            if key.startswith("vote_") and ballot[key]:
-                candidate_ballots[ballot[key]].add(idx)
-
-    # Calculate co-approval matrix
-    # For each pair (A, B), calculate: of voters who approved A, what % also approved B?
-    co_approval_list = []
-    for i, cand_a in enumerate(candidates):
-        for j, cand_b in enumerate(candidates):
-            if i == j:
-                continue
-
-            # Get ballots that approved candidate A
-            cand_a_ballots = candidate_ballots.get(cand_a, set())
-            if len(cand_a_ballots) == 0:
-                continue
-
-            # Count how many of those also approved candidate B
-            both_count = len(cand_a_ballots & candidate_ballots.get(cand_b, set()))
-
-            # Rate is percentage of candidate A voters who also approved candidate B
-            co_approval_rate = (
-                (both_count / len(cand_a_ballots) * 100)
-                if len(cand_a_ballots) > 0
-                else 0
-            )
-
-            co_approval_list.append(
-                {
-                    "candidateA": cand_a,
-                    "candidateB": cand_b,
-                    "coApprovalCount": both_count,
-                    "coApprovalRate": co_approval_rate,
-                }
-            )
-
-    # Calculate voting patterns
-    approval_counts = Counter()
-    bullet_voting = 0
-    full_approval = 0
-    candidate_approvals = defaultdict(int)
-    anyone_but_counts = defaultdict(int)
-
-    for ballot in ballots_data:
-        approved = []
-        for key in sorted(ballot.keys()):
-            if key.startswith("vote_") and ballot[key]:
-                approved.append(ballot[key])
-
-        num_approvals = len(approved)
-        approval_counts[num_approvals] += 1
-
-        if num_approvals == 1:
-            bullet_voting += 1
-
-        if num_approvals == len(candidates):
-            full_approval += 1
-
-        for candidate in approved:
-            candidate_approvals[candidate] += 1
-
-        # Anyone but analysis: count exclusions
-        for candidate in candidates:
-            if candidate not in approved:
-                anyone_but_counts[candidate] += 1
-
-    # Calculate approval distributions
-    approval_distribution = {str(k): v for k, v in sorted(approval_counts.items())}
-
-    # Calculate candidate-specific approval distributions
-    # For each candidate, count how many voters who approved them approved 1, 2, 3, etc. total candidates
-    candidate_approval_distributions = {}
-    for candidate in candidates:
-        # Get all ballots that approved this candidate
-        candidate_ballot_distribution = Counter()
-        for ballot in ballots_data:
-            approved = []
-            for key in sorted(ballot.keys()):
-                if key.startswith("vote_") and ballot[key]:
-                    approved.append(ballot[key])
-
-            # If this ballot approved the candidate, count how many total approvals it had
-            if candidate in approved:
-                total_approvals = len(approved)
-                candidate_ballot_distribution[total_approvals] += 1
-
-        if candidate_ballot_distribution:
-            candidate_approval_distributions[candidate] = {
-                str(k): v for k, v in sorted(candidate_ballot_distribution.items())
-            }
-
-    # Find most common combination
-    combination_counts = Counter()
-    for ballot in ballots_data:
-        approved = tuple(
-            sorted(
-                [
-                    ballot[key]
-                    for key in sorted(ballot.keys())
-                    if key.startswith("vote_") and ballot[key]
-                ]
-            )
-        )
-        combination_counts[approved] += 1
-
-    most_common = combination_counts.most_common(1)[0] if combination_counts else None
-    most_common_combination = (
-        {
-            "candidates": list(most_common[0]),
-            "count": most_common[1],
-            "rate": most_common[1] / total_ballots if total_ballots > 0 else 0,
-        }
-        if most_common
-        else None
-    )
+def ballot_approvals(ballot):
+    """Return the candidate names approved on a Utah ballot record.
 
-    # Anyone but analysis - ballots with exactly N-1 approvals (all candidates except one)
-    anyone_but_analysis = {}
-    num_candidates = len(candidates)
-
-    for ballot in ballots_data:
-        approved = []
-        for key in sorted(ballot.keys()):
-            if key.startswith("vote_") and ballot[key]:
-                approved.append(ballot[key])
-
-        # Only count ballots with exactly N-1 approvals
-        if len(approved) == num_candidates - 1:
-            # Find the one candidate that was NOT approved
-            excluded_candidates = set(candidates) - set(approved)
-            if len(excluded_candidates) == 1:
-                excluded_candidate = list(excluded_candidates)[0]
-                anyone_but_analysis[excluded_candidate] = (
-                    anyone_but_analysis.get(excluded_candidate, 0) + 1
-                )
-
-    voting_patterns = {
-        "totalBallots": total_ballots,
-        "bulletVotingCount": bullet_voting,
-        "bulletVotingRate": bullet_voting / total_ballots if total_ballots > 0 else 0,
-        "fullApprovalCount": full_approval,
-        "fullApprovalRate": full_approval / total_ballots if total_ballots > 0 else 0,
-        "averageApprovalsPerBallot": (
-            sum(approval_counts[k] * k for k in approval_counts) / total_ballots
-            if total_ballots > 0
-            else 0
-        ),
-        "mostCommonCombination": most_common_combination,
-        "approvalDistribution": approval_distribution,
-        "candidateApprovalDistributions": candidate_approval_distributions,
-        "anyoneButAnalysis": anyone_but_analysis,
-    }
+    Names come in the order of the record's sorted ``vote_`` keys.
+    """
+    return [
+        ballot[key] for key in sorted(ballot) if key.startswith("vote_") and ballot[key]
+    ]
 
-    return co_approval_list, voting_patterns
+
+def candidate_id(name):
+    """Return the CVR candidate id derived from a Utah candidate name."""
+    return name.lower().replace(" ", "_")
 
 
 def export_utah_cvr_to_main_database():
@@ -209,35 +76,51 @@ def export_utah_cvr_to_main_database():
 
     main_conn = sqlite3.connect(main_db)
 
-    # Get report ID for Utah Senate District 11
-    report_result = main_conn.execute(
-        "SELECT id FROM reports WHERE path = ?",
-        ("us/ut/senate_district_11/2025/12",),
-    ).fetchone()
+    # Load the report for Utah Senate District 11 and its candidates
+    report_path = "us/ut/senate_district_11/2025/12"
+    reference = ReferenceData.load(main_conn, "path = ?", (report_path,))
+    report_id = reference.report_id(path=report_path)
 
-    if not report_result:
+    if report_id is None:
         logger.error("Utah Senate District 11 report not found in database!")
         return False
 
-    report_id = report_result[0]
     logger.info(f"Found report_id: {report_id}")
 
-    # Get candidates for this report
-    candidates_result = main_conn.execute(
-        "SELECT name FROM candidates WHERE report_id = ? ORDER BY name", (report_id,)
-    ).fetchall()
-    candidates = [row[0] for row in candidates_result]
+    candidates = sorted(reference.candidates.get(report_id, []))
     logger.info(f"Found {len(candidates)} candidates: {', '.join(candidates)}")
 
+    # Compress the ballots to distinct approval sets, then analyze those
+    profile = ballot_profile(map(ballot_approvals, ballots_data))
+    logger.info(f"Compressed ballots to {len(profile)} distinct approval sets")
+
     # Generate co-approval analysis
     logger.info("Generating co-approval analysis...")
-    co_approvals, voting_patterns = generate_co_approval_analysis(
-        ballots_data, candidates
+    co_approvals, voting_patterns = analyze_profile(profile, candidates)
+
+    main_conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS ballot_profiles (
+            id INTEGER PRIMARY KEY,
+            report_id INTEGER,
+            combination TEXT,
+            ballots INTEGER,
+            FOREIGN KEY(report_id) REFERENCES reports(id)
+        )
+    """
     )
+    setup_export_tables(main_conn)
 
     # Clear existing data for this report (idempotent)
     main_conn.execute("DELETE FROM co_approvals WHERE report_id = ?", (report_id,))
     main_conn.execute("DELETE FROM voting_patterns WHERE report_id = ?", (report_id,))
+    main_conn.execute("DELETE FROM ballot_profiles WHERE report_id = ?", (report_id,))
+
+    # Store the profile the analysis was computed from
+    main_conn.executemany(
+        "INSERT INTO ballot_profiles (report_id, combination, ballots) VALUES (?, ?, ?)",
+        ((report_id, json.dumps(names), count) for names, count in profile),
+    )
 
     # Insert co-approval data
     for ca in co_approvals:
@@ -256,8 +139,6 @@ def export_utah_cvr_to_main_database():
         )
 
     # Insert voting patterns
-    import json as json_module
-
     main_conn.execute(
         """
         INSERT INTO voting_patterns (
@@ -275,10 +156,10 @@ def export_utah_cvr_to_main_database():
             voting_patterns["fullApprovalCount"],
             voting_patterns["fullApprovalRate"],
             voting_patterns["averageApprovalsPerBallot"],
-            json_module.dumps(voting_patterns["mostCommonCombination"]),
-            json_module.dumps(voting_patterns["approvalDistribution"]),
-            json_module.dumps(voting_patterns["candidateApprovalDistributions"]),
-            json_module.dumps(voting_patterns["anyoneButAnalysis"]),
+            json.dumps(voting_patterns["mostCommonCombination"]),
+            json.dumps(voting_patterns["approvalDistribution"]),
+            json.dumps(voting_patterns["candidateApprovalDistributions"]),
+            json.dumps(voting_patterns["anyoneButAnalysis"]),
         ),
     )
 
@@ -299,112 +180,80 @@ def export_utah_cvr_to_main_database():
 
     # Update candidate vote counts from CVR data
     logger.info("  Updating candidate vote counts from CVR data")
-    from collections import Counter
 
-    # Count votes from ballots_data
-    candidate_votes = Counter()
-    for ballot in ballots_data:
-        for key in sorted(ballot.keys()):
-            if key.startswith("vote_") and ballot[key]:
-                candidate_votes[ballot[key]] += 1
+    # Count votes from the profile
+    candidate_votes = ApprovalAccumulator.from_profile(profile).approval_counts()
 
-    # Update each candidate's vote count
+    # Update every candidate's vote count, then verify them together
     for candidate_name, vote_count in candidate_votes.items():
         logger.info(f"    Updating {candidate_name}: {vote_count} votes")
-        main_conn.execute(
-            """
-            UPDATE candidates 
-            SET votes = ? 
-            WHERE report_id = ? AND name = ?
-        """,
-            (vote_count, report_id, candidate_name),
+    mismatches = reference.update_votes(
+        main_conn,
+        (
+            (report_id, candidate_name, vote_count)
+            for candidate_name, vote_count in candidate_votes.items()
+        ),
+    )
+    for _, candidate_name, vote_count, updated_count in mismatches:
+        logger.warning(
+            f"    Vote count mismatch for {candidate_name}: expected {vote_count}, got {updated_count}"
         )
 
-        # Verify the update worked
-        updated_count = main_conn.execute(
-            """
-            SELECT votes FROM candidates 
-            WHERE report_id = ? AND name = ?
-        """,
-            (report_id, candidate_name),
-        ).fetchone()
-
-        if updated_count and updated_count[0] != vote_count:
-            logger.warning(
-                f"    Vote count mismatch for {candidate_name}: expected {vote_count}, got {updated_count[0]}"
-            )
-
     # Export CVR tables to main database
     logger.info("\n📦 Exporting CVR tables to main database...")
     source = "utah"
 
     # Delete existing Utah CVR data (idempotent)
-    main_conn.execute("DELETE FROM cvr_selections WHERE source = ?", (source,))
-    main_conn.execute("DELETE FROM cvr_contests WHERE source = ?", (source,))
-    main_conn.execute("DELETE FROM cvr_ballots WHERE source = ?", (source,))
+    source_id = export_source_id(main_conn, source)
+    delete_source(main_conn, source_id)
 
-    # Insert ballots
-    logger.info("  Inserting cvr_ballots...")
     contest_name = "Utah Senate District 11"
     contest_id = "utah_senate_district_11_2025_12"
+    writer = CompactCvrWriter(main_conn, source_id)
+    writer.declare_contest(
+        contest_name, contest_id, [(name, candidate_id(name)) for name in candidates]
+    )
+    first_ballot, first_record = (
+        main_conn.execute(
+            f"SELECT COALESCE(MAX(id), 0) + 1 FROM {table}"  # nosec B608 - Fixed table names
+        ).fetchone()[0]
+        for table in ("cvr_export_ballots", "cvr_ballot_approvals")
+    )
 
-    ballot_id_map = {}
-    cursor = main_conn.cursor()
-    for idx, ballot in enumerate(ballots_data, 1):
-        tracking = ballot.get("tracking", f"utah_ballot_{idx}")
-        cursor.execute(
-            """
-            INSERT INTO cvr_ballots (source, cvr_guid, batch_sequence, sheet_number, precinct_name, precinct_id, is_blank)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """,
-            (source, tracking, None, None, None, None, False),
+    # Insert ballots
+    logger.info("  Inserting ballots...")
+    ballot_count = writer.add_ballots(
+        (
+            first_ballot + idx,
+            ballot.get("tracking", f"utah_ballot_{idx + 1}"),
+            None,
+            None,
+            None,
+            None,
+            False,
+            None,
         )
-        ballot_id = cursor.lastrowid
-        ballot_id_map[idx] = ballot_id
-
-    logger.info(f"  ✓ Inserted {len(ballot_id_map)} ballots")
-
-    # Insert contests and selections
-    logger.info("  Inserting cvr_contests and cvr_selections...")
-    contest_id_map = {}
-    selection_count = 0
-
-    for idx, ballot in enumerate(ballots_data, 1):
-        ballot_id = ballot_id_map[idx]  # idx starts at 1 from enumerate(..., 1)
+        for idx, ballot in enumerate(ballots_data)
+    )
+    logger.info(f"  ✓ Inserted {ballot_count} ballots")
 
-        # Insert contest record
-        cursor.execute(
-            """
-            INSERT INTO cvr_contests (source, ballot_id, contest_name, contest_id, undervotes)
-            VALUES (?, ?, ?, ?, ?)
-        """,
-            (source, ballot_id, contest_name, contest_id, 0),
+    # Insert one contest record per ballot, with its approvals as a bitmask
+    logger.info("  Inserting contest records...")
+    record_count = writer.add_contest_records(
+        (
+            first_record + idx,
+            first_ballot + idx,
+            contest_name,
+            contest_id,
+            0,
+            candidate_name,
+            candidate_id(candidate_name) if candidate_name else None,
         )
-        contest_record_id = cursor.lastrowid
-        contest_id_map[idx] = contest_record_id
-
-        # Insert selections
-        for key in sorted(ballot.keys()):
-            if key.startswith("vote_") and ballot[key]:
-                candidate_name = ballot[key]
-                cursor.execute(
-                    """
-                    INSERT INTO cvr_selections (source, contest_record_id, candidate_name, candidate_id, selection_value)
-                    VALUES (?, ?, ?, ?, ?)
-                """,
-                    (
-                        source,
-                        contest_record_id,
-                        candidate_name,
-                        candidate_name.lower().replace(" ", "_"),
-                        1,
-                    ),
-                )
-                selection_count += 1
-
-    logger.info(
-        f"  ✓ Inserted {len(contest_id_map)} contests and {selection_count} selections"
+        for idx, ballot in enumerate(ballots_data)
+        for candidate_name in ballot_approvals(ballot) or [None]
     )
+    writer.finish(lambda name: report_id)
+    logger.info(f"  ✓ Inserted {record_count} contest records")
 
     main_conn.commit()
     main_conn.close()
@@ -414,8 +263,6 @@ def export_utah_cvr_to_main_database():
 
 
 if __name__ == "__main__":
-    import sys
-
     if export_utah_cvr_to_main_database():
         sys.exit(0)
     else:
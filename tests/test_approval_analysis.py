@@ -0,0 +1,201 @@
+"""
+Tests for the co-approval analysis engine shared by the importers
+(cvr/approval_analysis.py).
+
+Run with:
+    cd cvr/st-louis && uv run --with pytest pytest ../../tests
+"""
+
+import json
+import random
+import sys
+from itertools import pairwise
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "cvr"))
+from approval_analysis import (  # noqa: E402
+    ApprovalAccumulator,
+    accumulate_contests,
+    analyze_profile,
+    ballot_profile,
+    merge_contests,
+)
+
+
+def random_accumulator(num_names, num_candidates, combinations, seed):
+    """Return an accumulator over random bitmasks of ``num_names`` names.
+
+    The first ``num_candidates`` names are the reported candidates; the
+    rest count as write-ins.
+    """
+    rng = random.Random(seed)
+    names = [f"CANDIDATE {number}" for number in range(num_names)]
+    accumulator = ApprovalAccumulator(names[:num_candidates])
+    for name in names[num_candidates:]:
+        accumulator._bit(name)
+    limit = (1 << num_names) - 1
+    for _ in range(combinations):
+        # Mostly small approval sets, with some that approve almost everyone
+        mask = 0
+        for _ in range(rng.choice([1, 2, 3, num_names // 2])):
+            mask |= 1 << rng.randrange(num_names)
+        if rng.random() < 0.1:
+            mask = limit & ~(1 << rng.randrange(num_names))
+        accumulator.combination_counts[mask] += rng.randint(1, 10_000)
+    return accumulator
+
+
+@pytest.mark.parametrize(
+    "num_names, num_candidates",
+    [(3, 3), (4, 3), (12, 10), (40, 40), (62, 60), (63, 63)],
+)
+@pytest.mark.parametrize("seed", range(3))
+def test_numpy_tally_matches_python(num_names, num_candidates, seed):
+    """Both tallies give identical results, up to 63 names."""
+    pytest.importorskip("numpy")
+    accumulator = random_accumulator(num_names, num_candidates, 500, seed)
+    columns = [
+        accumulator.bits[candidate].bit_length() - 1
+        for candidate in accumulator.candidates
+    ]
+    assert accumulator._tally_numpy(columns) == accumulator._tally_python(columns)
+
+
+# Eleven ballots over three candidates, one with a write-in and one blank
+GOLDEN_BALLOTS = [
+    ["BAKER", "ADAMS"],
+    ["ADAMS"],
+    ["ADAMS", "BAKER"],
+    ["CLARK"],
+    ["ADAMS", "BAKER", "CLARK"],
+    [],
+    ["BAKER", "CLARK"],
+    ["ADAMS"],
+    ["CLARK", "BAKER"],
+    ["BAKER", "ADAMS"],
+    ["ADAMS", "WRITE-IN"],
+]
+
+
+def test_profile_analysis_golden():
+    """The payload the website reads, worked out by hand."""
+    profile = ballot_profile(GOLDEN_BALLOTS)
+    assert profile == [
+        (["ADAMS", "BAKER"], 3),
+        (["ADAMS"], 2),
+        (["CLARK"], 1),
+        (["ADAMS", "BAKER", "CLARK"], 1),
+        ([], 1),
+        (["BAKER", "CLARK"], 2),
+        (["ADAMS", "WRITE-IN"], 1),
+    ]
+
+    candidates = ["ADAMS", "BAKER", "CLARK"]
+    co_approvals, voting_patterns = analyze_profile(profile, candidates)
+
+    # Rates are percentages of the first candidate's approvals
+    assert co_approvals == [
+        {
+            "candidateA": a,
+            "candidateB": b,
+            "coApprovalCount": count,
+            "coApprovalRate": pytest.approx(rate),
+        }
+        for a, b, count, rate in [
+            ("ADAMS", "BAKER", 4, 57.142857),
+            ("ADAMS", "CLARK", 1, 14.285714),
+            ("BAKER", "ADAMS", 4, 66.666667),
+            ("BAKER", "CLARK", 3, 50.0),
+            ("CLARK", "ADAMS", 1, 25.0),
+            ("CLARK", "BAKER", 3, 75.0),
+        ]
+    ]
+    assert voting_patterns == {
+        "totalBallots": 11,
+        "bulletVotingCount": 3,
+        "bulletVotingRate": pytest.approx(27.272727),
+        "fullApprovalCount": 1,
+        "fullApprovalRate": pytest.approx(9.090909),
+        "averageApprovalsPerBallot": pytest.approx(18 / 11),
+        # The largest group; ADAMS alone and BAKER + CLARK have two each
+        "mostCommonCombination": ["ADAMS", "BAKER"],
+        "approvalDistribution": {0: 1, 1: 3, 2: 6, 3: 1},
+        "candidateApprovalDistributions": {
+            "ADAMS": {1: 2, 2: 4, 3: 1},
+            "BAKER": {2: 5, 3: 1},
+            "CLARK": {1: 1, 2: 2, 3: 1},
+        },
+        # The write-in ballot approves two, but only one of the candidates
+        "anyoneButAnalysis": {"ADAMS": 2, "CLARK": 3},
+    }
+
+    # A profile stored as JSON and read back gives the same payload
+    stored = json.loads(json.dumps(profile))
+    assert analyze_profile(stored, candidates) == (co_approvals, voting_patterns)
+
+
+def selection_rows(seed):
+    """Return ``(contest, record id, name)`` rows for 300 random ballots."""
+    rng = random.Random(seed)
+    contests = {
+        "MAYOR": ["CARA SPENCER", "TISHAURA O. JONES", "ANDREW JONES", "WRITE-IN"],
+        "COMPTROLLER": ["DARLENE GREEN", "DONNA BARINGER"],
+    }
+    rows = []
+    record = 0
+    for _ in range(300):
+        for contest, names in contests.items():
+            record += 1
+            # Names come in a different order on each ballot, so every batch
+            # numbers its bits differently
+            for name in rng.sample(names, rng.randint(1, len(names))):
+                rows.append((contest, record, name))
+    return rows
+
+
+def analysis(accumulators):
+    """Return each contest's profile and payload, independent of order.
+
+    The most common combination is left out: ties between combinations go
+    to the first one seen, which depends on the order of the batches.
+    """
+    summary = {}
+    for contest, accumulator in accumulators.items():
+        co_approvals, voting_patterns = accumulator.result()
+        voting_patterns.pop("mostCommonCombination")
+        summary[contest] = (
+            sorted((names, count) for names, count in accumulator.combinations()),
+            co_approvals,
+            voting_patterns,
+        )
+    return summary
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_merged_batches_match_one_pass(seed):
+    """Per-batch accumulators merged in any order equal a single pass."""
+    rows = selection_rows(seed)
+    expected = analysis(accumulate_contests(rows))
+
+    # Cut between records, with some empty batches and some with one contest
+    rng = random.Random(seed)
+    cuts = sorted(
+        rng.sample([i for i in range(1, len(rows)) if rows[i][1] != rows[i - 1][1]], 12)
+    )
+    bounds = [0, 0, *cuts, cuts[-1], len(rows), len(rows)]
+    batches = [rows[start:end] for start, end in pairwise(bounds)]
+    assert [] in batches
+
+    for order in (batches, batches[::-1], rng.sample(batches, len(batches))):
+        merged = {}
+        for batch in order:
+            merge_contests(merged, accumulate_contests(batch))
+        assert analysis(merged) == expected
+
+    # Feeding batches into shared accumulators is the same as merging them
+    shared = {}
+    for batch in batches:
+        accumulate_contests(batch, shared)
+    assert analysis(shared) == expected
@@ -0,0 +1,166 @@
+"""
+Tests for the compact CVR export shared by the importers (cvr/cvr_export.py).
+
+Run with:
+    cd cvr/st-louis && uv run --with pytest pytest ../../tests
+"""
+
+import sqlite3
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "cvr"))
+from cvr_export import setup_export_tables  # noqa: E402
+
+# The normalized tables data.sqlite3 held before the compact export
+LEGACY_SCHEMA = """
+CREATE TABLE cvr_ballots (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    cvr_guid TEXT NOT NULL,
+    batch_sequence INTEGER,
+    sheet_number INTEGER,
+    precinct_name TEXT,
+    precinct_id TEXT,
+    is_blank BOOLEAN,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(source, cvr_guid)
+);
+
+CREATE TABLE cvr_contests (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    ballot_id INTEGER,
+    contest_name TEXT NOT NULL,
+    contest_id TEXT NOT NULL,
+    undervotes INTEGER,
+    FOREIGN KEY(ballot_id) REFERENCES cvr_ballots(id)
+);
+
+CREATE TABLE cvr_selections (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    contest_record_id INTEGER,
+    candidate_name TEXT NOT NULL,
+    candidate_id TEXT NOT NULL,
+    selection_value INTEGER,
+    FOREIGN KEY(contest_record_id) REFERENCES cvr_contests(id)
+);
+
+CREATE INDEX idx_cvr_source_guid ON cvr_ballots(source, cvr_guid);
+CREATE INDEX idx_cvr_source_contest_selection ON cvr_selections(source, contest_record_id, candidate_id);
+"""
+
+LEGACY_TABLES = ("cvr_ballots", "cvr_contests", "cvr_selections")
+
+CANDIDATES = [("CARA SPENCER", "101"), ("TISHAURA O. JONES", "102"), ("WRITE-IN", "0")]
+
+
+def legacy_database(path):
+    """Write normalized CVR tables for two sources and two contests."""
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    ballot_id = record_id = 0
+    for source in ("st_louis", "utah"):
+        for number in range(40):
+            ballot_id += 1
+            conn.execute(
+                "INSERT INTO cvr_ballots VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    ballot_id,
+                    source,
+                    f"{source}-{number}",
+                    number % 3,
+                    1,
+                    f"Ward {number % 4}",
+                    str(number % 4),
+                    number == 0,
+                    "2025-03-04 12:00:00",
+                ),
+            )
+            for contest_name, contest_id in (("MAYOR", "1"), ("PROP A", "2")):
+                if contest_id == "2" and number % 5 == 0:
+                    continue
+                record_id += 1
+                conn.execute(
+                    "INSERT INTO cvr_contests VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        record_id,
+                        source,
+                        ballot_id,
+                        contest_name,
+                        contest_id,
+                        number % 2,
+                    ),
+                )
+                for index, (name, candidate_id) in enumerate(CANDIDATES):
+                    # Some unmarked options are stored with selection_value 0
+                    value = 1 if (number + record_id) % (index + 2) == 0 else 0
+                    if value or index == 0:
+                        conn.execute(
+                            "INSERT INTO cvr_selections (source, contest_record_id, candidate_name, candidate_id, selection_value) VALUES (?, ?, ?, ?, ?)",
+                            (source, record_id, name, candidate_id, value),
+                        )
+    conn.commit()
+    return conn
+
+
+def table_rows(conn):
+    """Return the rows of the three CVR tables (or views), comparably."""
+    ballots = conn.execute("SELECT * FROM cvr_ballots ORDER BY id").fetchall()
+    contests = conn.execute("SELECT * FROM cvr_contests ORDER BY id").fetchall()
+    # Only approvals are exported, and selection ids are not kept
+    selections = sorted(
+        conn.execute(
+            """
+            SELECT source, contest_record_id, candidate_name, candidate_id, selection_value
+            FROM cvr_selections WHERE selection_value = 1
+            """
+        )
+    )
+    return ballots, contests, selections
+
+
+def object_types(conn):
+    return dict(
+        conn.execute(
+            "SELECT name, type FROM sqlite_master WHERE name LIKE 'cvr_%' AND type IN ('table', 'view')"
+        )
+    )
+
+
+def test_legacy_conversion_keeps_rows(tmp_path):
+    """The views over converted tables return the rows the tables held."""
+    conn = legacy_database(tmp_path / "data.sqlite3")
+    before = table_rows(conn)
+
+    setup_export_tables(conn)
+    types = object_types(conn)
+    assert [types[name] for name in LEGACY_TABLES] == ["view"] * 3
+    assert table_rows(conn) == before
+
+    # Running it again changes nothing
+    setup_export_tables(conn)
+    assert table_rows(conn) == before
+    conn.close()
+
+
+def test_failed_conversion_leaves_legacy_tables(tmp_path):
+    """A conversion that fails part way through leaves the old tables."""
+    conn = legacy_database(tmp_path / "data.sqlite3")
+    # The second source has a contest too large for a bitmask, so it fails
+    # after the first source is converted
+    conn.executemany(
+        "INSERT INTO cvr_selections (source, contest_record_id, candidate_name, candidate_id, selection_value) VALUES ('utah', ?, ?, ?, 1)",
+        ((100, f"CANDIDATE {number}", str(number)) for number in range(70)),
+    )
+    conn.commit()
+    before = table_rows(conn)
+
+    with pytest.raises(ValueError, match="more than 64 candidates"):
+        setup_export_tables(conn)
+    assert object_types(conn) == {name: "table" for name in LEGACY_TABLES}
+    assert table_rows(conn) == before
+    conn.close()
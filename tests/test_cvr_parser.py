@@ -0,0 +1,467 @@
+"""
+Ingest tests for the St. Louis CVR parser (cvr/st-louis/cvr_parser.py).
+
+Run with:
+    cd cvr/st-louis && uv run --with pytest pytest ../../tests
+"""
+
+import io
+import sqlite3
+import sys
+import uuid
+import zipfile
+from pathlib import Path
+
+import pytest
+
+# The parser lives in cvr/st-louis, which is not a package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "cvr" / "st-louis"))
+from cvr_parser import (  # noqa: E402
+    APPROVALS_QUERY,
+    PARSER_BACKENDS,
+    CvrParser,
+    load_snapshots,
+)
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "cvr"))
+from approval_analysis import accumulate_contests  # noqa: E402
+
+CANDIDATES = ["CARA SPENCER", "TISHAURA O. JONES", "ANDREW JONES"]
+
+
+def ballot_xml(guid):
+    """Return a one-contest CVR file whose contents follow from its GUID."""
+    number = uuid.UUID(guid).int % 1000
+    options = "".join(
+        f"<Option><Name>{name}</Name><Id>{100 + index}</Id><Value>1</Value></Option>"
+        for index, name in enumerate(CANDIDATES)
+        if number % (index + 2) == 0
+    )
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<Cvr xmlns="http://tempuri.org/CVRDesign.xsd">'
+        f"<CvrGuid>{guid}</CvrGuid><BatchSequence>{number % 7}</BatchSequence>"
+        f"<SheetNumber>1</SheetNumber><PrecinctSplit><Name>Ward {number % 5}</Name>"
+        f"<Id>{number % 5}</Id></PrecinctSplit><Contests><Contest><Name>MAYOR</Name>"
+        f"<Id>1</Id><Options>{options}</Options><Undervotes>0</Undervotes></Contest>"
+        "</Contests><IsBlank>false</IsBlank></Cvr>\n"
+    )
+
+
+def make_guids(count, seed):
+    return [str(uuid.UUID(int=seed << 64 | number)) for number in range(count)]
+
+
+def write_archive(path, guids):
+    """Write a ZIP archive with one XML member per GUID."""
+    with zipfile.ZipFile(path, "w") as archive:
+        for number, guid in enumerate(guids):
+            archive.writestr(f"{path.stem}/{number}.xml", ballot_xml(guid))
+    return path
+
+
+def write_directory(path, guids):
+    """Write a directory of XML files, one per GUID, replacing any there."""
+    path.mkdir(exist_ok=True)
+    for old in path.glob("*.xml"):
+        old.unlink()
+    for number, guid in enumerate(guids):
+        (path / f"{number}.xml").write_text(ballot_xml(guid))
+    return path
+
+
+def ingest(db_path, data_dirs=(), zip_paths=(), prune=False, **settings):
+    """Run one ingest job, as process_all.py does, and check it succeeded."""
+    with CvrParser(str(db_path), batch_size=100, **settings) as parser:
+        if prune:
+            parser.prune_sources(data_dirs, zip_paths)
+        results = parser.ingest(data_dirs, zip_paths)
+    assert all(result.ok for result in results)
+    return results
+
+
+def stored_ballots(db_path):
+    """Return every stored ballot's GUID with its approvals, sorted."""
+    conn = sqlite3.connect(db_path)
+    try:
+        return sorted(
+            conn.execute(
+                """
+                SELECT b.cvr_guid, c.contest_name,
+                       (SELECT group_concat(candidate_name, '|') FROM (
+                           SELECT s.candidate_name FROM cvr_selections s
+                           WHERE s.contest_record_id = c.id ORDER BY 1
+                       ))
+                FROM cvr_ballots b JOIN cvr_contests c ON c.ballot_id = b.id
+                """
+            )
+        )
+    finally:
+        conn.close()
+
+
+def ballot_ids(db_path):
+    """Return ``(ballot id, GUID)`` for every stored ballot, sorted by id."""
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute(
+            "SELECT id, cvr_guid FROM cvr_ballots ORDER BY id"
+        ).fetchall()
+    finally:
+        conn.close()
+
+
+def profiles(accumulators):
+    """Return each contest's weighted profile, independent of order."""
+    return {
+        contest: sorted(
+            (tuple(names), count) for names, count in accumulator.combinations()
+        )
+        for contest, accumulator in accumulators.items()
+    }
+
+
+def completed_sources(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return {
+            Path(path).name
+            for (path,) in conn.execute(
+                "SELECT path FROM ingest_manifest WHERE content_hash IS NOT NULL"
+            )
+        }
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize(
+    "settings", [{}, {"pipeline_depth": 2}, {"workers": 2}, {"compact": True}]
+)
+def test_two_archives(tmp_path, settings):
+    """Every planned archive is read before it is marked complete."""
+    first = write_archive(tmp_path / "wave1.zip", make_guids(250, 1))
+    second = write_archive(tmp_path / "wave2.zip", make_guids(250, 2))
+    db_path = tmp_path / "cvr.sqlite3"
+
+    with CvrParser(str(db_path), batch_size=100, **settings) as parser:
+        results = parser.ingest(zip_paths=[first, second])
+
+    assert all(result.ok for result in results)
+    assert [result.parsed for result in results] == [250, 250]
+    assert len(stored_ballots(db_path)) == 500
+    assert completed_sources(db_path) == {"wave1.zip", "wave2.zip"}
+
+    # A re-run finds nothing to do and loses nothing
+    with CvrParser(str(db_path), batch_size=100, **settings) as parser:
+        results = parser.ingest(zip_paths=[first, second])
+    assert [result.skipped for result in results] == [250, 250]
+    assert len(stored_ballots(db_path)) == 500
+
+
+@pytest.mark.parametrize(
+    "settings",
+    [
+        {},
+        {"guid_filter": "bloom"},
+        {"guid_filter": "off"},
+        {"workers": 2},
+        {"compact": True},
+        {"shards": 2},
+    ],
+)
+@pytest.mark.parametrize("change", ["remove", "shrink"])
+def test_retraction_matches_rebuild(tmp_path, settings, change):
+    """Ballots another source also holds survive retracting the stored copy."""
+    guids = make_guids(400, 1)
+    first = write_directory(tmp_path / "export1", guids[:250])
+    second = write_archive(tmp_path / "export2.zip", guids[150:])
+    third = write_directory(tmp_path / "export3", guids[100:200])
+    db_path = tmp_path / "cvr.sqlite3"
+    ingest(db_path, [first, third], [second], **settings)
+    assert len(stored_ballots(db_path)) == 400
+
+    if change == "remove":
+        data_dirs = [third]
+        for old in first.glob("*.xml"):
+            old.unlink()
+        first.rmdir()
+    else:
+        data_dirs = [first, third]
+        write_directory(first, guids[:50])
+    ingest(db_path, data_dirs, [second], prune=True, **settings)
+
+    rebuild_path = tmp_path / "rebuild.sqlite3"
+    ingest(rebuild_path, data_dirs, [second], **settings)
+    assert stored_ballots(db_path) == stored_ballots(rebuild_path)
+
+
+class Crash(BaseException):
+    """Stands in for the process being killed; ingest does not catch it."""
+
+
+@pytest.mark.parametrize("settings", [{}, {"pipeline_depth": 2}])
+@pytest.mark.parametrize("resume", [False, True])
+def test_resume_after_crash(tmp_path, monkeypatch, settings, resume):
+    """A run killed part way through is finished by the next one."""
+    guids = make_guids(400, 1)
+    archive = write_archive(tmp_path / "wave1.zip", guids[:250])
+    directory = write_directory(tmp_path / "wave2", guids[250:])
+    db_path = tmp_path / "cvr.sqlite3"
+
+    add_to_batch = CvrParser.add_to_batch
+    added = []
+
+    def crashing_add_to_batch(self, *args):
+        added.append(1)
+        if len(added) == 250:
+            raise Crash()
+        add_to_batch(self, *args)
+
+    # Killed while the last member of the archive is parsed, after two batches
+    monkeypatch.setattr(CvrParser, "add_to_batch", crashing_add_to_batch)
+    with pytest.raises(Crash):
+        with CvrParser(str(db_path), batch_size=100, **settings) as parser:
+            parser.ingest([directory], [archive])
+    monkeypatch.undo()
+    assert len(stored_ballots(db_path)) == 200
+    assert completed_sources(db_path) == set()
+
+    with CvrParser(str(db_path), batch_size=100, **settings) as parser:
+        results = parser.ingest([directory], [archive], resume=resume)
+    assert all(result.ok for result in results)
+    if resume:
+        assert results[0].skipped == 200
+
+    clean_path = tmp_path / "clean.sqlite3"
+    ingest(clean_path, [directory], [archive], **settings)
+    assert stored_ballots(db_path) == stored_ballots(clean_path)
+    assert completed_sources(db_path) == completed_sources(clean_path)
+
+
+@pytest.mark.parametrize("settings", [{}, {"compact": True}])
+def test_shard_merge_matches_serial(tmp_path, settings):
+    """Sharded ingest stores and numbers ballots as a serial ingest does."""
+    guids = make_guids(400, 1)
+    archives = [
+        write_archive(tmp_path / "wave1.zip", guids[:200]),
+        write_archive(tmp_path / "wave2.zip", guids[150:300]),
+    ]
+    directory = write_directory(tmp_path / "wave3", guids[250:])
+
+    serial_path = tmp_path / "serial.sqlite3"
+    ingest(serial_path, [directory], archives, **settings)
+    sharded_path = tmp_path / "sharded.sqlite3"
+    ingest(sharded_path, [directory], archives, shards=3, **settings)
+
+    assert len(stored_ballots(serial_path)) == 400
+    assert stored_ballots(sharded_path) == stored_ballots(serial_path)
+    assert ballot_ids(sharded_path) == ballot_ids(serial_path)
+    assert completed_sources(sharded_path) == completed_sources(serial_path)
+
+
+@pytest.mark.parametrize("settings", [{}, {"compact": True}, {"shards": 2}])
+def test_snapshots_match_full_scan(tmp_path, settings):
+    """Merged snapshots give the totals of a scan, also after a retraction."""
+    guids = make_guids(400, 1)
+    first = write_directory(tmp_path / "export1", guids[:250])
+    second = write_archive(tmp_path / "export2.zip", guids[150:])
+    db_path = tmp_path / "cvr.sqlite3"
+
+    def check():
+        conn = sqlite3.connect(db_path)
+        try:
+            rows = conn.execute(APPROVALS_QUERY.format(where="1"))
+            scanned = accumulate_contests(
+                (contest_name, record_id, name)
+                for _, contest_name, record_id, name in rows
+            )
+            snapshots = load_snapshots(conn)
+            (batches,) = conn.execute(
+                "SELECT COUNT(*) FROM analysis_batches"
+            ).fetchone()
+        finally:
+            conn.close()
+        assert snapshots is not None
+        assert profiles(snapshots) == profiles(scanned)
+        return batches
+
+    ingest(db_path, [first], [second], **settings)
+    check()
+
+    # The retracted ballots are subtracted from their batches, not rebuilt
+    # into one snapshot of the whole database
+    write_directory(first, guids[:100])
+    ingest(db_path, [first], [second], prune=True, **settings)
+    assert check() > 1
+
+
+# A two-contest ballot with the parts a backend could trip over: an
+# overvoted contest, a write-in with its image data, an unmarked option,
+# a contest without Undervotes and elements the parser does not read
+MULTI_CONTEST_XML = """<?xml version="1.0" encoding="utf-8"?>
+<Cvr xmlns="http://tempuri.org/CVRDesign.xsd" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+  <CvrGuid>0f6c2d3e-0000-4000-8000-000000000001</CvrGuid>
+  <BatchSequence>12</BatchSequence>
+  <SheetNumber>2</SheetNumber>
+  <PrecinctSplit>
+    <Name>Ward 3 Precinct 4</Name>
+    <Id>304</Id>
+  </PrecinctSplit>
+  <Contests>
+    <Contest>
+      <Name>MAYOR</Name>
+      <Id>1</Id>
+      <Options>
+        <Option>
+          <Name>CARA SPENCER</Name>
+          <Id>101</Id>
+          <Value>1</Value>
+        </Option>
+        <Option>
+          <Name>Write-in</Name>
+          <Id>199</Id>
+          <Value>1</Value>
+          <WriteInData>
+            <Text>ANDREW JONES</Text>
+            <ImageData>iVBORw0KGgo=</ImageData>
+          </WriteInData>
+        </Option>
+        <Option>
+          <Name>TISHAURA O. JONES</Name>
+          <Id>102</Id>
+          <Value>0</Value>
+        </Option>
+      </Options>
+      <Undervotes>0</Undervotes>
+      <Overvotes>0</Overvotes>
+    </Contest>
+    <Contest>
+      <Name>PROPOSITION A</Name>
+      <Id>2</Id>
+      <Options>
+        <Option>
+          <Name>YES</Name>
+          <Id>201</Id>
+          <Value>1</Value>
+        </Option>
+        <Option>
+          <Name>NO</Name>
+          <Id>202</Id>
+          <Value>1</Value>
+        </Option>
+      </Options>
+      <Overvotes>1</Overvotes>
+    </Contest>
+  </Contests>
+  <IsBlank>False</IsBlank>
+</Cvr>
+"""
+
+MULTI_CONTEST_BALLOT = (
+    "0f6c2d3e-0000-4000-8000-000000000001",
+    12,
+    2,
+    "Ward 3 Precinct 4",
+    "304",
+    False,
+    (
+        (
+            "MAYOR",
+            "1",
+            0,
+            (
+                ("CARA SPENCER", "101", 1),
+                ("Write-in", "199", 1),
+                ("TISHAURA O. JONES", "102", 0),
+            ),
+        ),
+        ("PROPOSITION A", "2", 0, (("YES", "201", 1), ("NO", "202", 1))),
+    ),
+)
+
+
+def backend(name):
+    """Return a parser backend, skipping the lxml ones without lxml."""
+    if name != "etree":
+        pytest.importorskip("lxml")
+    return PARSER_BACKENDS[name]
+
+
+@pytest.mark.parametrize("name", PARSER_BACKENDS)
+@pytest.mark.parametrize("namespaced", [True, False])
+def test_parser_backends_agree(tmp_path, name, namespaced):
+    """Every backend returns the same tuple, from a file or a stream."""
+    parse = backend(name)
+    xml = MULTI_CONTEST_XML
+    if not namespaced:
+        xml = xml.replace(' xmlns="http://tempuri.org/CVRDesign.xsd"', "")
+    path = tmp_path / "ballot.xml"
+    path.write_text(xml)
+
+    assert parse(str(path)) == MULTI_CONTEST_BALLOT
+    assert parse(io.BytesIO(xml.encode())) == MULTI_CONTEST_BALLOT
+
+
+@pytest.mark.parametrize("name", PARSER_BACKENDS)
+def test_parser_backends_reject_malformed(name):
+    """Truncated XML and a ballot missing a required element both raise."""
+    parse = backend(name)
+    truncated = MULTI_CONTEST_XML[: MULTI_CONTEST_XML.index("<IsBlank>")]
+    with pytest.raises(SyntaxError):
+        parse(io.BytesIO(truncated.encode()))
+
+    start = MULTI_CONTEST_XML.index("  <Contests>")
+    end = MULTI_CONTEST_XML.index("  <IsBlank>")
+    no_contests = MULTI_CONTEST_XML[:start] + MULTI_CONTEST_XML[end:]
+    with pytest.raises((KeyError, ValueError)):
+        parse(io.BytesIO(no_contests.encode()))
+
+
+def layout_rows(db_path):
+    """Return every column of the three CVR tables (or views) but created_at."""
+    conn = sqlite3.connect(db_path)
+    try:
+        return (
+            conn.execute(
+                """
+                SELECT id, cvr_guid, batch_sequence, sheet_number, precinct_name,
+                       precinct_id, is_blank, source_id
+                FROM cvr_ballots ORDER BY id
+                """
+            ).fetchall(),
+            conn.execute("SELECT * FROM cvr_contests ORDER BY id").fetchall(),
+            # Selection ids are numbered differently, but in the same order
+            conn.execute(
+                """
+                SELECT contest_record_id, candidate_name, candidate_id, selection_value
+                FROM cvr_selections ORDER BY id
+                """
+            ).fetchall(),
+        )
+    finally:
+        conn.close()
+
+
+def test_compact_views_match_legacy_tables(tmp_path):
+    """The compact layout's views return the rows the legacy tables hold."""
+    guid = MULTI_CONTEST_BALLOT[0]
+    members = [ballot_xml(other) for other in make_guids(150, 1)]
+    # Multi-contest ballots, unmarked options and a GUID that is not a UUID
+    members += [MULTI_CONTEST_XML.replace(guid, other) for other in make_guids(50, 2)]
+    members.append(MULTI_CONTEST_XML.replace(guid, "BALLOT-0001"))
+    archive_path = tmp_path / "export.zip"
+    with zipfile.ZipFile(archive_path, "w") as archive:
+        for number, xml in enumerate(members):
+            archive.writestr(f"export/{number}.xml", xml)
+
+    legacy = tmp_path / "legacy.sqlite3"
+    compact = tmp_path / "compact.sqlite3"
+    ingest(legacy, zip_paths=[archive_path])
+    ingest(compact, zip_paths=[archive_path], compact=True)
+
+    rows = layout_rows(legacy)
+    ballots, contests, selections = rows
+    assert len(ballots) == 201 and len(contests) == 201 + 51
+    assert {value for *_, value in selections} == {0, 1}
+    assert layout_rows(compact) == rows
+    assert stored_ballots(compact) == stored_ballots(legacy)
@@ -0,0 +1,230 @@
+"""
+Tests for staging and publishing the St. Louis export (cvr/st-louis/process_all.py).
+
+Run with:
+    cd cvr/st-louis && uv run --with pytest pytest ../../tests
+"""
+
+import sqlite3
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+from test_cvr_parser import ingest, make_guids, stored_ballots, write_archive
+
+# process_all.py lives in cvr/st-louis, which is not a package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "cvr" / "st-louis"))
+from process_all import (  # noqa: E402
+    PUBLISH_TIMEOUT,
+    RESULTS_SCHEMA,
+    STAGING_SCHEMA,
+    publish_staged_export,
+    stage_cvr_tables,
+)
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "cvr"))
+from cvr_export import (  # noqa: E402
+    EXPORT_SCHEMA,
+    CompactCvrWriter,
+    export_source_id,
+    setup_export_tables,
+)
+
+REPORT_ID = 7
+
+
+def main_database(path):
+    """Create a data.sqlite3 with one report and an existing Utah export."""
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        """
+        CREATE TABLE reports (id INTEGER PRIMARY KEY, office TEXT, date TEXT, path TEXT, ballotCount INTEGER);
+        CREATE TABLE candidates (id INTEGER PRIMARY KEY, report_id INTEGER, name TEXT, votes INTEGER);
+        """
+    )
+    conn.executescript(RESULTS_SCHEMA)
+    setup_export_tables(conn)
+    conn.execute(
+        "INSERT INTO reports VALUES (?, 'mayor', '2025-03-04', 'us/mo/st_louis/2025/03/mayor', 0)",
+        (REPORT_ID,),
+    )
+    conn.executemany(
+        "INSERT INTO candidates (report_id, name, votes) VALUES (?, ?, 0)",
+        ((REPORT_ID, name) for name in ("CARA SPENCER", "TISHAURA O. JONES")),
+    )
+
+    writer = CompactCvrWriter(conn, export_source_id(conn, "utah"))
+    writer.add_ballots(
+        (None, f"utah-{number}", None, None, None, None, False, None)
+        for number in range(30)
+    )
+    writer.add_contest_records(
+        (number + 1, number + 1, "SENATE", "11", 0, "ALICE", "alice")
+        for number in range(30)
+    )
+    writer.finish()
+    conn.commit()
+    return conn
+
+
+def stage(tmp_path, cvr_db, name):
+    """Stage an export of a CVR database as export_to_main_database does."""
+    staging_db = tmp_path / f"{name}.sqlite3"
+    conn = sqlite3.connect(staging_db)
+    conn.executescript(STAGING_SCHEMA)
+    conn.executescript(EXPORT_SCHEMA)
+    (ballots,) = (
+        sqlite3.connect(cvr_db).execute("SELECT COUNT(*) FROM cvr_ballots").fetchone()
+    )
+    conn.execute(
+        "INSERT INTO voting_patterns (report_id, total_ballots) VALUES (?, ?)",
+        (REPORT_ID, ballots),
+    )
+    conn.execute(
+        "INSERT INTO candidate_votes (report_id, name, votes) VALUES (?, 'CARA SPENCER', ?)",
+        (REPORT_ID, ballots),
+    )
+    conn.commit()
+    stage_cvr_tables(conn, str(cvr_db), lambda contest_name: REPORT_ID)
+    conn.close()
+    return str(staging_db)
+
+
+def cvr_database(tmp_path, name, guids):
+    cvr_db = tmp_path / f"{name}.cvr.sqlite3"
+    ingest(cvr_db, zip_paths=[write_archive(tmp_path / f"{name}.zip", guids)])
+    return cvr_db
+
+
+def exported(conn, source):
+    """Return a source's exported ballots with their approvals, sorted."""
+    return sorted(
+        conn.execute(
+            """
+            SELECT b.cvr_guid, c.contest_name,
+                   (SELECT group_concat(candidate_name, '|') FROM (
+                       SELECT s.candidate_name FROM cvr_selections s
+                       WHERE s.contest_record_id = c.id ORDER BY 1
+                   ))
+            FROM cvr_ballots b JOIN cvr_contests c ON c.ballot_id = b.id
+            WHERE b.source = ?
+            """,
+            (source,),
+        )
+    )
+
+
+def dump(conn):
+    return list(conn.iterdump())
+
+
+def test_publish_offsets_ids(tmp_path):
+    """A publish replaces the source's rows, numbered after the others."""
+    main_db = tmp_path / "data.sqlite3"
+    conn = main_database(main_db)
+    utah = exported(conn, "utah")
+
+    first = cvr_database(tmp_path, "first", make_guids(120, 1))
+    publish_staged_export(conn, stage(tmp_path, first, "first"), "st_louis")
+    assert exported(conn, "st_louis") == stored_ballots(first)
+
+    second = cvr_database(tmp_path, "second", make_guids(90, 2))
+    publish_staged_export(conn, stage(tmp_path, second, "second"), "st_louis")
+    assert exported(conn, "st_louis") == stored_ballots(second)
+    assert exported(conn, "utah") == utah
+
+    # Every table is numbered past the Utah rows, and references line up
+    utah_id = export_source_id(conn, "utah")
+    for table, source_of in (
+        ("cvr_export_ballots", "t.source_id"),
+        ("cvr_export_contests", "t.source_id"),
+        (
+            "cvr_ballot_approvals",
+            "(SELECT source_id FROM cvr_export_contests WHERE id = t.contest)",
+        ),
+    ):
+        (utah_max, st_louis_min) = conn.execute(
+            f"""
+            SELECT MAX(t.id) FILTER (WHERE {source_of} = ?),
+                   MIN(t.id) FILTER (WHERE {source_of} != ?)
+            FROM {table} t
+            """,  # nosec B608 - Fixed table names
+            (utah_id, utah_id),
+        ).fetchone()
+        assert utah_max < st_louis_min
+    (orphans,) = conn.execute(
+        """
+        SELECT COUNT(*) FROM cvr_ballot_approvals a
+        JOIN cvr_export_ballots b ON b.id = a.ballot_id
+        JOIN cvr_export_contests c ON c.id = a.contest
+        WHERE b.source_id != c.source_id
+        """
+    ).fetchone()
+    assert orphans == 0
+    assert conn.execute(
+        "SELECT ballotCount FROM reports WHERE id = ?", (REPORT_ID,)
+    ).fetchone() == (90,)
+    assert conn.execute(
+        "SELECT votes FROM candidates WHERE name = 'CARA SPENCER'"
+    ).fetchone() == (90,)
+    conn.close()
+
+
+def test_failed_publish_leaves_database_untouched(tmp_path):
+    """A publish that fails on its last step changes nothing."""
+    main_db = tmp_path / "data.sqlite3"
+    conn = main_database(main_db)
+    first = cvr_database(tmp_path, "first", make_guids(120, 1))
+    publish_staged_export(conn, stage(tmp_path, first, "first"), "st_louis")
+
+    conn.execute(
+        """
+        CREATE TRIGGER fail_publish BEFORE INSERT ON cvr_ballot_approvals
+        BEGIN SELECT RAISE(ABORT, 'disk full'); END
+        """
+    )
+    conn.commit()
+    before = dump(conn)
+
+    second = cvr_database(tmp_path, "second", make_guids(90, 2))
+    with pytest.raises(sqlite3.DatabaseError, match="disk full"):
+        publish_staged_export(conn, stage(tmp_path, second, "second"), "st_louis")
+    assert not conn.in_transaction
+    assert dump(conn) == before
+    assert exported(conn, "st_louis") == stored_ballots(first)
+    conn.close()
+
+
+def test_publish_waits_for_readers(tmp_path):
+    """Publishing waits for readers, up to the connection's timeout."""
+    main_db = tmp_path / "data.sqlite3"
+    main_database(main_db).close()
+    cvr_db = cvr_database(tmp_path, "first", make_guids(60, 1))
+    staging_db = stage(tmp_path, cvr_db, "first")
+
+    # A reader (the website build) in the middle of a read transaction
+    reader = sqlite3.connect(main_db, check_same_thread=False)
+    reader.execute("BEGIN")
+    reader.execute("SELECT COUNT(*) FROM cvr_export_ballots").fetchone()
+
+    # One that waits less than the reader takes gives up, changing nothing
+    conn = sqlite3.connect(main_db, timeout=0.2)
+    before = dump(conn)
+    with pytest.raises(sqlite3.OperationalError, match="locked"):
+        publish_staged_export(conn, staging_db, "st_louis")
+    assert not conn.in_transaction
+    assert dump(conn) == before
+    conn.close()
+
+    # With the publish timeout it goes ahead once the reader is done
+    conn = sqlite3.connect(main_db, timeout=PUBLISH_TIMEOUT)
+    done = threading.Timer(0.5, reader.commit)
+    done.start()
+    try:
+        publish_staged_export(conn, staging_db, "st_louis")
+    finally:
+        done.join()
+        reader.close()
+    assert exported(conn, "st_louis") == stored_ballots(cvr_db)
+    conn.close()
@@ -0,0 +1,109 @@
+"""
+Tests for the report and candidate lookups shared by the importers
+(cvr/reference_data.py).
+
+Run with:
+    cd cvr/st-louis && uv run --with pytest pytest ../../tests
+"""
+
+import sqlite3
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "cvr"))
+from reference_data import ReferenceData, normalize_for_match  # noqa: E402
+
+MAYOR, COMPTROLLER = 1, 2
+
+
+def reference_database():
+    """Two reports of one election, spelling names as the website does."""
+    conn = sqlite3.connect(":memory:")
+    conn.executescript(
+        """
+        CREATE TABLE reports (id INTEGER PRIMARY KEY, office TEXT, date TEXT, path TEXT, ballotCount INTEGER);
+        CREATE TABLE candidates (id INTEGER PRIMARY KEY, report_id INTEGER, name TEXT, votes INTEGER);
+        """
+    )
+    conn.executemany(
+        "INSERT INTO reports (id, office, date, path) VALUES (?, ?, '2025-03-04', ?)",
+        [
+            (MAYOR, "mayor", "us/mo/st_louis/2025/03/mayor"),
+            (COMPTROLLER, "comptroller", "us/mo/st_louis/2025/03/comptroller"),
+        ],
+    )
+    conn.executemany(
+        "INSERT INTO candidates (report_id, name, votes) VALUES (?, ?, 0)",
+        [
+            (MAYOR, "Tishaura O. Jones"),
+            (MAYOR, "Cara Spencer"),
+            (MAYOR, "Andrew  Jones"),
+            (COMPTROLLER, "Donna Baringer"),
+            # Same spelling in another report, which must not be touched
+            (COMPTROLLER, "Cara Spencer"),
+        ],
+    )
+    return conn
+
+
+def test_normalize_for_match():
+    assert normalize_for_match("Tishaura O. Jones") == "TISHAURAOJONES"
+    assert normalize_for_match("TISHAURA O JONES") == "TISHAURAOJONES"
+    assert normalize_for_match("andrew  jones") == normalize_for_match("ANDREW JONES")
+
+
+def test_update_votes_with_matched_names():
+    """CVR spellings map to the report's names; unmatched ones are reported."""
+    conn = reference_database()
+    reference = ReferenceData.load(conn, "date = ?", ("2025-03-04",))
+    assert reference.report_id(office="mayor") == MAYOR
+    assert reference.report_id(path="us/mo/st_louis/2025/03/comptroller") == (
+        COMPTROLLER
+    )
+
+    cvr_votes = {
+        "TISHAURA O JONES": 310,
+        "CARA SPENCER": 420,
+        "ANDREW JONES": 95,
+        "WRITE-IN": 12,
+    }
+    mapping = reference.name_mapping(MAYOR, cvr_votes)
+    assert mapping == {
+        "TISHAURA O JONES": "Tishaura O. Jones",
+        "CARA SPENCER": "Cara Spencer",
+        "ANDREW JONES": "Andrew  Jones",
+    }
+
+    votes = [
+        (MAYOR, mapping.get(name, name), count) for name, count in cvr_votes.items()
+    ]
+    # A repeated candidate keeps the last value given
+    votes.insert(0, (MAYOR, "Cara Spencer", 1))
+    mismatches = reference.update_votes(conn, votes)
+
+    assert mismatches == [(MAYOR, "WRITE-IN", 12, None)]
+    assert conn.execute(
+        "SELECT report_id, name, votes FROM candidates ORDER BY id"
+    ).fetchall() == [
+        (MAYOR, "Tishaura O. Jones", 310),
+        (MAYOR, "Cara Spencer", 420),
+        (MAYOR, "Andrew  Jones", 95),
+        (COMPTROLLER, "Donna Baringer", 0),
+        (COMPTROLLER, "Cara Spencer", 0),
+    ]
+
+
+def test_update_votes_reports_counts_that_did_not_stick():
+    """A row left with another count is reported with what it holds."""
+    conn = reference_database()
+    conn.execute(
+        """
+        CREATE TRIGGER cap_votes AFTER UPDATE OF votes ON candidates
+        WHEN NEW.votes > 400
+        BEGIN UPDATE candidates SET votes = 400 WHERE id = NEW.id; END
+        """
+    )
+    mismatches = ReferenceData.update_votes(
+        conn, [(MAYOR, "Cara Spencer", 420), (MAYOR, "Tishaura O. Jones", 310)]
+    )
+    assert mismatches == [(MAYOR, "Cara Spencer", 420, 400)]